@@ -0,0 +1,83 @@
+"""
+Decimal 엔진 vs fixed(스케일 정수) 엔진: 차분 검증.
+
+여러 seed 의 합성 원장(소수 수량 포함)을 두 엔진으로 리플레이해서
+lot 별 qty/price/stop 과 티커별 실현손익이 str() 까지 완전히 같은지 확인한다.
+시간도 함께 출력하지만 참고용이다: CPython 에서는 C 로 구현된 Decimal 이 순수 파이썬 정수 루프보다 빠르다.
+
+    python bench/bench_engines.py --rows 100000 --seeds 5
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import random
+import time
+from typing import Dict, List, Tuple
+
+from synth import generate_rows, tb
+
+
+def fractional(rows: List[List[str]], seed: int) -> List[List[str]]:
+    """일부 원장은 수량을 1/4 단위로 바꿔 소수 qty 도 검증한다."""
+    rnd = random.Random(seed)
+    if rnd.random() < 0.5:
+        return rows
+    out = []
+    for r in rows:
+        r = list(r)
+        if r[3] not in ("0", "-0"):
+            r[3] = str(tb.Decimal(r[3]) / 4)
+        out.append(r)
+    return out
+
+
+def corpus(n: int, seed: int) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(tb.HEADER)
+    writer.writerows(fractional(list(generate_rows(n, seed)), seed))
+    return buf.getvalue()
+
+
+def snapshot(result: Tuple[Dict, Dict]) -> Tuple[Dict, Dict]:
+    positions, realized = result
+    # str() 로 비교해서 표시 자릿수(체크포인트·출력에 그대로 나간다)도 같은지 확인
+    lots = {t: {i: (str(l.qty), str(l.price), str(l.stop)) for i, l in ls.items()} for t, ls in positions.items()}
+    return lots, {t: str(pl) for t, pl in realized.items()}
+
+
+def run(text: str, engine: str) -> Tuple[Dict, Dict]:
+    lines = io.StringIO(text)
+    if engine == "fixed":
+        return tb.build_portfolio_fixed(tb.parse_rows(lines, number=str))
+    return tb.build_portfolio(tb.parse_rows(lines))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=100_000)
+    ap.add_argument("--seeds", type=int, default=5)
+    args = ap.parse_args()
+
+    totals = {"decimal": 0.0, "fixed": 0.0}
+    for seed in range(args.seeds):
+        text = corpus(args.rows, seed)
+        results = {}
+        for engine in totals:
+            start = time.perf_counter()
+            results[engine] = snapshot(run(text, engine))
+            totals[engine] += time.perf_counter() - start
+        for engine in totals:
+            if results[engine] != results["decimal"]:
+                raise SystemExit(f"seed {seed}: {engine} engine disagrees with decimal")
+        print(f"seed {seed}: identical ({len(results['decimal'][0])} tickers)")
+
+    rows = args.rows * args.seeds
+    for engine, secs in totals.items():
+        print(f"{engine:<8}: {secs:8.3f}s  {rows / secs:12,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+리플레이 핫루프 벤치마크: 예전 DictReader + dict 행 경로 vs parse_rows() + TradeRow 경로.
+
+    python bench/bench_rows.py --rows 200000
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import tempfile
+import time
+from decimal import Decimal
+from pathlib import Path
+from typing import Dict, Iterable, Tuple
+
+from synth import tb, write_ledger
+
+
+def legacy_build_portfolio(rows: Iterable[Dict[str, str]]) -> Tuple[Dict, Dict]:
+    """TradeRow 도입 전 build_portfolio 루프 (비교 기준)"""
+    positions: Dict[str, Dict[int, tb.Lot]] = {}
+    realized: Dict[str, Decimal] = {}
+    for r in rows:
+        qty = Decimal(r["qty"])
+        price = Decimal(r["price"])
+        stop = Decimal(r["stop"])
+        ticker = r["ticker"]
+        row_id = int(r["id"])
+        note = r.get("note", "")
+        positions.setdefault(ticker, {})
+        realized.setdefault(ticker, Decimal("0"))
+        if qty > 0:
+            positions[ticker][row_id] = tb.Lot(row_id, ticker, qty, price, stop)
+        elif qty < 0:
+            target = tb._parse_target_id(note)
+            lot = positions[ticker].get(target)
+            if not lot:
+                continue
+            sell_qty = -qty
+            if sell_qty > lot.qty:
+                sell_qty = lot.qty
+            realized[ticker] += sell_qty * (price - lot.price)
+            lot.qty -= sell_qty
+            if lot.qty == 0:
+                del positions[ticker][target]
+        else:
+            target = tb._parse_target_id(note)
+            lot = positions[ticker].get(target)
+            if lot:
+                lot.stop = stop
+    return positions, realized
+
+
+def run_dictreader(path: Path) -> Tuple[Dict, Dict]:
+    with path.open(newline="") as f:
+        return legacy_build_portfolio(list(csv.DictReader(f)))
+
+
+def run_tuple(path: Path) -> Tuple[Dict, Dict]:
+    with path.open(newline="") as f:
+        return tb.build_portfolio(tb.parse_rows(f))
+
+
+def best_of(fn, path: Path, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(path)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=200_000)
+    ap.add_argument("--tickers", type=int, default=8)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        path = write_ledger(Path(d) / "trades.csv", args.rows, tickers=args.tickers)
+
+        # 두 경로의 결과가 같은지 먼저 확인
+        old_pos, old_real = run_dictreader(path)
+        new_pos, new_real = run_tuple(path)
+        assert old_real == new_real
+        assert {t: {i: (l.qty, l.price, l.stop) for i, l in lots.items()} for t, lots in old_pos.items()} == \
+               {t: {i: (l.qty, l.price, l.stop) for i, l in lots.items()} for t, lots in new_pos.items()}
+
+        old = best_of(run_dictreader, path, args.repeat)
+        new = best_of(run_tuple, path, args.repeat)
+
+    print(f"rows={args.rows} tickers={args.tickers} (best of {args.repeat})")
+    print(f"DictReader + dict : {old:8.3f}s  {args.rows / old:12,.0f} rows/s")
+    print(f"parse_rows + tuple: {new:8.3f}s  {args.rows / new:12,.0f} rows/s  (x{old / new:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+CLI 시작 시간 벤치마크: 서브 명령별 첫 출력까지의 시간(time-to-first-output)과
+`python -X importtime` 기준 import 비용 상위 모듈.
+
+    python bench/bench_startup.py --rows 2000 --repeat 10
+    python bench/bench_startup.py -- status -h "stop T000 1 --id 1"   # 옵션처럼 보이는 명령은 -- 뒤에
+
+- cold: main.py 의 .pyc 와 체크포인트/메타 보조 파일을 지운 뒤 실행 (설치 직후, 원장 수정 직후)
+- warm: 직전 실행이 남긴 .pyc 와 체크포인트를 그대로 쓰는 보통의 실행
+각 실행은 합성 원장(임시 폴더)을 가리키도록 DATA_PATH 만 바꾼 뒤 src/tb.py 와 같이 main.main() 을 부른다.
+쓰기 명령도 측정할 수 있지만 실행할 때마다 원장에 행이 붙는다.
+"""
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from synth import SRC, write_ledger
+
+DEFAULT_COMMANDS = ["status", "report", "summary", "-h"]
+
+RUNNER = """\
+import sys
+sys.path.insert(0, {src!r})
+import main
+from pathlib import Path
+main.DATA_PATH = Path({data!r})
+main.main()
+"""
+
+
+def run_once(runner: Path, argv: List[str], env: Dict[str, str],
+             extra: Tuple[str, ...] = ()) -> Tuple[float, float, bytes]:
+    """(첫 출력까지 초, 종료까지 초, stderr) — 첫 바이트가 파이프에 나오는 순간을 잰다."""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, *extra, str(runner), *argv], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert proc.stdout is not None and proc.stderr is not None
+    first_byte = proc.stdout.read(1)
+    first = time.perf_counter() - start
+    proc.stdout.read()
+    err = proc.stderr.read()
+    proc.wait()
+    total = time.perf_counter() - start
+    if not first_byte:
+        first = total
+    return first, total, err
+
+
+def make_cold(data: Path) -> None:
+    """main 의 바이트코드 캐시와 원장 보조 파일(체크포인트/메타)을 지운다."""
+    Path(importlib.util.cache_from_source(str(SRC / "main.py"))).unlink(missing_ok=True)
+    for sidecar in data.parent.glob(f"{data.stem}.*.json"):
+        sidecar.unlink()
+
+
+def import_breakdown(runner: Path, argv: List[str], env: Dict[str, str], top: int) -> List[Tuple[int, int, str]]:
+    """-X importtime 출력에서 (self us, cumulative us, 모듈) 을 self 시간 큰 순으로 top 개"""
+    _, _, err = run_once(runner, argv, env, ("-X", "importtime"))
+    entries = []
+    for line in err.decode("utf-8", "replace").splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        entries.append((int(self_us), int(cumulative), name.rstrip()))
+    entries.sort(reverse=True)
+    return entries[:top]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("commands", nargs="*", default=DEFAULT_COMMANDS,
+                    help="Subcommand lines to time (default: status, report, summary, -h)")
+    ap.add_argument("--rows", type=int, default=2000)
+    ap.add_argument("--tickers", type=int, default=8)
+    ap.add_argument("--repeat", type=int, default=10)
+    ap.add_argument("--top", type=int, default=12, help="Modules shown in the import breakdown")
+    args = ap.parse_args()
+
+    # 이 벤치는 .pyc 캐시 유무를 비교하므로 바이트코드 쓰기를 막는 설정은 끈다
+    env = dict(os.environ, TRADINGBOOK_NO_DAEMON="1")
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    with tempfile.TemporaryDirectory() as d:
+        data = write_ledger(Path(d) / "trades.csv", args.rows, tickers=args.tickers)
+        runner = Path(d) / "run.py"
+        runner.write_text(RUNNER.format(src=str(SRC), data=str(data)))
+
+        print(f"rows={args.rows} tickers={args.tickers} repeat={args.repeat} ({sys.executable})")
+        print(f"{'command':<24} {'cold first':>11} {'warm first':>11} {'warm total':>11}")
+        for line in args.commands:
+            argv = shlex.split(line)
+            cold = []
+            for _ in range(args.repeat):
+                make_cold(data)
+                cold.append(run_once(runner, argv, env)[0])
+            run_once(runner, argv, env)  # .pyc / 체크포인트를 다시 만들어 둔다
+            warm = [run_once(runner, argv, env)[:2] for _ in range(args.repeat)]
+            print(f"{line:<24} {statistics.median(cold) * 1e3:9.1f}ms "
+                  f"{statistics.median(w[0] for w in warm) * 1e3:9.1f}ms "
+                  f"{statistics.median(w[1] for w in warm) * 1e3:9.1f}ms")
+
+        argv = shlex.split(args.commands[0])
+        for label in ("cold", "warm"):
+            if label == "cold":
+                make_cold(data)
+            else:
+                run_once(runner, argv, env)
+            print(f"\n-X importtime ({label}, '{args.commands[0]}'), top {args.top} by self time:")
+            print(f"{'self':>9} {'cumulative':>11}  module")
+            for self_us, cumulative, name in import_breakdown(runner, argv, env, args.top):
+                print(f"{self_us / 1e3:7.2f}ms {cumulative / 1e3:9.2f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
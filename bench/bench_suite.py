@@ -0,0 +1,289 @@
+"""
+리플레이 벤치마크 스위트: 원장 크기별로 각 명령의 처리량(rows/s), 최대 RSS, 단계별 지연을 재고
+결과를 JSON 파일로 남긴다. 버전 간 회귀는 --compare 로 이전 결과와 비교한다.
+
+    python bench/bench_suite.py                                   # 10k, 100k, 1M
+    python bench/bench_suite.py --sizes 10k,100k,1M,10M --cache /tmp/ledgers
+    python bench/bench_suite.py --sizes 100k --tickers 50 --max-open 200 --out new.json --compare old.json
+
+측정은 명령마다 새 프로세스에서 한다 (RSS 가 섞이지 않도록).
+- phases: import → parse(parse_rows) → replay(build_portfolio) → render(print_*) 또는 plan → append
+          단계를 나누려고 행 목록을 한 번 메모리에 올리므로 RSS 는 실제 명령보다 크다
+- cold  : 체크포인트/메타 없이 main.main(argv) 한 번 (전체 리플레이)
+- warm  : 다른 명령이 체크포인트를 남긴 뒤 main.main(argv) 한 번
+쓰기 명령이 덧붙인 행은 실행 후 원장을 원래 크기로 잘라 되돌린다.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+
+READ_COMMANDS = ["status", "report", "summary"]
+WRITE_COMMANDS = ["add", "trim", "stop", "split"]
+MODES = ["phases", "cold", "warm"]
+
+
+def parse_size(text: str) -> int:
+    """'10k' / '1M' / '250000' → 행 수"""
+    text = text.strip().lower().replace("_", "")
+    scale = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+
+# 원장에서 다시 만들어지는 보조 파일 (.gitignore 의 목록과 같다). 남아 있으면 cold 측정이 일부 warm 이 된다
+DERIVED_SIDECARS = ["ckpt.json", "meta.json", "idx.db*", "asof.json", "asof.states"]
+
+
+def clear_sidecars(data: Path) -> None:
+    for pattern in DERIVED_SIDECARS:
+        for sidecar in data.parent.glob(f"{data.stem}.{pattern}"):
+            sidecar.unlink()
+
+
+def tail_lot(data: Path, block: int = 1 << 16) -> Dict[str, Any]:
+    """
+    원장 끝부분에서 마지막 매수 lot 을 찾아 남은 수량까지 계산한다 (쓰기 명령 인자용).
+    그 lot 을 대상으로 한 이후 행은 모두 같은 꼬리 안에 있다.
+    """
+    with data.open("rb") as f:
+        f.seek(max(0, f.seek(0, os.SEEK_END) - block))
+        lines = f.read().decode("utf-8").splitlines()[1:]
+    rows = list(csv.reader(lines))
+    for i in range(len(rows) - 1, -1, -1):
+        row_id, _, ticker, qty = rows[i][:4]
+        if qty.isdigit() and int(qty) > 0:
+            left = int(qty)
+            for later in rows[i + 1:]:
+                if later[6] == row_id and later[3].startswith("-"):
+                    left += int(later[3])
+            if left > 1:
+                return {"ticker": ticker, "id": row_id, "qty": left}
+    raise SystemExit(f"no open lot near the end of {data}")
+
+
+def command_argv(name: str, lot: Dict[str, Any]) -> List[str]:
+    t, i, q = lot["ticker"], lot["id"], lot["qty"]
+    return {
+        "status": ["status"],
+        "report": ["report"],
+        "summary": ["summary"],
+        "add": ["add", t, "10", "100", "90", "--date", "2030-01-02"],
+        "trim": ["trim", t, "1", "--id", i, "--price", "101", "--date", "2030-01-02"],
+        "stop": ["stop", t, "95", "--id", i, "--date", "2030-01-02"],
+        "split": ["split", t, "--id", i, "--parts", f"1:91 {q - 1}:92", "--date", "2030-01-02"],
+    }[name]
+
+
+# --- 자식 프로세스 ---------------------------------------------------------
+
+def child(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """명령 하나를 측정하고 {phases, peak_rss_kb, message} 를 돌려준다."""
+    import contextlib
+    import resource
+
+    phases: Dict[str, float] = {}
+    start = time.perf_counter()
+    sys.path.insert(0, str(SRC))
+    import main as tb
+    phases["import"] = time.perf_counter() - start
+
+    tb.DATA_PATH = Path(spec["data"])
+    tb.ENGINE = spec["engine"]
+    argv = spec["argv"]
+    out = io.StringIO()
+
+    with contextlib.redirect_stdout(out):
+        if spec["mode"] != "phases":
+            start = time.perf_counter()
+            tb.main(["--engine", spec["engine"], *argv])
+            phases["command"] = time.perf_counter() - start
+        else:
+            number = str if tb.ENGINE != "decimal" else tb.Decimal
+            replay = {"decimal": tb.build_portfolio, "fixed": tb.build_portfolio_fixed}[tb.ENGINE]
+            start = time.perf_counter()
+            with tb.DATA_PATH.open(newline="") as f:
+                rows = list(tb.parse_rows(f, number=number))
+            phases["parse"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            positions, realized = replay(rows)
+            phases["replay"] = time.perf_counter() - start
+            del rows
+
+            name = argv[0]
+            start = time.perf_counter()
+            if name in ("status", "summary"):
+                tb.print_status(positions)
+            if name in ("report", "summary"):
+                tb.print_report(positions, realized)
+            if name in READ_COMMANDS:
+                phases["render"] = time.perf_counter() - start
+            else:
+                args = tb.build_parser(name).parse_args(argv)
+                planned, message = getattr(tb, f"plan_{name}")(args, positions, tb.next_row_id())
+                phases["plan"] = time.perf_counter() - start
+                start = time.perf_counter()
+                if planned:
+                    tb.append_rows(planned)
+                phases["append"] = time.perf_counter() - start
+                print(message)
+
+    lines = out.getvalue().strip().splitlines()
+    return {
+        "phases": phases,
+        # 리눅스는 KB, macOS 는 바이트 단위
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == "darwin" else 1),
+        "message": lines[-1] if lines and argv[0] in WRITE_COMMANDS else "",
+    }
+
+
+def run_child(spec: Dict[str, Any]) -> Dict[str, Any]:
+    env = dict(os.environ, TRADINGBOOK_NO_DAEMON="1")
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, __file__, "--child", json.dumps(spec)], env=env,
+                          capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode:
+        raise SystemExit(f"child failed for {spec['argv']}:\n{proc.stderr}")
+    result = json.loads(proc.stdout)
+    result["wall"] = wall
+    return result
+
+
+# --- 부모 프로세스 ---------------------------------------------------------
+
+def ledger(n: int, args: argparse.Namespace, workdir: Path) -> Path:
+    from synth import write_ledger
+
+    name = f"trades-{n}-s{args.seed}-t{args.tickers}-o{args.max_open}.csv"
+    cached = (args.cache / name) if args.cache else None
+    if cached and cached.exists():
+        data = workdir / "trades.csv"
+        data.write_bytes(cached.read_bytes())
+        return data
+    start = time.perf_counter()
+    data = write_ledger(workdir / "trades.csv", n, args.seed, args.tickers, args.max_open)
+    print(f"  generated {n:,} rows in {time.perf_counter() - start:.1f}s", flush=True)
+    if cached:
+        args.cache.mkdir(parents=True, exist_ok=True)
+        cached.write_bytes(data.read_bytes())
+    return data
+
+
+def measure(n: int, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        data = ledger(n, args, Path(d))
+        base_size = data.stat().st_size
+        lot = tail_lot(data)
+        for name in args.commands:
+            argv = command_argv(name, lot)
+            for mode in args.modes:
+                clear_sidecars(data)
+                if mode == "warm":
+                    run_child({"mode": "cold", "data": str(data), "engine": args.engine, "argv": ["status"]})
+                result = run_child({"mode": mode, "data": str(data), "engine": args.engine, "argv": argv})
+                if data.stat().st_size != base_size:
+                    with data.open("r+b") as f:  # 쓰기 명령이 붙인 행을 되돌린다
+                        f.truncate(base_size)
+
+                phases = result["phases"]
+                work = phases.get("command") or phases["parse"] + phases["replay"]
+                record = {
+                    "rows": n,
+                    "command": name,
+                    "mode": mode,
+                    "seconds": round(work, 6),
+                    "rows_per_s": round(n / work) if work else None,
+                    "wall_seconds": round(result["wall"], 6),
+                    "peak_rss_mb": round(result["peak_rss_kb"] / 1024, 1),
+                    "phases": {k: round(v, 6) for k, v in phases.items()},
+                }
+                if result["message"]:
+                    record["message"] = result["message"]
+                results.append(record)
+                detail = " ".join(f"{k}={v * 1e3:.1f}ms" for k, v in phases.items())
+                print(f"  {name:<8} {mode:<6} {work:9.3f}s {record['rows_per_s'] or 0:>12,} rows/s "
+                      f"{record['peak_rss_mb']:8.1f}MB  {detail}", flush=True)
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC, capture_output=True, text=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(old_path: Path, params: Dict[str, Any], results: List[Dict[str, Any]]) -> None:
+    old = json.loads(old_path.read_text())
+    before = {(r["rows"], r["command"], r["mode"]): r for r in old["results"]}
+    print(f"\nvs {old_path} ({old.get('revision') or '?'}):")
+    if old.get("params") != params:
+        print(f"⚠️ parameters differ: {old.get('params')} → {params}")
+    print(f"{'rows':>10} {'command':<8} {'mode':<6} {'old s':>9} {'new s':>9} {'delta':>8} {'rss MB':>15}")
+    for r in results:
+        o = before.get((r["rows"], r["command"], r["mode"]))
+        if not o:
+            continue
+        delta = (r["seconds"] / o["seconds"] - 1) * 100 if o["seconds"] else 0.0
+        print(f"{r['rows']:>10,} {r['command']:<8} {r['mode']:<6} {o['seconds']:9.3f} {r['seconds']:9.3f} "
+              f"{delta:+7.1f}% {o['peak_rss_mb']:7.1f}→{r['peak_rss_mb']:<7.1f}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", default="10k,100k,1M", help="Comma-separated row counts (e.g. 10k,100k,1M,10M)")
+    ap.add_argument("--tickers", type=int, default=8)
+    ap.add_argument("--max-open", type=int, default=40, help="Open lots per ticker before the generator closes one")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--engine", choices=["decimal", "fixed"], default="decimal")
+    ap.add_argument("--commands", default=",".join(READ_COMMANDS + WRITE_COMMANDS))
+    ap.add_argument("--modes", default=",".join(MODES))
+    ap.add_argument("--cache", type=Path, help="Keep generated ledgers here and reuse them on later runs")
+    ap.add_argument("--out", type=Path, default=Path("bench_results.json"))
+    ap.add_argument("--compare", type=Path, help="Previous --out file to diff against")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        print(json.dumps(child(json.loads(args.child))))
+        return
+
+    args.commands = args.commands.split(",")
+    args.modes = args.modes.split(",")
+    results = []
+    for size in args.sizes.split(","):
+        n = parse_size(size)
+        print(f"rows={n:,} tickers={args.tickers} max_open={args.max_open} engine={args.engine}", flush=True)
+        results.extend(measure(n, args))
+
+    report = {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"tickers": args.tickers, "max_open": args.max_open, "seed": args.seed, "engine": args.engine},
+        "results": results,
+    }
+    args.out.write_text(json.dumps(report, indent=2, ensure_ascii=False) + "\n")
+    print(f"\nwrote {len(results)} results to {args.out}")
+    if args.compare:
+        compare(args.compare, report["params"], results)
+
+
+if __name__ == "__main__":
+    main()
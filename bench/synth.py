@@ -0,0 +1,101 @@
+"""
+벤치마크용 합성 원장 생성기.
+
+현재 trades.csv 포맷 그대로 add / trim / stop / split 행을 섞어서 만든다.
+같은 seed 면 항상 같은 원장이 나온다 (버전 간 비교용).
+"""
+from __future__ import annotations
+
+import csv
+import datetime
+import random
+import sys
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+if str(SRC) not in sys.path:
+    sys.path.insert(0, str(SRC))
+
+import main as tb  # noqa: E402
+
+
+def generate_rows(n: int, seed: int = 0, tickers: int = 8, max_open: int = 40) -> Iterator[List[str]]:
+    """
+    n 개 행을 HEADER 순서의 문자열 리스트로 하나씩 만든다.
+    max_open: 티커당 동시에 열려 있는 lot 상한. 넘으면 lot 하나를 전량 청산한다.
+    """
+    rnd = random.Random(seed)
+    names = [f"T{i:03d}" for i in range(tickers)]
+    open_lots: Dict[str, Dict[int, int]] = {t: {} for t in names}
+    day = datetime.date(2015, 1, 2)
+    row_id = 0
+
+    def row(ticker: str, qty: object, price: object, stop: object, note: str) -> List[str]:
+        nonlocal row_id
+        row_id += 1
+        target = tb._parse_target_id(note)
+        return [str(row_id), day.isoformat(), ticker, str(qty), str(price), str(stop),
+                "" if target is None else str(target), note]
+
+    while row_id < n:
+        if rnd.random() < 0.05:
+            day += datetime.timedelta(days=1)
+        ticker = rnd.choice(names)
+        lots = open_lots[ticker]
+        price = f"{rnd.uniform(20, 500):.2f}"
+        r = rnd.random()
+
+        if len(lots) >= max_open:
+            lot_id = rnd.choice(list(lots))
+            yield row(ticker, -lots.pop(lot_id), price, 0, f"trim id={lot_id}")
+        elif r < 0.40 or not lots:
+            qty = rnd.randint(1, 300)
+            stop = f"{float(price) * rnd.uniform(0.85, 0.97):.2f}"
+            yield row(ticker, qty, price, stop, "setup")
+            lots[row_id] = qty
+        elif r < 0.70:
+            lot_id = rnd.choice(list(lots))
+            sell = rnd.randint(1, lots[lot_id])
+            yield row(ticker, -sell, price, 0, f"trim id={lot_id}")
+            lots[lot_id] -= sell
+            if lots[lot_id] == 0:
+                del lots[lot_id]
+        elif r < 0.92 or n - row_id < 3:
+            lot_id = rnd.choice(list(lots))
+            stop = f"{float(price) * 0.9:.2f}"
+            yield row(ticker, 0, 0, stop, f"stop id={lot_id}")
+        else:
+            # cmd_split 과 같은 3행 패턴: 원래 lot 축소 + 스탑 이동 + 새 lot
+            lot_id = rnd.choice(list(lots))
+            qty = lots[lot_id]
+            if qty < 2:
+                continue
+            keep = rnd.randint(1, qty - 1)
+            note = f"split from id={lot_id} part {{}}/3"
+            yield row(ticker, -(qty - keep), price, 0, note.format(1))
+            yield row(ticker, 0, 0, f"{float(price) * 0.95:.2f}", note.format(2))
+            yield row(ticker, qty - keep, price, f"{float(price) * 0.9:.2f}", note.format(3))
+            lots[lot_id] = keep
+            lots[row_id] = qty - keep
+
+
+def write_ledger(path: Path, n: int, seed: int = 0, tickers: int = 8, max_open: int = 40) -> Path:
+    with path.open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(tb.HEADER)
+        writer.writerows(generate_rows(n, seed, tickers, max_open))
+    return path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Write a deterministic synthetic trades.csv")
+    ap.add_argument("out", type=Path)
+    ap.add_argument("--rows", type=int, default=100_000)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--tickers", type=int, default=8)
+    ap.add_argument("--max-open", type=int, default=40, help="Open lots per ticker before one is closed")
+    args = ap.parse_args()
+    write_ledger(args.out, args.rows, args.seed, args.tickers, args.max_open)
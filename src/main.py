@@ -5,54 +5,117 @@
 # 이렇게 하면 클래스 내부에서 자기 자신이나 아직 정의되지 않은 타입을 타입 힌트로 쓸 수 있다.
 from __future__ import annotations
 
-import argparse # cls 명령어 파싱 모듈
+# 하루 수백 번 실행되는 CLI 라서 시작 시간이 곧 응답 시간이다.
+# 모든 경로에 필요한 모듈만 여기서 import 하고, 특정 명령에서만 쓰는 모듈
+# (argparse, datetime, hashlib, socket, signal, shlex, contextlib, traceback)은 쓰는 함수 안에서 import 한다.
+# 특히 데몬으로 전달되는 호출은 argparse 없이 json + socket 만으로 끝난다.
 import csv
-import datetime
-from decimal import Decimal, getcontext # 금융에서 주로 사용하는 고정소수점 모듈
+import io
+import json
+import os
+from decimal import Decimal, InvalidOperation, getcontext # 금융에서 주로 사용하는 고정소수점 모듈
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import sys
 
+if TYPE_CHECKING:  # 어노테이션 전용 (실행 시에는 쓰는 함수 안에서 import)
+    import argparse
+    import socket
+
 # 고정 소수점 연산인 Decimal의 내부 계산 정밀도를 소수점 12자리까지 보장
 getcontext().prec = 12
 
 
 DATA_PATH = Path(__file__).resolve().parents[1] / "data" / "trades.csv"
-HEADER = ["id", "date", "ticker", "qty", "price", "stop", "note"]
-
-def print_status(positions: Dict[str, Dict[int, Lot]]) -> None:
+HEADER = ["id", "date", "ticker", "qty", "price", "stop", "target_id", "note"]
+# target_id 컬럼이 생기기 전 스키마 (대상 lot 은 note 의 "id=N" 으로만 표시)
+LEGACY_HEADER = ["id", "date", "ticker", "qty", "price", "stop", "note"]
+CHECKPOINT_VERSION = 2
+
+# 리플레이 수치 엔진: "decimal"(기본) 또는 "fixed"(스케일 정수). main() 의 --engine 으로 바뀐다.
+# fixed 는 Decimal 결과를 정수 연산으로 교차 검증하는 용도이며, CPython 에서는 Decimal 보다 빠르지 않다.
+ENGINE = "decimal"
+# fixed 엔진의 소수 자릿수 (qty 1e-8, price 1e-6 단위 정수로 계산)
+QTY_DIGITS = 8
+PRICE_DIGITS = 6
+# 샤드 레이아웃에서 status/report 가 샤드를 병렬로 리플레이할 프로세스 수 (--jobs)
+JOBS = 1
+
+def print_status(positions: Dict[str, Dict[int, Lot]], quotes: Optional[Dict[str, Quote]] = None) -> None:
+    """quotes(티커 → 시세)가 있으면 시세가 있는 티커의 lot 에 평가 금액/평가 손익/스탑까지 거리를 붙인다."""
     print("🟢 Open Lots\n")
+    stale = 0
+    now = _now() if quotes else 0.0
     for ticker in sorted(positions.keys()):
         lots = positions[ticker]
+        # 시세 조회는 티커당 한 번: 그 티커의 lot 들은 같은 시세로 한꺼번에 평가한다
+        quote = quotes.get(ticker) if quotes else None
+        mark = ""
+        if quote:
+            last = quote.price
+            flag = "*" if now - quote.ts > PRICE_STALE_SECONDS else ""
+            stale += bool(flag) and bool(lots)
         for lot in lots.values():
+            if quote:
+                to_stop = (last - lot.stop) / last * 100 if last else Decimal("0")
+                mark = (f" | Last={last:.2f}{flag} | MV=${lot.qty * last:.2f} | "
+                        f"Unreal=${lot.qty * (last - lot.price):.2f} | ToStop={to_stop:.2f}%")
             print(
                 f"[{ticker:<5}] Lot ID={lot.id} | Qty={lot.qty} | "
                 f"In={lot.price:.2f} | Stop={lot.stop:.2f} | "
-                f"Risk=${lot.risk():.2f}"
+                f"Risk=${lot.risk():.2f}{mark}"
             )
+    if stale:
+        print(f"\n* {stale} ticker(s) priced with quotes older than {PRICE_STALE_SECONDS // 3600}h (refresh with `prices FILE`)")
 
 
-def print_report(positions: Dict[str, Dict[int, Lot]], realized: Dict[str, Decimal]) -> None:
+def print_report(positions: Dict[str, Dict[int, Lot]], realized: Dict[str, Decimal],
+                 quotes: Optional[Dict[str, Quote]] = None) -> None:
+    """quotes 가 있으면 시세 기준 평가 금액과 평가 손익 컬럼을 덧붙인다 (시세 없는 티커는 -)."""
     print("\n📊 Portfolio Summary (by Ticker)\n")
-    print("Ticker | Shares | AvgIn | AvgStop | Risk$ | Realized P/L")
-    print("-" * 60)
-
+    if quotes:
+        print("Ticker | Shares | AvgIn | AvgStop | Risk$ | Realized P/L | Last | MktVal | Unrealized P/L")
+        print("-" * 90)
+    else:
+        print("Ticker | Shares | AvgIn | AvgStop | Risk$ | Realized P/L")
+        print("-" * 60)
+
+    zero = Decimal("0")
+    now = _now() if quotes else 0.0
     for ticker, lots in positions.items():
-        qty = sum(l.qty for l in lots.values())
+        # 티커당 lot 들을 한 번만 순회하면서 네 가지 합계를 같이 누적
+        qty = cost = stop_cost = risk = zero
+        for l in lots.values():
+            qty += l.qty
+            cost += l.qty * l.price
+            stop_cost += l.qty * l.stop
+            risk += l.risk()
         if qty == 0:
             continue
-        avg_in = sum(l.qty * l.price for l in lots.values()) / qty
-        avg_stop = sum(l.qty * l.stop for l in lots.values()) / qty
-        risk = sum(l.risk() for l in lots.values())
+        avg_in = cost / qty
+        avg_stop = stop_cost / qty
         pl = realized[ticker]
+        marks = ""
+        if quotes:
+            quote = quotes.get(ticker)
+            if quote:
+                # 평가 손익 = Σ qty × (last - in) = qty × last - cost → lot 을 다시 돌 필요가 없다
+                flag = "*" if now - quote.ts > PRICE_STALE_SECONDS else ""
+                value = qty * quote.price
+                marks = f" | {quote.price:.2f}{flag} | {value:.2f} | {value - cost:.2f}"
+            else:
+                marks = " | - | - | -"
         print(
-            f"{ticker:<6} | {qty} | {avg_in:.2f} | {avg_stop:.2f} | {risk:.2f} | {pl:.2f}"
+            f"{ticker:<6} | {qty} | {avg_in:.2f} | {avg_stop:.2f} | {risk:.2f} | {pl:.2f}{marks}"
         )
 
 
 
 class Lot:
+    # lot 이 수만 개 쌓여도 가볍도록 인스턴스 __dict__ 없이 고정 슬롯만 사용
+    __slots__ = ("id", "ticker", "qty", "price", "stop")
+
     def __init__(self, lot_id: int, ticker: str, qty: Decimal, price: Decimal, stop: Decimal):
         self.id = lot_id
         self.ticker = ticker
@@ -64,40 +127,202 @@ class Lot:
         return (self.price - self.stop) * self.qty
 
 
+class TradeRow(NamedTuple):
+    """
+    리플레이용으로 미리 타입 변환된 CSV 한 행.
+    dict(문자열 키) 대신 튜플 하나라서 행당 할당/조회 비용이 작다.
+    target: 매도/스탑이 적용될 lot id (split 으로 생긴 lot 은 원래 lot id). 없으면 None
+    """
+    id: int
+    date: str
+    ticker: str
+    qty: Decimal
+    price: Decimal
+    stop: Decimal
+    target: Optional[int]
+    note: str
+
+
+class Quote(NamedTuple):
+    """시세 캐시의 한 티커: 가격, 시세 시각(epoch 초), 표시용 ISO 시각"""
+    price: Decimal
+    ts: float
+    as_of: str
+
+
 def ensure_csv() -> None:
-    DATA_PATH.parent.mkdir(exist_ok=True)
-    if not DATA_PATH.exists():
-        with DATA_PATH.open("w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(HEADER)
+    """단일 CSV 레이아웃이면 헤더만 있는 trades.csv 를 만든다 (샤드/SQLite 레이아웃에서는 아무것도 안 한다)"""
+    _backend().ensure()
 
 
-def load_rows() -> List[Dict[str, str]]:
-    ensure_csv()
-    with DATA_PATH.open() as f:
-        reader = csv.DictReader(f) # 첫 줄을 헤더로 인식하고, 이후 각 줄을 dict로 반환하는 이터레이터 객체
-        return list(reader) # 이터레이터를 강제로 모두 소비하여, 각 줄을 딕셔너리로 변환한 리스트 반환
+def parse_rows(lines: Iterable[str], header: Optional[List[str]] = None,
+               number: Any = Decimal, ticker: Optional[str] = None) -> Iterator[TradeRow]:
+    """
+    csv.reader 기반 위치 파서. 컬럼 위치는 헤더에서 한 번만 계산하고,
+    이후에는 인덱스로 바로 꺼내 TradeRow 를 만든다.
+    header 를 안 주면 첫 줄을 헤더로 읽는다.
+    number: qty/price/stop 변환 함수 (fixed 엔진은 str 로 받아 직접 정수화한다)
+    ticker: 주면 그 티커 행만 돌려준다. 다른 티커 행은 필드 분리만 하고 변환 전에 버린다
+
+    두 스키마를 모두 읽는다. target_id 컬럼이 있으면 정수 컬럼을 그대로 쓰고,
+    구 스키마(LEGACY_HEADER)면 note 의 "id=N" 에서 대상 lot 을 복원한다 (migrate 와 같은 규칙).
+    """
+    reader = csv.reader(lines)
+    if header is None:
+        header = next(reader, HEADER)
+    i_id, i_date, i_ticker, i_qty, i_price, i_stop, i_note = (header.index(col) for col in LEGACY_HEADER)
+    i_target = header.index("target_id") if "target_id" in header else -1
+
+    if number is str:
+        number = None  # 문자열 그대로 넘길 때는 함수 호출 자체를 생략
+    if ticker is not None:
+        # 거르지 않는 보통 리플레이의 핫루프에는 비교를 넣지 않는다
+        reader = (f for f in reader if f and f[i_ticker] == ticker)
+
+    for f in reader:
+        if not f:  # 빈 줄 (DictReader 와 동일하게 건너뜀)
+            continue
+        note = f[i_note] if i_note < len(f) else ""
+        if i_target >= 0:
+            target = int(f[i_target]) if f[i_target] else None
+        else:
+            target = _legacy_target(f[i_qty], note)
+        if number is None:
+            yield TradeRow(int(f[i_id]), f[i_date], f[i_ticker], f[i_qty], f[i_price], f[i_stop], target, note)
+        else:
+            yield TradeRow(
+                int(f[i_id]), f[i_date], f[i_ticker],
+                number(f[i_qty]), number(f[i_price]), number(f[i_stop]), target, note,
+            )
 
 
+def read_header(path: Optional[Path] = None) -> List[str]:
+    """CSV 첫 줄(헤더)만 읽는다. 구/신 스키마 판별용"""
+    with (path or DATA_PATH).open(newline="") as f:
+        return next(csv.reader(f), HEADER)
+
+
+def load_rows() -> Iterator[Dict[str, str]]:
+    """
+    CSV 행을 한 줄씩 흘려보내는 제너레이터.
+    list 로 만들지 않으므로 원장이 커져도 메모리 사용량은 행 수와 무관하게 일정하다.
+    """
+    yield from _backend().load_rows()
+
 
 
-def next_row_id(rows: List[Dict[str, str]]) -> int:
-    if not rows:
-        return 1
-    return max(int(r["id"]) for r in rows) + 1
+
+"""
+id 하이워터마크: trades.meta.json 에 {"last_id": 마지막 id, "stat": CSV stat} 를 저장한다.
+append_row 가 행을 쓴 직후 같이 갱신하므로, stat 이 일치하면 CSV 를 읽지 않고 다음 id 를 알 수 있다.
+"""
+def _load_meta() -> Optional[Dict[str, Any]]:
+    try:
+        with _sidecar_path("meta.json").open() as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if isinstance(meta, dict) else None
+
+
+def _save_meta(last_id: int, st: os.stat_result) -> None:
+    _write_json_atomic(_sidecar_path("meta.json"), {"last_id": last_id, "stat": _stat_key(st)})
+
+
+def _tail_row_id() -> int:
+    """메타 파일이 없거나 낡았을 때: 파일 끝부분만 읽어 마지막 행의 id 를 구한다."""
+    with DATA_PATH.open("rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        block = 4096
+        while True:
+            start = max(0, size - block)
+            f.seek(start)
+            lines = f.read(size - start).splitlines()
+            # 맨 앞 줄은 잘린 조각일 수 있으므로 파일 처음부터 읽은 경우가 아니면 버린다
+            if start > 0:
+                lines = lines[1:]
+            lines = [line for line in lines if line.strip()]
+            if lines:
+                fields = next(csv.reader([lines[-1].decode("utf-8")]))
+                if fields[0] == "id":  # 헤더 줄 (구/신 스키마 공통)
+                    return 0
+                try:
+                    return int(fields[0])
+                except ValueError:
+                    break  # note 안의 줄바꿈 등으로 행 경계를 못 찾으면 전체 스캔으로
+            if start == 0:
+                return 0
+            block *= 4
+    return max((int(r["id"]) for r in load_rows()), default=0)
+
+
+def next_row_id() -> int:
+    return _backend().next_row_id()
 
 """
 "a": append 모드 — 기존 파일 내용을 유지하면서 맨 끝에 추가
 newline="": 윈도우 환경에서 불필요한 빈 줄 생김 방지 (표준 권장)
 """
-def append_row(row: Dict[str, str]) -> None:
-    with DATA_PATH.open("a", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=HEADER)
+def append_rows(rows: Iterable[Dict[str, str]]) -> None:
+    """
+    한 명령이 만든 여러 행을 버퍼에 모아 한 번의 write + fsync 로 추가한다.
+    split 처럼 여러 행을 쓰는 명령도 파일 열기/flush 는 한 번뿐이고,
+    중간에 죽어서 일부 행만 남는 경우를 줄인다.
+    """
+    _backend().append_rows(rows)
+
+
+def _append_file(path: Path, rows: Iterable[Dict[str, str]]) -> Optional[Tuple[int, os.stat_result]]:
+    """path 에 행들을 한 번에 덧붙이고 (마지막 id, 쓴 뒤 stat) 을 돌려준다. 쓸 행이 없으면 None"""
+    # 마이그레이션 전 원장이면 그 파일의 헤더(구 스키마)대로 쓴다. target_id 는 note 의 id= 로 남는다
+    header = read_header(path)
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=header, extrasaction="ignore")
+    indexed = _index_path(path).exists()
+    ends = []  # 보조 인덱스용: 각 행이 끝나는 위치 (buf 기준 문자 수)
+    last_id = 0
+    for row in rows:
         writer.writerow(row)
+        last_id = max(last_id, int(row["id"]))
+        if indexed:
+            ends.append(buf.tell())
+    if not last_id:
+        return None
+
+    text = buf.getvalue()
+    with path.open("a", newline="") as f:
+        before = _stat_key(os.fstat(f.fileno()))
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+        after = os.fstat(f.fileno())
+
+    if indexed:
+        # 행마다 바이트 위치를 구해 방금 쓴 행만 인덱스에 넣는다 (한글 note 가 있으니 문자 수가 아닌 바이트 수)
+        entries = []
+        offset = before[0]
+        prev = 0
+        for r, end in zip(parse_rows(io.StringIO(text), header, number=str), ends):
+            size = len(text[prev:end].encode("utf-8"))
+            entries.append((offset, offset + size, r))
+            offset += size
+            prev = end
+        _index_append(path, before, after, entries)
+
+    # 메모리 상태가 쓰기 직전 파일과 일치했다면, 늘어난 부분은 방금 쓴 행뿐이다
+    state = _STATE.get(path)
+    if state and before in (state["stat"], state["trusted"]):
+        state["trusted"] = _stat_key(after)
+    return last_id, after
+
+
+def append_row(row: Dict[str, str]) -> None:
+    append_rows([row])
 
 
 def make_row(row_id: int, date: str, ticker: str, qty: Decimal,
-             price: Decimal, stop: Decimal, note: str) -> Dict[str, str]:
+             price: Decimal, stop: Decimal, note: str,
+             target_id: Optional[int] = None) -> Dict[str, str]:
     """공용 row 생성 헬퍼"""
     return {
         "id": str(row_id),
@@ -106,42 +331,45 @@ def make_row(row_id: int, date: str, ticker: str, qty: Decimal,
         "qty": str(qty),
         "price": str(price),
         "stop": str(stop),
+        "target_id": "" if target_id is None else str(target_id),
         "note": note,
     }
 
 
-def build_portfolio(rows: List[Dict[str, str]]) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+def build_portfolio(
+    rows: Iterable[TradeRow],
+    positions: Optional[Dict[str, Dict[int, Lot]]] = None,
+    realized: Optional[Dict[str, Decimal]] = None,
+) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
     """
     반환값 튜플)
     positions: {ticker: {row_id: Lot}} 형태 — 보유 중인 \n
     realized: {ticker: 수익} 형태 — 실현 수익금
-    """
-
-    positions: Dict[str, Dict[int, Lot]] = {}
-    realized: Dict[str, Decimal] = {}   
-
-    for r in rows:
-        # csv 읽은 값은 기본적으로 str이기 때문에 Decimal로 변환 필요
-        qty = Decimal(r["qty"])
-        price = Decimal(r["price"])
-        stop = Decimal(r["stop"])
-        ticker = r["ticker"]
-        row_id = int(r["id"])
-        note = r.get("note", "")
 
-        # dict에 키 없으면 기본값 세팅
-        positions.setdefault(ticker, {})
-        realized.setdefault(ticker, Decimal("0"))
+    positions/realized 를 넘기면 그 상태(체크포인트) 위에 rows 를 이어서 리플레이한다.
+    rows 는 parse_rows() 가 만든 TradeRow (이미 Decimal 로 변환된 값) 이터러블이다.
+    """
 
+    if positions is None:
+        positions = {}
+    if realized is None:
+        realized = {}
+    zero = Decimal("0")
 
+    # 속성 접근 대신 튜플 언패킹으로 필드를 한 번에 꺼낸다 (핫루프)
+    for row_id, _, ticker, qty, price, stop, target, note in rows:
+        # dict에 키 없으면 기본값 세팅 (setdefault 두 번 대신 조회 한 번)
+        lots = positions.get(ticker)
+        if lots is None:
+            lots = positions[ticker] = {}
+            realized.setdefault(ticker, zero)
 
         # csv 에서 qty가 양수이면 매수 입력, 음수이면 매도 입력, 0이면 그 밖의 처리(move stop) 
         if qty > 0:
             # new lot
-            positions[ticker][row_id] = Lot(row_id, ticker, qty, price, stop)
+            lots[row_id] = Lot(row_id, ticker, qty, price, stop)
         elif qty < 0:
-            target = _parse_target_id(note)
-            lot = positions[ticker].get(target)
+            lot = lots.get(target)
             if not lot:
                 continue
             sell_qty = -qty
@@ -150,30 +378,1453 @@ def build_portfolio(rows: List[Dict[str, str]]) -> Tuple[Dict[str, Dict[int, Lot
             realized[ticker] += sell_qty * (price - lot.price)
             lot.qty -= sell_qty
             if lot.qty == 0:
-                del positions[ticker][target]
+                del lots[target]
         else:  # stop move
-            target = _parse_target_id(note)
-            lot = positions[ticker].get(target)
+            lot = lots.get(target)
             if lot:
                 lot.stop = stop
 
     return positions, realized
 
 
-def _parse_target_id(note: str) -> int:
+class ScaleError(ValueError):
+    """fixed 엔진: 원장 값이 --qty-digits / --price-digits 보다 세밀하다 (main 이 CLI 오류로 바꾼다)"""
+
+
+def to_scaled(text: str, digits: int) -> Tuple[int, int]:
+    """
+    10진 문자열을 10**digits 배 정수로 바꾼다. '12.5', 6 → (12500000, -1)
+    두 번째 값은 Decimal(text) 의 지수 (표시용 자릿수 복원에 사용).
+    digits 보다 세밀한 값은 정확히 표현할 수 없으므로 ScaleError.
+    """
+    # 빠른 경로: '123', '-12.50' 같은 평범한 표기는 int() 한 번으로 끝낸다
+    whole, dot, frac = text.partition(".")
+    if len(frac) <= digits and "e" not in text and "E" not in text:
+        try:
+            return int(whole + frac) * 10 ** (digits - len(frac)), -len(frac)
+        except ValueError:
+            if not dot or whole.strip() not in ("", "-", "+"):
+                raise
+
+    # 일반 경로: 지수 표기('1E+2')나 자릿수 초과 등은 Decimal 로 분해해서 처리
+    sign, digit_tuple, exp = Decimal(text).as_tuple()
+    n = int("".join(map(str, digit_tuple)) or "0")
+    shift = exp + digits
+    if shift < 0:
+        n, rem = divmod(n, 10 ** -shift)
+        if rem:
+            raise ScaleError(f"{text!r} needs more than {digits} decimal places")
+    else:
+        n *= 10 ** shift
+    return (-n if sign else n), exp
+
+
+def from_scaled(n: int, digits: int, exp: Optional[int] = None) -> Decimal:
+    """
+    to_scaled 의 역변환. exp 를 주면 Decimal 엔진과 같은 자릿수로 맞춘다.
+    (자릿수를 맞춘 뒤 context 정밀도를 넘는 값은 Decimal 엔진처럼 반올림된다)
+    """
+    value = Decimal(f"{n}E-{digits}")  # 문자열 생성이라 context 정밀도에 의한 반올림 없음
+    if exp is not None:
+        from decimal import Context
+
+        value = +value.quantize(Decimal(f"1E{exp}"), context=Context(prec=len(str(abs(n))) + abs(exp) + digits))
+    return value
+
+
+def build_portfolio_fixed(
+    rows: Iterable[TradeRow],
+    positions: Optional[Dict[str, Dict[int, Lot]]] = None,
+    realized: Optional[Dict[str, Decimal]] = None,
+    qty_digits: Optional[int] = None,
+    price_digits: Optional[int] = None,
+) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """
+    build_portfolio 와 같은 리플레이를 스케일 정수로 수행하는 fixed 엔진.
+    rows 는 parse_rows(..., number=str) 로 만든 (숫자가 문자열인) TradeRow 이다.
+    qty/price 는 행마다 한 번만 정수로 바뀌고, 루프 안에서는 int 연산만 한다.
+    Decimal 로는 마지막에 한 번만 되돌린다 (출력/체크포인트용).
+
+    lot 상태: [qty(정수), qty 지수, price(정수), price 원문, stop 원문, qty 원문]
+    stop 은 리플레이 계산에 쓰이지 않으므로 원문 그대로 들고 다닌다.
+    qty 원문은 한 번도 매도되지 않은 lot 을 Decimal 로 되돌릴 때 그대로 재사용한다 (매도 시 None).
+    """
+    if qty_digits is None:
+        qty_digits = QTY_DIGITS
+    if price_digits is None:
+        price_digits = PRICE_DIGITS
+    pl_digits = qty_digits + price_digits
+    lots_i: Dict[str, Dict[int, List[Any]]] = {}
+    realized_i: Dict[str, int] = {}
+    # 실현손익의 Decimal 지수 (Decimal 엔진의 덧셈/곱셈 결과 지수를 그대로 따라간다: 표시·체크포인트용)
+    realized_exp: Dict[str, int] = {}
+
+    # 원장에는 같은 수량/가격 문자열이 반복해서 나오므로 변환 결과를 캐시한다
+    qty_cache: Dict[str, Tuple[int, int]] = {}
+    price_cache: Dict[str, Tuple[int, int]] = {}
+
+    # 이어서 리플레이할 초기 상태(체크포인트)는 Decimal → 정수로 한 번 변환
+    for ticker, lots in (positions or {}).items():
+        lots_i[ticker] = {}
+        for lot in lots.values():
+            q, q_exp = to_scaled(str(lot.qty), qty_digits)
+            price_s = str(lot.price)
+            price_cache[price_s] = to_scaled(price_s, price_digits)
+            lots_i[ticker][lot.id] = [q, q_exp, price_cache[price_s][0], price_s, str(lot.stop), str(lot.qty)]
+    for ticker, pl in (realized or {}).items():
+        realized_i[ticker], realized_exp[ticker] = to_scaled(str(pl), pl_digits)
+
+    for row_id, _, ticker, qty_s, price_s, stop_s, target, note in rows:
+        lots = lots_i.get(ticker)
+        if lots is None:
+            lots = lots_i[ticker] = {}
+            realized_i.setdefault(ticker, 0)
+            realized_exp.setdefault(ticker, 0)
+
+        scaled = qty_cache.get(qty_s)
+        if scaled is None:
+            scaled = qty_cache[qty_s] = to_scaled(qty_s, qty_digits)
+        qty, qty_exp = scaled
+        if qty != 0:
+            scaled = price_cache.get(price_s)
+            if scaled is None:
+                scaled = price_cache[price_s] = to_scaled(price_s, price_digits)
+            price, price_exp = scaled
+
+        if qty > 0:
+            lots[row_id] = [qty, qty_exp, price, price_s, stop_s, qty_s]
+        elif qty < 0:
+            lot = lots.get(target)
+            if not lot:
+                continue
+            sell_qty, sell_exp = -qty, qty_exp
+            if sell_qty > lot[0]:
+                sell_qty, sell_exp = lot[0], lot[1]
+            realized_i[ticker] += sell_qty * (price - lot[2])
+            pl_exp = sell_exp + min(price_exp, price_cache[lot[3]][1])
+            if pl_exp < realized_exp[ticker]:
+                realized_exp[ticker] = pl_exp
+            lot[0] -= sell_qty
+            # Decimal 뺄셈 결과의 지수 = 두 피연산자 지수 중 작은 쪽
+            lot[1] = min(lot[1], qty_exp)
+            lot[5] = None
+            if lot[0] == 0:
+                del lots[target]
+        else:  # stop move
+            lot = lots.get(target)
+            if lot:
+                lot[4] = stop_s
+
+    return _scaled_state_to_decimal(lots_i, realized_i, qty_digits, pl_digits, realized_exp)
+
+
+def _scaled_state_to_decimal(
+    lots_i: Dict[str, Dict[int, List[Any]]],
+    realized_i: Dict[str, int],
+    qty_digits: int,
+    pl_digits: int,
+    realized_exp: Dict[str, int],
+) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """
+    fixed 엔진의 정수 상태를 build_portfolio 와 같은 Decimal 상태로 되돌린다.
+    realized_exp: 티커별 실현손익 지수 → str() 까지 Decimal 엔진과 같게 만든다.
+    """
+    # 같은 가격/스탑 문자열은 Decimal 객체 하나를 공유 (불변 객체라 안전)
+    decimals: Dict[str, Decimal] = {}
+
+    def dec(text: str) -> Decimal:
+        value = decimals.get(text)
+        if value is None:
+            value = decimals[text] = Decimal(text)
+        return value
+
+    positions = {
+        ticker: {
+            lot_id: Lot(lot_id, ticker,
+                        dec(qty_s) if qty_s is not None else from_scaled(q, qty_digits, q_exp),
+                        dec(price_s), dec(stop_s))
+            for lot_id, (q, q_exp, _, price_s, stop_s, qty_s) in lots.items()
+        }
+        for ticker, lots in lots_i.items()
+    }
+    realized = {ticker: from_scaled(pl, pl_digits, realized_exp.get(ticker, 0)) for ticker, pl in realized_i.items()}
+    return positions, realized
+
+
+def _parse_target_id(note: str) -> Optional[int]:
+    """구 스키마용: note 에서 "id=N" 토큰을 찾는다. 없거나 깨져 있으면 None (대상 없음으로 무시)"""
+    if "id=" not in note:
+        return None
     for token in note.split():
         if token.startswith("id="):
             try:
                 return int(token.split("=", 1)[1]) # '=' 기준으로 1번 쪼개서 [1] 인덱스를 반환
             except ValueError:
                 pass
-    raise ValueError("target id not found in note")
+    return None
 
 
-def cmd_add(args: argparse.Namespace) -> None:
-    rows = load_rows()
-    row_id = next_row_id(rows)
-    date = args.date or datetime.date.today().isoformat() # date 인자가 없으면 오늘 날짜 사용.
+def _legacy_target(qty: str, note: str) -> Optional[int]:
+    """구 스키마 행의 대상 lot: 매도/스탑 행과 split 으로 생긴 lot 만 note 의 id=N 을 쓴다 (매수 행의 id= 는 메모)"""
+    if "id=" not in note:
+        return None
+    if note.startswith("split from ") or Decimal(qty) <= 0:
+        return _parse_target_id(note)
+    return None
+
+
+"""
+체크포인트: build_portfolio 결과(positions/realized)를 trades.ckpt.json 에 저장해 두고,
+다음 실행에서는 그 뒤에 추가된 행(offset 이후 바이트)만 파싱/리플레이한다.
+
+- offset: 체크포인트가 반영한 CSV 바이트 길이 (항상 행 경계)
+- last_id: offset 까지 반영된 행 중 가장 큰 id
+- digest: CSV 의 [0, offset) 구간 sha1. 그 위쪽이 수정되면 불일치 → 전체 리플레이
+- stat: 저장 시점의 (size, mtime_ns, inode). 그대로면 파일이 안 바뀐 것이므로 해시 검증도 생략
+- baseline: 리플레이가 출발한 컴팩션 베이스라인 세대 (없으면 0). 다르면 전체 리플레이
+- tail: [offset - CKPT_TAIL_CHECK, offset) 구간 sha1. 티커 하나만 읽는 쓰기 경로는 이것과 inode 로만 확인한다
+- tickers: 티커 → 본문에서 그 티커 줄의 위치 [pos, len] / realized: 실현 손익 티커 순서
+
+파일은 첫 줄이 위 헤더, 그 뒤로 티커마다 [lots, 실현 손익] JSON 한 줄이다.
+전체 로드는 본문을 다 읽고, _checkpoint_slice 는 헤더와 그 티커 줄만 읽는다.
+"""
+def _sidecar_path(name: str, path: Optional[Path] = None) -> Path:
+    """원장 파일(기본 DATA_PATH) 옆에 두는 보조 파일 경로 (예: trades.ckpt.json, trades/QQQ.ckpt.json)"""
+    path = path or DATA_PATH
+    return path.with_name(f"{path.stem}.{name}")
+
+
+def _stat_key(st: os.stat_result) -> List[int]:
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _write_json_atomic(path: Path, data: Dict[str, Any]) -> None:
+    _write_bytes_atomic(path, json.dumps(data, separators=(",", ":")).encode())
+
+
+def _write_bytes_atomic(path: Path, data: bytes) -> None:
+    # 임시 파일에 쓰고 rename 해서, 중간에 죽어도 반쯤 쓰인 파일이 남지 않게 한다.
+    # 동시에 체크포인트를 저장하는 프로세스끼리 임시 파일이 겹치지 않도록 pid 를 붙인다.
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with tmp.open("wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _hash_prefix(f: BinaryIO, length: int, hasher: Any) -> str:
+    f.seek(0)
+    remaining = length
+    while remaining > 0:
+        chunk = f.read(min(remaining, 1 << 20))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        remaining -= len(chunk)
+    return hasher.hexdigest()
+
+
+def _tail_digest(f: BinaryIO, offset: int) -> str:
+    """[offset - CKPT_TAIL_CHECK, offset) 구간 sha1: 체크포인트 끝이 원장의 행 경계 그대로인지 싸게 확인한다"""
+    import hashlib
+
+    start = max(0, offset - CKPT_TAIL_CHECK)
+    f.seek(start)
+    return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+def _encode_state(positions: Dict[str, Dict[int, Lot]], realized: Dict[str, Decimal]) -> Dict[str, Any]:
+    return {
+        "positions": {
+            ticker: [[lot.id, str(lot.qty), str(lot.price), str(lot.stop)] for lot in lots.values()]
+            for ticker, lots in positions.items()
+        },
+        "realized": {ticker: str(pl) for ticker, pl in realized.items()},
+    }
+
+
+def _decode_state(data: Dict[str, Any]) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    positions = {
+        ticker: {
+            lot_id: Lot(lot_id, ticker, Decimal(qty), Decimal(price), Decimal(stop))
+            for lot_id, qty, price, stop in lots
+        }
+        for ticker, lots in data["positions"].items()
+    }
+    realized = {ticker: Decimal(pl) for ticker, pl in data["realized"].items()}
+    return positions, realized
+
+
+def _read_checkpoint_header(f: BinaryIO) -> Optional[Dict[str, Any]]:
+    try:
+        ckpt = json.loads(f.readline())
+    except ValueError:
+        return None
+    if not isinstance(ckpt, dict) or ckpt.get("version") != CHECKPOINT_VERSION:
+        return None
+    return ckpt
+
+
+def load_checkpoint(path: Optional[Path] = None) -> Optional[Dict[str, Any]]:
+    """헤더 + 전체 상태(_encode_state 형식의 positions/realized)"""
+    try:
+        with _sidecar_path("ckpt.json", path).open("rb") as f:
+            ckpt = _read_checkpoint_header(f)
+            if ckpt is None:
+                return None
+            lines = [json.loads(line) for line in f]
+    except (OSError, ValueError):
+        return None
+    if len(lines) != len(ckpt["tickers"]):
+        return None  # 본문이 잘렸다
+    slices = dict(zip(ckpt["tickers"], lines))
+    ckpt["positions"] = {ticker: lots for ticker, (lots, _) in slices.items() if lots is not None}
+    ckpt["realized"] = {ticker: slices[ticker][1] for ticker in ckpt["realized"]}
+    return ckpt
+
+
+def save_checkpoint(offset: int, last_id: int, digest: str, tail: str, st: os.stat_result,
+                    positions: Dict[str, Dict[int, Lot]], realized: Dict[str, Decimal],
+                    path: Optional[Path] = None, baseline: int = 0) -> None:
+    state = _encode_state(positions, realized)
+    lines = []
+    spans = {}
+    pos = 0
+    for ticker in dict.fromkeys([*state["positions"], *state["realized"]]):
+        line = json.dumps([state["positions"].get(ticker), state["realized"].get(ticker)],
+                          separators=(",", ":")).encode() + b"\n"
+        spans[ticker] = [pos, len(line)]
+        pos += len(line)
+        lines.append(line)
+    header = {
+        "version": CHECKPOINT_VERSION,
+        "offset": offset,
+        "last_id": last_id,
+        "digest": digest,
+        "tail": tail,
+        "stat": _stat_key(st),
+        "baseline": baseline,
+        "tickers": spans,
+        "realized": list(state["realized"]),
+    }
+    lines.insert(0, json.dumps(header, separators=(",", ":")).encode() + b"\n")
+    _write_bytes_atomic(_sidecar_path("ckpt.json", path), b"".join(lines))
+
+
+"""
+컴팩션 베이스라인: `compact` 가 완전히 청산된 lot 의 행을 trades.archive.csv 로 옮기고,
+그 행들이 만든 결과(티커 순서, 실현 손익, 마지막 id)를 trades.baseline.json 에 남긴다.
+전체 리플레이는 빈 상태가 아니라 베이스라인에서 출발해 남은 원장(열린 lot 의 행)만 읽는다.
+체크포인트/메타와 달리 원장의 일부이므로 지우면 안 된다.
+
+  {"version": 1, "generation": G, "last_id": N, "tickers": ["QQQ", ...], "realized": {"QQQ": "12.5"},
+   "open_lots": [3, 7], "archive": {"rows": R, "bytes": B, "sha1": "..."}, "active_sha1": "..."}
+
+- generation: 컴팩션 횟수. 체크포인트는 자기가 출발한 세대가 아니면 버려진다
+- archive: 아카이브 [0, bytes) 구간의 행 수와 sha1 (compact --verify 가 대조한다)
+- active_sha1: 같은 컴팩션이 써 넣은 원장의 sha1 (중단된 컴팩션 복구용)
+"""
+BASELINE_VERSION = 1
+
+
+def _archive_path(path: Optional[Path] = None) -> Path:
+    """원장 파일 옆의 아카이브 세그먼트 (예: trades.archive.csv, trades/QQQ.archive.csv)"""
+    path = path or DATA_PATH
+    return path.with_name(f"{path.stem}.archive{path.suffix}")
+
+
+def _file_sha1(path: Path, length: Optional[int] = None) -> str:
+    import hashlib
+
+    with path.open("rb") as f:
+        return _hash_prefix(f, os.fstat(f.fileno()).st_size if length is None else length, hashlib.sha1())
+
+
+def _finish_compaction(path: Path) -> None:
+    """
+    컴팩션은 새 베이스라인을 baseline.json.next 로 쓰고 → 원장을 교체하고 → .next 를 제자리로 옮긴다.
+    .next 가 남아 있으면 중간에 죽은 것이므로, 원장이 이미 교체됐는지(sha1)로 마무리하거나 버린다.
+    """
+    pending = _sidecar_path("baseline.json.next", path)
+    if not pending.exists():
+        return
+    with pending.open() as f:
+        baseline = json.load(f)
+    if path.exists() and _file_sha1(path) == baseline["active_sha1"]:
+        os.replace(pending, _sidecar_path("baseline.json", path))
+    else:
+        pending.unlink()
+
+
+def load_baseline(path: Optional[Path] = None) -> Optional[Dict[str, Any]]:
+    path = path or DATA_PATH
+    _finish_compaction(path)
+    try:
+        with _sidecar_path("baseline.json", path).open() as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        return None
+    if baseline.get("version") != BASELINE_VERSION:
+        raise ValueError(f"unsupported compaction baseline version: {baseline.get('version')}")
+    return baseline
+
+
+def _baseline_state(baseline: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal], int]:
+    """베이스라인 → 리플레이 시작 상태 (열린 lot 은 원장에 남아 있으므로 티커 자리만 만든다)"""
+    if not baseline:
+        return {}, {}, 0
+    positions: Dict[str, Dict[int, Lot]] = {ticker: {} for ticker in baseline["tickers"]}
+    realized = {ticker: Decimal(baseline["realized"].get(ticker, "0")) for ticker in baseline["tickers"]}
+    return positions, realized, baseline["last_id"]
+
+
+# 프로세스 안에서 유지하는 리플레이 상태. serve/shell 처럼 한 프로세스가 여러 명령을 처리할 때
+# 명령마다 체크포인트 JSON 을 다시 읽지 않고, 새로 붙은 행만 반영한다.
+# 원장 파일(단일 CSV 또는 샤드)마다 하나씩 둔다.
+# trusted: 이 프로세스가 직접 행을 덧붙인 뒤의 stat → 그 stat 이면 앞부분 해시 검증을 생략한다.
+_STATE: Dict[Path, Dict[str, Any]] = {}
+# 티커 하나만 리플레이한 결과 {(원장 파일, 티커): (stat, positions, realized)}.
+# 쓰기 명령은 잠금 밖(낙관적 검증)과 잠금 안에서 같은 티커를 두 번 읽는다.
+_TICKER_STATE: Dict[Tuple[Path, str], Tuple[List[int], Dict[str, Dict[int, Lot]], Dict[str, Decimal]]] = {}
+# 체크포인트 뒤에 붙은 꼬리가 이 크기(바이트) 이하면 체크포인트 + 꼬리의 티커 행 리플레이가 티커 스캔보다 싸다
+CKPT_TAIL_MAX = 1 << 20
+# 티커 하나만 읽을 때 체크포인트 끝 직전 이만큼(바이트)을 해시해 원장이 그대로인지 본다 (앞부분 전체 해시 대신)
+CKPT_TAIL_CHECK = 1 << 12
+
+
+def load_portfolio(ticker: Optional[str] = None) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """
+    체크포인트 + 꼬리 행 리플레이로 build_portfolio(load_rows()) 와 같은 결과를 만든다.
+    CSV 가 체크포인트 이후로 안 바뀌었으면 파싱 없이 바로 반환한다.
+    ticker 를 주면 그 티커만 담은 결과일 수 있다: 샤드 레이아웃은 그 샤드만, 단일 CSV 는 _replay_ticker.
+    (SQLite 는 ticker 와 관계없이 전체를 리플레이한다)
+    """
+    return _backend().load_portfolio(ticker)
+
+
+def load_lot(ticker: str, lot_id: int) -> Dict[str, Dict[int, Lot]]:
+    """
+    trim/close/stop/split 용: ticker 의 lot 하나만 검증하면 되므로 그 lot 을 담은 positions 를 돌려준다.
+    SQLite 는 그 lot 의 행만 인덱스로 골라 리플레이하고, 그 밖의 레이아웃은 load_portfolio(ticker) 와 같다.
+    """
+    return _backend().load_lot(ticker, lot_id)
+
+
+def lot_history(lot_id: int) -> List[TradeRow]:
+    """
+    history 용: lot_id 의 행 + 그 lot 을 대상으로 한 행(매도/스탑/분할)을 id 순으로 돌려준다.
+    전체 리플레이 없이 lot 인덱스(SQLite 는 target_id 인덱스)로 그 행들만 읽는다.
+    컴팩션된 원장은 아카이브에서도 찾는다.
+    """
+    return _backend().lot_history(lot_id)
+
+
+def _replay_ticker(path: Path, ticker: str) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """
+    trim/close/stop/split 처럼 티커 하나만 필요할 때.
+    체크포인트가 파일 끝 근처까지 덮고 있으면 체크포인트의 그 티커 몫만 풀고 꼬리에서 그 티커 행만 이어간다
+    (전체 상태를 Decimal 로 풀거나 체크포인트를 다시 쓰지 않는다 → 열린 lot 이 많아도 쓰기 비용이 일정하다).
+    그렇지 않으면(체크포인트 없음, 컴팩션/마이그레이션 직후, 긴 꼬리) 티커 인덱스로 그 티커의 행만
+    읽어 리플레이한다 → 다른 티커의 행은 읽지도, Decimal 로 바꾸지도 않는다.
+    (인덱스가 없으면 파일을 한 번 훑되 다른 티커 행은 Decimal 변환 전에 버린다)
+    """
+    key = _stat_key(os.stat(path))
+    state = _STATE.get(path)
+    if state and key in (state["stat"], state["trusted"]):
+        return _replay_file(path)  # serve/shell: 메모리 상태에서 새 행만 이어간다
+    cached = _TICKER_STATE.get((path, ticker))
+    if cached and cached[0] == key:
+        return cached[1], cached[2]
+
+    baseline = load_baseline(path)
+    generation = baseline["generation"] if baseline else 0
+    start = _checkpoint_slice(path, ticker, key[0], generation)
+    if start:
+        offset, positions, realized = start
+        header = read_header(path)
+        with path.open("rb") as f:
+            f.seek(offset)
+            rows = parse_rows((line.decode("utf-8") for line in f), header, ticker=ticker)
+            positions, realized = build_portfolio(rows, positions, realized)
+    else:
+        # 컴팩션된 파일이면 그 티커의 베이스라인(실현 손익)에서 출발한다
+        base_positions, base_realized, _ = _baseline_state(baseline)
+        positions = {ticker: base_positions[ticker]} if ticker in base_positions else {}
+        realized = {ticker: base_realized[ticker]} if ticker in base_realized else {}
+        if _index_path(path).exists():
+            positions, realized = build_portfolio(indexed_rows(path, ticker=ticker), positions, realized)
+        else:
+            # 인덱스를 처음 만드는 비용은 전체 리플레이보다 크다 → 여기서는 만들지 않고 한 번 훑으며 거른다
+            with path.open(newline="") as f:
+                positions, realized = build_portfolio(parse_rows(f, ticker=ticker), positions, realized)
+    _TICKER_STATE[(path, ticker)] = (key, positions, realized)
+    return positions, realized
+
+
+def _checkpoint_slice(path: Path, ticker: str, size: int,
+                      generation: int) -> Optional[Tuple[int, Dict[str, Dict[int, Lot]], Dict[str, Decimal]]]:
+    """
+    _replay_ticker 용: 체크포인트가 쓸 만하면 (offset, 그 티커의 positions, realized).
+    체크포인트의 헤더와 그 티커 줄만 읽고, 원장은 inode 와 체크포인트 끝 직전 CKPT_TAIL_CHECK 바이트의
+    해시로만 확인한다 (append-only 원장이므로 그 앞은 바뀌지 않았다고 본다) → 원장·체크포인트 크기와 무관하다.
+    꼬리가 CKPT_TAIL_MAX 보다 길면 None (티커 스캔이 싸다).
+    """
+    try:
+        with _sidecar_path("ckpt.json", path).open("rb") as ckpt_file:
+            ckpt = _read_checkpoint_header(ckpt_file)
+            if (not ckpt or ckpt.get("baseline", 0) != generation
+                    or not 0 <= size - ckpt["offset"] <= CKPT_TAIL_MAX):
+                return None
+            span = ckpt["tickers"].get(ticker)
+            lots, pl = None, None
+            if span:
+                ckpt_file.seek(span[0], os.SEEK_CUR)
+                lots, pl = json.loads(ckpt_file.read(span[1]))
+        with path.open("rb") as f:
+            if os.fstat(f.fileno()).st_ino != ckpt["stat"][2] or _tail_digest(f, ckpt["offset"]) != ckpt["tail"]:
+                return None
+    except (OSError, ValueError):
+        return None
+    positions, realized = _decode_state({"positions": {ticker: lots} if lots is not None else {},
+                                         "realized": {ticker: pl} if pl is not None else {}})
+    return ckpt["offset"], positions, realized
+
+
+def _replay_file(path: Path) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """원장 파일 하나를 체크포인트/프로세스 상태에서 이어서 리플레이한다."""
+    state = _STATE.get(path, {})
+
+    with path.open("rb") as f:
+        st = os.fstat(f.fileno())
+        key = _stat_key(st)
+        if state.get("stat") == key:
+            return state["positions"], state["realized"]
+
+        trusted = state.get("trusted") == key
+        ckpt = None
+        if not trusted:
+            ckpt = load_checkpoint(path)
+            if ckpt and ckpt["stat"] == key:
+                positions, realized = _decode_state(ckpt)
+                _STATE[path] = {"stat": key, "trusted": None, "offset": ckpt["offset"],
+                                "last_id": ckpt["last_id"], "hasher": None,
+                                "baseline": ckpt.get("baseline", 0),
+                                "positions": positions, "realized": realized}
+                return positions, realized
+
+        # 여기부터는 실제로 행을 읽는다 (체크포인트가 맞으면 위에서 해시 모듈도 안 올린다)
+        import hashlib
+
+        hasher = hashlib.sha1()
+        offset = 0
+        last_id = 0
+        positions = {}
+        realized = {}
+
+        if trusted:
+            # 이 프로세스가 덧붙인 행만 늘었으므로 메모리 상태에서 바로 이어간다
+            offset, last_id = state["offset"], state["last_id"]
+            positions, realized = state["positions"], state["realized"]
+            generation = state["baseline"]
+            if state["hasher"] is not None:
+                hasher = state["hasher"].copy()
+            else:
+                _hash_prefix(f, offset, hasher)
+        else:
+            # 컴팩션 이후에는 베이스라인 세대가 바뀌므로 그 전 체크포인트는 쓰지 않는다
+            baseline = load_baseline(path)
+            generation = baseline["generation"] if baseline else 0
+            # 체크포인트 구간의 바이트가 그대로인지 해시로 확인 (파싱보다 훨씬 싸다)
+            if (ckpt and ckpt.get("baseline", 0) == generation and ckpt["offset"] <= st.st_size
+                    and _hash_prefix(f, ckpt["offset"], hasher) == ckpt["digest"]):
+                offset = ckpt["offset"]
+                last_id = ckpt["last_id"]
+                positions, realized = _decode_state(ckpt)
+            else:
+                hasher = hashlib.sha1()
+                if baseline:
+                    # 전체 리플레이는 0 이 아니라 컴팩션 베이스라인(청산 lot 들의 결과)에서 시작한다
+                    positions, realized, last_id = _baseline_state(baseline)
+        f.seek(offset)
+
+        ends_with_newline = True
+
+        def tail_lines() -> Iterator[str]:
+            nonlocal ends_with_newline
+            for raw in f:
+                hasher.update(raw)
+                ends_with_newline = raw.endswith(b"\n")
+                yield raw.decode("utf-8")
+
+        # offset 0 이면 첫 줄이 헤더, 아니면 헤더 없이 이어지는 행들 (스키마는 파일 헤더를 따름)
+        header = None if offset == 0 else read_header(path)
+        if ENGINE == "fixed":
+            reader = parse_rows(tail_lines(), header, number=str)
+            replay = build_portfolio_fixed
+        else:
+            reader = parse_rows(tail_lines(), header)
+            replay = build_portfolio
+
+        def tracked_rows() -> Iterator[TradeRow]:
+            nonlocal last_id
+            for r in reader:
+                if r.id > last_id:
+                    last_id = r.id
+                yield r
+
+        positions, realized = replay(tracked_rows(), positions, realized)
+
+        end = f.tell()
+        end_st = os.fstat(f.fileno())
+        tail = _tail_digest(f, end) if ends_with_newline and end == end_st.st_size else None
+
+    # 마지막 줄이 개행으로 끝나지 않으면(쓰기 도중) 행 경계가 아니므로 저장하지 않는다.
+    _STATE.pop(path, None)
+    if tail is not None:
+        save_checkpoint(end, last_id, hasher.hexdigest(), tail, end_st, positions, realized, path, generation)
+        # 같은 패스에서 구한 last_id 로 하이워터마크도 맞춰 둔다 → 이어지는 next_row_id() 는 O(1)
+        # (샤드는 manifest 가 전역 id 를 들고 있다)
+        if path == DATA_PATH:
+            meta = _load_meta()
+            if not meta or meta.get("stat") != _stat_key(end_st):
+                _save_meta(last_id, end_st)
+        _STATE[path] = {"stat": _stat_key(end_st), "trusted": None, "offset": end, "last_id": last_id,
+                        "hasher": hasher, "baseline": generation, "positions": positions, "realized": realized}
+    return positions, realized
+
+
+"""
+샤드 레이아웃 (선택): `convert --to sharded` 로 원장을 티커별 append-only 파일로 나눈다.
+
+  data/trades/manifest.json  {"version": 1, "last_id": N, "tickers": {"QQQ": "QQQ.csv", ...}}
+  data/trades/QQQ.csv        HEADER + QQQ 행만 (원래 순서 그대로)
+
+매도/스탑은 같은 티커의 lot 만 대상으로 하므로 티커별 리플레이를 합친 결과는
+단일 CSV 리플레이와 같다. 그래서 trim/stop/split 은 해당 티커 샤드만 읽고,
+status/report 는 샤드를 모두 읽어 합친다 (--jobs N 이면 프로세스 N 개로 병렬).
+id 는 manifest 의 last_id 하나로 전역 할당한다. 체크포인트는 샤드마다 따로 둔다.
+manifest 가 있으면 샤드 레이아웃, 없으면 지금처럼 trades.csv 하나다.
+"""
+SHARD_VERSION = 1
+
+
+def _shard_dir() -> Path:
+    return DATA_PATH.with_suffix("")
+
+
+def _manifest_path() -> Path:
+    return _shard_dir() / "manifest.json"
+
+
+def _load_manifest() -> Dict[str, Any]:
+    with _manifest_path().open() as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SHARD_VERSION:
+        raise ValueError(f"unsupported shard manifest version: {manifest.get('version')}")
+    return manifest
+
+
+def _shard_file_name(ticker: str, taken: Iterable[str]) -> str:
+    """티커 → 샤드 파일 이름. 파일 이름에 못 쓰는 글자는 바꾸고, 대소문자만 다른 충돌은 번호를 붙인다."""
+    base = "".join(c if c.isalnum() or c in "-_" else "_" for c in ticker) or "_"
+    used = {name.lower() for name in taken}
+    name, n = f"{base}.csv", 1
+    while name.lower() in used:
+        n += 1
+        name = f"{base}-{n}.csv"
+    return name
+
+
+def _replay_shard(path: str, engine: str, qty_digits: int, price_digits: int) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """병렬 리플레이 작업 프로세스용: 부모의 엔진 설정을 받아 샤드 하나를 리플레이한다."""
+    global ENGINE, QTY_DIGITS, PRICE_DIGITS
+    ENGINE, QTY_DIGITS, PRICE_DIGITS = engine, qty_digits, price_digits
+    return _replay_file(Path(path))
+
+
+def _load_sharded(ticker: Optional[str] = None) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    manifest = _load_manifest()
+    shard_dir = _shard_dir()
+    # manifest 순서 = 티커가 처음 나온 순서 = 단일 CSV 리플레이의 출력 순서
+    paths = [shard_dir / name for t, name in manifest["tickers"].items() if ticker is None or t == ticker]
+
+    if JOBS > 1 and len(paths) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(min(JOBS, len(paths))) as pool:
+            results = list(pool.map(_replay_shard, map(str, paths), [ENGINE] * len(paths),
+                                    [QTY_DIGITS] * len(paths), [PRICE_DIGITS] * len(paths)))
+    else:
+        results = [_replay_file(path) for path in paths]
+
+    positions: Dict[str, Dict[int, Lot]] = {}
+    realized: Dict[str, Decimal] = {}
+    for shard_positions, shard_realized in results:
+        positions.update(shard_positions)
+        realized.update(shard_realized)
+    return positions, realized
+
+
+def _append_sharded(rows: Iterable[Dict[str, str]]) -> None:
+    """행을 티커별 샤드에 나눠 쓴다. 새 티커는 샤드 파일을 만들고 manifest 에 등록한다."""
+    groups: Dict[str, List[Dict[str, str]]] = {}
+    for row in rows:
+        groups.setdefault(row["ticker"], []).append(row)
+    if not groups:
+        return
+
+    manifest = _load_manifest()
+    shard_dir = _shard_dir()
+    for ticker in groups:
+        if ticker not in manifest["tickers"]:
+            name = _shard_file_name(ticker, manifest["tickers"].values())
+            with (shard_dir / name).open("w", newline="") as f:
+                csv.writer(f).writerow(HEADER)
+            manifest["tickers"][ticker] = name
+    # 행보다 manifest 를 먼저 쓴다: 중간에 죽어도 id 는 건너뛸 뿐 두 번 쓰이지 않는다
+    manifest["last_id"] = max(manifest["last_id"], *(int(r["id"]) for g in groups.values() for r in g))
+    _write_json_atomic(_manifest_path(), manifest)
+    for ticker, group in groups.items():
+        _append_file(shard_dir / manifest["tickers"][ticker], group)
+
+
+def _merged_shard_rows() -> Iterator[Dict[str, str]]:
+    """모든 샤드의 행을 id 순으로 합쳐 흘려보낸다 (샤드 안의 순서는 그대로)."""
+    import contextlib
+    import heapq
+
+    manifest = _load_manifest()
+    with contextlib.ExitStack() as stack:
+        readers = [
+            csv.DictReader(stack.enter_context((_shard_dir() / name).open(newline="")))
+            for name in manifest["tickers"].values()
+        ]
+        yield from heapq.merge(*readers, key=lambda r: int(r["id"]))
+
+
+"""
+SQLite 레이아웃 (선택): `convert --to sqlite` 로 원장을 data/trades.db 의 trades 테이블로 옮긴다.
+수치는 Decimal 문자열(TEXT) 그대로 저장하고, ticker / target_id / date 에 인덱스를 둔다.
+WAL 모드라 리플레이(읽기)는 쓰는 프로세스를 막지 않는다.
+
+- trim/close/stop/split: 대상 lot 의 행(id = N 또는 target_id = N)만 인덱스로 골라 리플레이
+- status/report: checkpoint 테이블의 상태 + 그 뒤 id 의 행만 리플레이.
+  기존 행이 수정/삭제되거나 더 작은 id 가 끼어들면 트리거가 체크포인트를 지운다 → 전체 리플레이
+trades.db 가 있으면 SQLite 레이아웃이다. `convert --to csv` 로 되돌릴 수 있다.
+"""
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trades (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    qty TEXT NOT NULL,
+    price TEXT NOT NULL,
+    stop TEXT NOT NULL,
+    target_id INTEGER,
+    note TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkpoint (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    last_id INTEGER NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS trades_update AFTER UPDATE ON trades BEGIN DELETE FROM checkpoint; END;
+CREATE TRIGGER IF NOT EXISTS trades_delete AFTER DELETE ON trades BEGIN DELETE FROM checkpoint; END;
+CREATE TRIGGER IF NOT EXISTS trades_insert AFTER INSERT ON trades
+    WHEN NEW.id <= (SELECT last_id FROM checkpoint) BEGIN DELETE FROM checkpoint; END;
+"""
+# 대량 적재 뒤에 만드는 편이 빠르므로 스키마와 따로 둔다
+_SQLITE_INDEXES = """
+CREATE INDEX IF NOT EXISTS trades_ticker ON trades (ticker);
+CREATE INDEX IF NOT EXISTS trades_target ON trades (target_id);
+CREATE INDEX IF NOT EXISTS trades_date ON trades (date);
+"""
+_SQLITE_COLUMNS = "id, date, ticker, qty, price, stop, target_id, note"
+_SQLITE_INSERT = "INSERT INTO trades (" + _SQLITE_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+# 프로세스 안에서 재사용하는 연결 (serve/shell 은 명령마다 다시 열지 않는다)
+_DB: Dict[Path, Any] = {}
+
+
+def _db_path() -> Path:
+    return DATA_PATH.with_suffix(".db")
+
+
+def _db() -> Any:
+    path = _db_path()
+    conn = _DB.get(path)
+    if conn is None:
+        import sqlite3
+
+        conn = _DB[path] = sqlite3.connect(path)
+    return conn
+
+
+def _close_db() -> None:
+    for conn in _DB.values():
+        conn.close()
+    _DB.clear()
+
+
+def _sqlite_params(row: Dict[str, str]) -> Tuple[Any, ...]:
+    target = row["target_id"]
+    return (int(row["id"]), row["date"], row["ticker"], row["qty"], row["price"], row["stop"],
+            int(target) if target else None, row["note"])
+
+
+def _sqlite_trade_rows(cursor: Iterable[Tuple[Any, ...]]) -> Iterator[TradeRow]:
+    """SELECT 결과 → TradeRow. fixed 엔진은 parse_rows(number=str) 처럼 문자열 그대로 넘긴다"""
+    if ENGINE == "fixed":
+        return map(TradeRow._make, cursor)
+    return (TradeRow(i, d, t, Decimal(q), Decimal(p), Decimal(s), g, n) for i, d, t, q, p, s, g, n in cursor)
+
+
+def _sqlite_rows() -> Iterator[Dict[str, str]]:
+    """load_rows() 와 같은 모양(dict, 모든 값 문자열)으로 id 순 행을 흘려보낸다."""
+    for values in _db().execute(f"SELECT {_SQLITE_COLUMNS} FROM trades ORDER BY id"):
+        row = dict(zip(HEADER, map(str, values)))
+        if values[6] is None:
+            row["target_id"] = ""
+        yield row
+
+
+def _append_sqlite(rows: Iterable[Dict[str, str]]) -> None:
+    # 한 트랜잭션 = 한 번의 커밋(fsync). 같은 id 가 이미 있으면 IntegrityError 로 전부 취소된다
+    with _db() as conn:
+        conn.executemany(_SQLITE_INSERT, map(_sqlite_params, rows))
+
+
+def _load_sqlite() -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    conn = _db()
+    path = _db_path()
+    # data_version 은 다른 연결의 커밋, total_changes 는 이 연결의 변경을 센다 → 둘 다 같으면 그대로
+    version = (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+    state = _STATE.get(path, {})
+    if state.get("stat") == version:
+        return state["positions"], state["realized"]
+
+    ckpt = conn.execute("SELECT last_id, state FROM checkpoint").fetchone()
+    last_id = 0
+    positions: Dict[str, Dict[int, Lot]] = {}
+    realized: Dict[str, Decimal] = {}
+    if ckpt:
+        last_id = ckpt[0]
+        positions, realized = _decode_state(json.loads(ckpt[1]))
+    start = last_id
+
+    def tracked_rows() -> Iterator[TradeRow]:
+        nonlocal last_id
+        for r in _sqlite_trade_rows(conn.execute(
+                f"SELECT {_SQLITE_COLUMNS} FROM trades WHERE id > ? ORDER BY id", (start,))):
+            last_id = r.id
+            yield r
+
+    replay = build_portfolio_fixed if ENGINE == "fixed" else build_portfolio
+    positions, realized = replay(tracked_rows(), positions, realized)
+
+    if last_id != start:
+        import sqlite3
+
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO checkpoint (id, last_id, state) VALUES (0, ?, ?)",
+                             (last_id, json.dumps(_encode_state(positions, realized), separators=(",", ":"))))
+        except sqlite3.OperationalError:
+            pass  # 다른 프로세스가 쓰는 중 (잠김) → 체크포인트는 다음 실행에 맡긴다
+    _STATE[path] = {"stat": (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes),
+                    "positions": positions, "realized": realized}
+    return positions, realized
+
+
+def _load_sqlite_lot(ticker: str, lot_id: int) -> Optional[Lot]:
+    """lot 하나의 현재 상태: 그 lot 을 만든 행과 그 lot 을 대상으로 한 행만 id 순으로 리플레이한다."""
+    cursor = _db().execute(
+        f"SELECT {_SQLITE_COLUMNS} FROM trades WHERE id = ?1 AND ticker = ?2 "
+        f"UNION ALL SELECT {_SQLITE_COLUMNS} FROM trades WHERE target_id = ?1 AND ticker = ?2 AND id != ?1 "
+        f"ORDER BY id",
+        (lot_id, ticker),
+    )
+    positions, _ = build_portfolio(
+        TradeRow(i, d, t, Decimal(q), Decimal(p), Decimal(s), g, n) for i, d, t, q, p, s, g, n in cursor
+    )
+    return positions.get(ticker, {}).get(lot_id)
+
+
+"""
+저장소 백엔드: 레이아웃마다 객체 하나 (단일 CSV / 티커별 샤드 / SQLite).
+load_rows, next_row_id, append_rows, load_portfolio, load_lot, lot_history, load_portfolio_as_of 는
+_backend() 가 고른 객체에 넘기기만 한다 → 새 레이아웃은 클래스 하나와 _backend() 한 줄이면 된다.
+"""
+class _CsvLedger:
+    """data/trades.csv 하나. 체크포인트·메타·인덱스·as-of 사이드카는 원장 파일마다 둔다"""
+
+    name = "csv"
+
+    def ensure(self) -> None:
+        DATA_PATH.parent.mkdir(exist_ok=True)
+        if not DATA_PATH.exists():
+            with DATA_PATH.open("w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(HEADER)
+
+    def files(self) -> List[Path]:
+        """원장 파일들 (컴팩션·as-of·history 가 파일마다 처리한다)"""
+        self.ensure()
+        return [DATA_PATH]
+
+    def load_rows(self) -> Iterator[Dict[str, str]]:
+        self.ensure()
+        with DATA_PATH.open(newline="") as f:
+            reader = csv.DictReader(f) # 첫 줄을 헤더로 인식하고, 이후 각 줄을 dict로 반환하는 이터레이터 객체
+            yield from reader
+
+    def next_row_id(self) -> int:
+        meta = _load_meta()
+        if meta and meta.get("stat") == _stat_key(DATA_PATH.stat()):
+            return meta["last_id"] + 1
+        # 컴팩션이 마지막 행들을 아카이브로 옮겼을 수 있으므로 베이스라인의 last_id 보다 작아지지 않게
+        baseline = load_baseline()
+        return max(_tail_row_id(), baseline["last_id"] if baseline else 0) + 1
+
+    def append_rows(self, rows: Iterable[Dict[str, str]]) -> None:
+        written = _append_file(DATA_PATH, rows)
+        if written:
+            # 행 추가와 같은 단계에서 하이워터마크도 갱신 (새 stat 기준)
+            _save_meta(*written)
+
+    def load_portfolio(self, ticker: Optional[str] = None) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+        self.ensure()
+        if ticker is not None:
+            return _replay_ticker(DATA_PATH, ticker)
+        return _replay_file(DATA_PATH)
+
+    def load_lot(self, ticker: str, lot_id: int) -> Dict[str, Dict[int, Lot]]:
+        positions, _ = self.load_portfolio(ticker)
+        return positions
+
+    def lot_history(self, lot_id: int) -> List[TradeRow]:
+        import heapq
+
+        sources = []
+        for path in self.files():
+            sources.append(indexed_rows(path, lot=lot_id))
+            if _archive_path(path).exists():
+                sources.append(indexed_rows(_archive_path(path), lot=lot_id))
+        return list(heapq.merge(*sources, key=lambda r: r.id))
+
+    def as_of(self, as_of: str) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+        positions: Dict[str, Dict[int, Lot]] = {}
+        realized: Dict[str, Decimal] = {}
+        for path in self.files():
+            file_positions, file_realized = _as_of_file(path, as_of)
+            positions.update(file_positions)
+            realized.update(file_realized)
+        return positions, realized
+
+
+class _ShardedLedger(_CsvLedger):
+    """data/trades/<티커>.csv + manifest.json. 파일 단위 처리(history, as-of)는 단일 CSV 와 같다"""
+
+    name = "sharded"
+
+    def ensure(self) -> None:
+        pass  # trades.csv 를 만들지 않는다
+
+    def files(self) -> List[Path]:
+        return [_shard_dir() / name for name in _load_manifest()["tickers"].values()]
+
+    def load_rows(self) -> Iterator[Dict[str, str]]:
+        return _merged_shard_rows()
+
+    def next_row_id(self) -> int:
+        return _load_manifest()["last_id"] + 1
+
+    def append_rows(self, rows: Iterable[Dict[str, str]]) -> None:
+        _append_sharded(rows)
+
+    def load_portfolio(self, ticker: Optional[str] = None) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+        return _load_sharded(ticker)
+
+
+class _SqliteLedger:
+    """data/trades.db 의 trades 테이블. 행 선택은 SQL 인덱스로 한다"""
+
+    name = "sqlite"
+
+    def ensure(self) -> None:
+        pass
+
+    def files(self) -> List[Path]:
+        return []  # 파일 단위 사이드카(컴팩션 등)가 없다
+
+    def load_rows(self) -> Iterator[Dict[str, str]]:
+        return _sqlite_rows()
+
+    def next_row_id(self) -> int:
+        return (_db().execute("SELECT max(id) FROM trades").fetchone()[0] or 0) + 1
+
+    def append_rows(self, rows: Iterable[Dict[str, str]]) -> None:
+        _append_sqlite(rows)
+
+    def load_portfolio(self, ticker: Optional[str] = None) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+        return _load_sqlite()
+
+    def load_lot(self, ticker: str, lot_id: int) -> Dict[str, Dict[int, Lot]]:
+        lot = _load_sqlite_lot(ticker, lot_id)
+        return {ticker: {lot_id: lot}} if lot else {}
+
+    def lot_history(self, lot_id: int) -> List[TradeRow]:
+        cursor = _db().execute(
+            f"SELECT {_SQLITE_COLUMNS} FROM trades WHERE id = ?1 "
+            f"UNION ALL SELECT {_SQLITE_COLUMNS} FROM trades WHERE target_id = ?1 AND id != ?1 ORDER BY id",
+            (lot_id,),
+        )
+        return [TradeRow(i, d, t, Decimal(q), Decimal(p), Decimal(s), g, n) for i, d, t, q, p, s, g, n in cursor]
+
+    def as_of(self, as_of: str) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+        cursor = _db().execute(f"SELECT {_SQLITE_COLUMNS} FROM trades WHERE date <= ? ORDER BY id", (as_of,))
+        return build_portfolio(TradeRow(i, d, t, Decimal(q), Decimal(p), Decimal(s), g, n)
+                               for i, d, t, q, p, s, g, n in cursor)
+
+
+_CSV_LEDGER, _SHARDED_LEDGER, _SQLITE_LEDGER = _CsvLedger(), _ShardedLedger(), _SqliteLedger()
+
+
+def _backend() -> Any:
+    """지금 레이아웃의 백엔드: manifest 가 있으면 샤드, trades.db 가 있으면 SQLite, 아니면 단일 CSV"""
+    if _manifest_path().exists():
+        return _SHARDED_LEDGER
+    if _db_path().exists():
+        return _SQLITE_LEDGER
+    return _CSV_LEDGER
+
+
+
+"""
+기준일(--as-of) 조회: "그날까지의 날짜를 가진 행"만 원장 순서대로 리플레이한 포트폴리오.
+원장 파일마다 trades.asof.json 에 월별 스냅숏 목록을, trades.asof.states 에 스냅숏 상태(JSON 한 줄씩)를 둔다.
+
+  {"version": 1, "stat": [...], "offset": N, "digest": "...", "monotonic": true, "max_date": "2024-03-29",
+   "snapshots": [{"month": "2024-03", "offset": 1234, "span": [pos, len]}, ...],
+   "end": {"positions": ..., "realized": ...}}
+
+- snapshots: 그 달의 첫 행 직전(offset) 상태. 조회는 기준일이 속한 달(또는 그 전) 스냅숏에서
+  시작해 기준일보다 늦은 첫 행에서 멈춘다
+- 상태는 .states 의 span 위치만 읽는다 → 조회 비용이 원장 길이(스냅숏 수)에 비례하지 않는다.
+  .states 는 덧붙이기만 하고, 읽은 줄의 month/offset 이 안 맞으면 스냅숏 없이 전체를 훑는다
+- offset/digest/stat/end: 체크포인트와 같은 방식으로 검증하고, 뒤에 붙은 행만 읽어 인덱스를 늘린다
+- monotonic: 날짜가 줄어든 행(과거 날짜로 기록한 행)이 한 번이라도 있으면 false →
+  스냅숏을 쓰지 않고 전체를 훑으며 날짜로 거른다
+샤드는 샤드마다 조회해 합치고, SQLite 는 date 인덱스로 거른다.
+컴팩션된 파일은 아카이브 + 원장 전체 이력을 날짜로 걸러 리플레이한다.
+"""
+ASOF_VERSION = 1
+
+
+def _as_of_date(text: str) -> str:
+    """argparse type: YYYY-MM-DD 검증"""
+    import argparse
+    from datetime import date
+
+    try:
+        return date.fromisoformat(text).isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date '{text}' (use YYYY-MM-DD)") from None
+
+
+def load_portfolio_as_of(as_of: str) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """as_of(YYYY-MM-DD) 이하 날짜의 행만 원장 순서대로 리플레이한 결과 (Decimal 엔진)"""
+    return _backend().as_of(as_of)
+
+
+def _as_of_file(path: Path, as_of: str) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    import itertools
+
+    if load_baseline(path):
+        import heapq
+
+        # 컴팩션된 행은 아카이브에 있다 → 전체 이력(id 순)을 날짜로 거른다
+        with _archive_path(path).open("rb") as arc, path.open("rb") as f:
+            history = heapq.merge(parse_rows(line.decode("utf-8") for line in arc),
+                                  parse_rows(line.decode("utf-8") for line in f), key=lambda r: r.id)
+            return build_portfolio(r for r in history if r.date <= as_of)
+
+    index = _update_asof_index(path)
+    with path.open("rb") as f:
+        lines = (line.decode("utf-8") for line in f)
+        if not index["monotonic"]:
+            return build_portfolio(r for r in parse_rows(lines) if r.date <= as_of)
+        snapshot = None
+        for snap in index["snapshots"]:  # 월 순서
+            if snap["month"] > as_of[:7]:
+                break
+            snapshot = snap
+        if snapshot is None:
+            return {}, {}  # 기준일이 첫 행보다 이르다
+        state = snapshot.get("state") or _read_asof_state(path, snapshot)
+        if state is None:
+            return build_portfolio(r for r in parse_rows(lines) if r.date <= as_of)
+        header = read_header(path)
+        f.seek(snapshot["offset"])
+        positions, realized = _decode_state(state)
+        rows = itertools.takewhile(lambda r: r.date <= as_of, parse_rows(lines, header))
+        return build_portfolio(rows, positions, realized)
+
+
+def _read_asof_state(path: Path, snapshot: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """.states 에서 스냅숏 한 줄만 읽는다. 어긋났으면(동시 갱신 등) None"""
+    pos, length = snapshot["span"]
+    try:
+        with _sidecar_path("asof.states", path).open("rb") as f:
+            f.seek(pos)
+            state = json.loads(f.read(length))
+    except (OSError, ValueError):
+        return None
+    if state.get("month") != snapshot["month"] or state.get("offset") != snapshot["offset"]:
+        return None
+    return state
+
+
+def _update_asof_index(path: Path) -> Dict[str, Any]:
+    """월별 스냅숏 인덱스를 최신으로 맞춰 돌려준다 (바뀐 것이 없으면 읽기만 한다)."""
+    import hashlib
+
+    index_path = _sidecar_path("asof.json", path)
+    try:
+        with index_path.open() as fp:
+            index = json.load(fp)
+        if index.get("version") != ASOF_VERSION:
+            index = None
+    except (OSError, ValueError):
+        index = None
+
+    with path.open("rb") as f:
+        st = os.fstat(f.fileno())
+        if index and index["stat"] == _stat_key(st):
+            return index
+        hasher = hashlib.sha1()
+        rebuilt = False
+        if not (index and index["offset"] <= st.st_size and _hash_prefix(f, index["offset"], hasher) == index["digest"]):
+            hasher = hashlib.sha1()
+            rebuilt = True
+            index = {"version": ASOF_VERSION, "offset": 0, "monotonic": True, "max_date": "", "snapshots": [],
+                     "end": {"positions": {}, "realized": {}}}
+        f.seek(index["offset"])
+        offset = index["offset"]
+        header = None if offset == 0 else read_header(path)
+        line_start = offset
+        ends_with_newline = True
+
+        def tail_lines() -> Iterator[str]:
+            nonlocal offset, line_start, ends_with_newline
+            for raw in f:
+                hasher.update(raw)
+                line_start = offset
+                offset += len(raw)
+                ends_with_newline = raw.endswith(b"\n")
+                yield raw.decode("utf-8")
+
+        positions, realized = _decode_state(index["end"])
+
+        def snapshot_rows() -> Iterator[TradeRow]:
+            # build_portfolio 가 다음 행을 달라고 할 때는 앞 행까지 반영된 상태다 → 달이 바뀌면 그 상태를 저장
+            for r in parse_rows(tail_lines(), header):
+                if index["monotonic"]:
+                    if r.date < index["max_date"]:
+                        index["monotonic"] = False
+                        index["snapshots"] = []  # 날짜가 거꾸로 간 원장에서는 쓸 수 없다
+                    elif r.date[:7] > index["max_date"][:7]:
+                        # line_start: 방금 csv.reader 가 읽은 줄(= 이 행)의 시작 위치
+                        month = r.date[:7]
+                        index["snapshots"].append({"month": month, "offset": line_start, "state": {
+                            "month": month, "offset": line_start, **_encode_state(positions, realized)}})
+                    index["max_date"] = max(index["max_date"], r.date)
+                yield r
+
+        positions, realized = build_portfolio(snapshot_rows(), positions, realized)
+        end_st = os.fstat(f.fileno())
+
+    if ends_with_newline and offset == end_st.st_size:
+        _save_asof_states(path, index["snapshots"], rebuilt)
+        index.update(stat=_stat_key(end_st), offset=offset, digest=hasher.hexdigest(),
+                     end=_encode_state(positions, realized))
+        _write_json_atomic(index_path, index)
+    return index
+
+
+def _save_asof_states(path: Path, snapshots: List[Dict[str, Any]], rebuilt: bool) -> None:
+    """새 스냅숏의 상태를 .states 에 한 번의 write 로 붙이고, 인덱스에는 위치(span)만 남긴다"""
+    fresh = [snap for snap in snapshots if "state" in snap]
+    if not fresh and not rebuilt:
+        return
+    states_path = _sidecar_path("asof.states", path)
+    # 인덱스를 처음부터 다시 만들 때는 옛 상태를 버린다 (남은 span 은 읽을 때 month/offset 검사에서 걸러진다)
+    with states_path.open("wb" if rebuilt else "ab") as f:
+        pos = f.seek(0, os.SEEK_END)
+        chunks = []
+        for snap in fresh:
+            line = json.dumps(snap.pop("state"), separators=(",", ":")).encode() + b"\n"
+            snap["span"] = [pos, len(line)]
+            pos += len(line)
+            chunks.append(line)
+        f.write(b"".join(chunks))
+
+
+"""
+보조 인덱스: 원장 파일마다 trades.idx.db (표준 sqlite3) 에 행의 바이트 위치를 둔다.
+
+  tickers(ticker, offset)        티커 → 그 티커 행들의 시작 위치
+  dates(date, start, finish)     날짜 → 같은 날짜 행이 이어진 구간 [start, finish)
+  lots(lot, offset)              lot id → 그 id 의 행 + 그 lot 을 대상으로 한 행들의 위치
+  meta                           stat / 인덱스한 끝(offset) / digest 로 검증된 앞부분(verified)
+
+읽는 쪽(indexed_rows)은 위치만 찾아 seek 하고 그 행들만 파싱한다.
+- append_rows 는 인덱스가 쓰기 직전 파일과 맞으면(stat) 새 행만 넣는다. 인덱스가 없으면 만들지 않는다
+- 그 밖의 변경(손으로 고침, 컴팩션, 마이그레이션)은 읽을 때 stat 으로 알아채고, digest 가 맞는
+  앞부분 뒤만 한 번의 스트리밍 패스로 다시 넣는다. 맞지 않거나 인덱스가 없으면 처음부터 만든다
+인덱스는 언제 지워도 되는 캐시라서 sqlite 의 fsync 는 끈다 (깨졌으면 지우고 다시 만든다).
+"""
+INDEX_VERSION = 1
+INDEX_BATCH = 50_000  # 스트리밍 패스에서 한 번에 넣는 행 수
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    k INTEGER PRIMARY KEY CHECK (k = 0), version INTEGER, stat TEXT, offset INTEGER,
+    verified INTEGER, digest TEXT, run_date TEXT, run_start INTEGER
+);
+CREATE TABLE IF NOT EXISTS tickers (ticker TEXT, offset INTEGER, PRIMARY KEY (ticker, offset)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dates (date TEXT, start INTEGER, finish INTEGER, PRIMARY KEY (date, start)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lots (lot INTEGER, offset INTEGER, PRIMARY KEY (lot, offset)) WITHOUT ROWID;
+"""
+
+
+def _index_path(path: Path) -> Path:
+    return _sidecar_path("idx.db", path)
+
+
+def _index_conn(path: Path) -> Any:
+    """인덱스 연결 (프로세스 안에서 재사용). 트랜잭션은 BEGIN IMMEDIATE 로 직접 연다."""
+    index_path = _index_path(path)
+    conn = _DB.get(index_path)
+    if conn is None:
+        import sqlite3
+
+        conn = sqlite3.connect(index_path, isolation_level=None, timeout=30)
+        try:
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.executescript(_INDEX_SCHEMA)
+        except sqlite3.DatabaseError:
+            # 깨진 캐시 → 지우고 새로 만든다
+            conn.close()
+            index_path.unlink()
+            conn = sqlite3.connect(index_path, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.executescript(_INDEX_SCHEMA)
+        _DB[index_path] = conn
+    return conn
+
+
+def _index_meta(conn: Any) -> Optional[Tuple[Any, ...]]:
+    """(stat, offset, verified, digest, run_date, run_start) — 버전이 다르면 None"""
+    meta = conn.execute("SELECT version, stat, offset, verified, digest, run_date, run_start FROM meta").fetchone()
+    if not meta or meta[0] != INDEX_VERSION:
+        return None
+    return meta[1:]
+
+
+def _index_insert(conn: Any, entries: List[Tuple[int, int, TradeRow]],
+                  run: Tuple[Optional[str], int, int]) -> Tuple[Optional[str], int, int]:
+    """
+    (행 시작, 행 끝, TradeRow) 들을 세 테이블에 넣는다.
+    run: 마지막 날짜 구간 (date, start, finish) — 같은 날짜 행이 바로 이어지면 구간을 늘린다.
+    """
+    tickers = []
+    lots = []
+    run_date, run_start, run_finish = run
+    runs = []
+    for start, finish, r in entries:
+        tickers.append((r.ticker, start))
+        lots.append((r.id, start))
+        if r.target is not None and r.target != r.id:
+            lots.append((r.target, start))
+        if r.date == run_date and start == run_finish:
+            run_finish = finish
+        else:
+            if run_date is not None:
+                runs.append((run_date, run_start, run_finish))
+            run_date, run_start, run_finish = r.date, start, finish
+    if run_date is not None:
+        runs.append((run_date, run_start, run_finish))
+    conn.executemany("INSERT OR IGNORE INTO tickers VALUES (?, ?)", tickers)
+    conn.executemany("INSERT OR IGNORE INTO lots VALUES (?, ?)", lots)
+    conn.executemany("INSERT OR REPLACE INTO dates VALUES (?, ?, ?)", runs)
+    return run_date, run_start, run_finish
+
+
+def _refresh_index(conn: Any, path: Path) -> None:
+    """인덱스를 원장 파일에 맞춘다 (맞으면 meta 한 줄만 읽는다)."""
+    with path.open("rb") as f:
+        key = json.dumps(_stat_key(os.fstat(f.fileno())))
+        meta = _index_meta(conn)
+        if meta and meta[0] == key:
+            return
+
+        import hashlib
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            meta = _index_meta(conn)  # 잠금을 기다리는 동안 다른 프로세스가 맞춰 놨을 수 있다
+            if meta and meta[0] == key:
+                conn.execute("COMMIT")
+                return
+            size = os.fstat(f.fileno()).st_size
+            hasher = hashlib.sha1()
+            if meta and meta[2] <= size and _hash_prefix(f, meta[2], hasher) == meta[3]:
+                # 검증된 앞부분은 그대로 두고, 그 뒤(덧붙이며 넣은 행 포함)만 다시 넣는다
+                start = meta[2]
+                conn.execute("DELETE FROM tickers WHERE offset >= ?", (start,))
+                conn.execute("DELETE FROM lots WHERE offset >= ?", (start,))
+                conn.execute("DELETE FROM dates WHERE start >= ?", (start,))
+                conn.execute("UPDATE dates SET finish = ? WHERE finish > ?", (start, start))
+                run = conn.execute("SELECT date, start, finish FROM dates WHERE finish = ?", (start,)).fetchone()
+                run = run or (None, 0, 0)
+            else:
+                hasher = hashlib.sha1()
+                start = 0
+                run = (None, 0, 0)
+                for table in ("tickers", "lots", "dates"):
+                    conn.execute(f"DELETE FROM {table}")
+
+            f.seek(start)
+            offset = start
+            if start == 0:
+                raw = f.readline()
+                hasher.update(raw)
+                offset = len(raw)
+                header = next(csv.reader([raw.decode("utf-8")]), HEADER)
+            else:
+                header = read_header(path)
+
+            def complete_lines() -> Iterator[str]:
+                # 개행으로 끝나지 않은 마지막 줄(쓰는 중)은 인덱스하지 않는다
+                nonlocal offset
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        return
+                    hasher.update(raw)
+                    offset += len(raw)
+                    yield raw.decode("utf-8")
+
+            entries = []
+            row_start = offset
+            for r in parse_rows(complete_lines(), header, number=str):
+                # csv.reader 는 행에 필요한 줄만 당겨 가므로, 지금 offset 이 이 행의 끝이다
+                entries.append((row_start, offset, r))
+                row_start = offset
+                if len(entries) >= INDEX_BATCH:
+                    run = _index_insert(conn, entries, run)
+                    entries = []
+            run = _index_insert(conn, entries, run)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (0, ?, ?, ?, ?, ?, ?, ?)",
+                         (INDEX_VERSION, key, offset, offset, hasher.hexdigest(), run[0], run[1]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def _index_append(path: Path, before: List[int], after: os.stat_result,
+                  entries: List[Tuple[int, int, TradeRow]]) -> None:
+    """append_rows 직후: 인덱스가 있고 쓰기 직전 파일과 맞았으면 방금 쓴 행만 넣는다."""
+    if not _index_path(path).exists():
+        return
+    import sqlite3
+
+    try:
+        conn = _index_conn(path)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            meta = _index_meta(conn)
+            if meta and meta[0] == json.dumps(before) and meta[1] == entries[0][0]:
+                run_date, run_start = meta[4], meta[5]
+                run = _index_insert(conn, entries, (run_date, run_start, meta[1]))
+                # verified/digest 는 그대로: 덧붙인 구간은 다음 리프레시 때 digest 검증 뒤에 다시 넣는다
+                conn.execute("UPDATE meta SET stat = ?, offset = ?, run_date = ?, run_start = ?",
+                             (json.dumps(_stat_key(after)), entries[-1][1], run[0], run[1]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    except sqlite3.Error:
+        pass  # 캐시일 뿐이다: 다음에 읽을 때 stat 이 안 맞아 다시 맞춘다
+
+
+def indexed_rows(path: Optional[Path] = None, *, ticker: Optional[str] = None, lot: Optional[int] = None,
+                 since: Optional[str] = None, until: Optional[str] = None,
+                 number: Any = Decimal) -> Iterator[TradeRow]:
+    """
+    인덱스로 고른 행만 원장 순서대로 파싱한다 (전체를 읽지 않는다).
+    lot: 그 id 의 행 + 그 lot 을 대상으로 한 행, ticker: 그 티커의 행, since/until: 날짜 구간 (양 끝 포함).
+    여러 조건을 주면 lot → ticker → 날짜 순으로 인덱스 하나를 쓰고 나머지는 파싱한 행에서 거른다.
+    """
+    path = path or DATA_PATH
+    conn = _index_conn(path)
+    _refresh_index(conn, path)
+    header = read_header(path)
+
+    with path.open("rb") as f:
+        if lot is None and ticker is None:
+            ranges = conn.execute(
+                "SELECT start, finish FROM dates WHERE date >= ? AND date <= ? ORDER BY start",
+                (since or "", until or "\uffff"),
+            ).fetchall()
+            for start, finish in ranges:
+                f.seek(start)
+                yield from parse_rows(f.read(finish - start).decode("utf-8").splitlines(True), header, number)
+            return
+
+        if lot is not None:
+            cursor = conn.execute("SELECT offset FROM lots WHERE lot = ? ORDER BY offset", (lot,))
+        else:
+            cursor = conn.execute("SELECT offset FROM tickers WHERE ticker = ? ORDER BY offset", (ticker,))
+        offsets = cursor.fetchall()
+
+        def records() -> Iterator[str]:
+            for (offset,) in offsets:
+                f.seek(offset)
+                record = f.readline()
+                while record.count(b'"') % 2:  # 따옴표 안의 개행 → 레코드가 다음 줄로 이어진다
+                    more = f.readline()
+                    if not more:
+                        break
+                    record += more
+                yield record.decode("utf-8")
+
+        for r in parse_rows(records(), header, number):
+            if ticker is not None and r.ticker != ticker:
+                continue
+            if (since and r.date < since) or (until and r.date > until):
+                continue
+            yield r
+
+
+"""
+쓰기 명령은 "계획"과 "기록"을 나눈다.
+plan_* 는 주어진 포트폴리오로 검증만 하고 덧붙일 행 목록과 출력 메시지를 돌려준다.
+행 목록이 비어 있으면 건너뛴 것이고 메시지가 그 이유다.
+cmd_* 는 load_portfolio() → plan_* → append_rows() 이고, batch 는 같은 plan_* 를
+메모리 포트폴리오 하나에 차례로 적용한 뒤 한 번에 기록한다.
+"""
+Plan = Tuple[List[Dict[str, str]], str]
+
+
+def _today() -> str:
+    """--date 가 없을 때 쓰는 오늘 날짜 (datetime 은 쓰기 명령에서만 import)"""
+    import datetime
+
+    return datetime.date.today().isoformat()
+
+
+def plan_add(args: argparse.Namespace, positions: Dict[str, Dict[int, Lot]], row_id: int) -> Plan:
+    date = args.date or _today() # date 인자가 없으면 오늘 날짜 사용.
 
     # csv 저장되기 위한 형태는 반드시 str
     row = {
@@ -183,33 +1834,27 @@ def cmd_add(args: argparse.Namespace) -> None:
         "qty": str(Decimal(args.qty)),
         "price": str(Decimal(args.price)),
         "stop": str(Decimal(args.stop)),
+        "target_id": "",
         "note": args.note or "",
     }
-    append_row(row)
-    print(f"Added lot {row_id}")
+    return [row], f"Added lot {row_id}"
 
 
-def cmd_trim(args: argparse.Namespace) -> None:
-    rows = load_rows()
-    positions, _ = build_portfolio(rows)
-
+def plan_trim(args: argparse.Namespace, positions: Dict[str, Dict[int, Lot]], row_id: int) -> Plan:
     ticker = args.ticker.upper()
     lot = positions.get(ticker, {}).get(args.id)
 
     # 1) ID 존재 검사
     if not lot:
-        print(f"⚠️ Trim skipped: lot id={args.id} for {ticker} not found.")
-        return
+        return [], f"⚠️ Trim skipped: lot id={args.id} for {ticker} not found."
 
     sell_qty = Decimal(args.qty)
     # 2) 과다 매도 방지
     if sell_qty > lot.qty:
-        print(f"⚠️ Trim skipped: trying to sell {sell_qty}, but only {lot.qty} left.")
-        return
+        return [], f"⚠️ Trim skipped: trying to sell {sell_qty}, but only {lot.qty} left."
 
     # 3) 정상 처리
-    row_id = next_row_id(rows)
-    date = args.date or datetime.date.today().isoformat()
+    date = args.date or _today()
     note = f"trim id={args.id}" + (f" {args.note}" if args.note else "")
     row = {
         "id": str(row_id),
@@ -218,28 +1863,25 @@ def cmd_trim(args: argparse.Namespace) -> None:
         "qty": str(-sell_qty),
         "price": str(Decimal(args.price)),
         "stop": "0",
+        "target_id": str(args.id),
         "note": note,
     }
-    append_row(row)
-    print(f"Trimmed lot {args.id} by {sell_qty}")
+    return [row], f"Trimmed lot {args.id} by {sell_qty}"
 
 
-def cmd_close(args: argparse.Namespace) -> None:
-    rows = load_rows()
-    positions, _ = build_portfolio(rows)
-
+def plan_close(args: argparse.Namespace, positions: Dict[str, Dict[int, Lot]], row_id: int) -> Plan:
     ticker = args.ticker.upper()
     lot = positions.get(ticker, {}).get(args.id)
 
 
     if not lot:
-        print(f"⚠️ Close skipped: lot id={args.id} for {ticker} not found.")
-        return
+        return [], f"⚠️ Close skipped: lot id={args.id} for {ticker} not found."
     if lot.qty == 0:
-        print(f"⚠️ Close skipped: lot id={args.id} for {ticker} already fully sold.")
-        return
+        return [], f"⚠️ Close skipped: lot id={args.id} for {ticker} already fully sold."
     
-    # close는 특정 트랜치를 전량 청산하는 것을 의미하기 때문에 id가 일치하는 트랜치의 전체 수량을 cmd_trim 입력으로 넣어 코드를 재사용한다.
+    # close는 특정 트랜치를 전량 청산하는 것을 의미하기 때문에 id가 일치하는 트랜치의 전체 수량을 plan_trim 입력으로 넣어 코드를 재사용한다.
+    import argparse
+
     qty = lot.qty
     args_trim = argparse.Namespace(
         ticker=ticker,
@@ -249,22 +1891,17 @@ def cmd_close(args: argparse.Namespace) -> None:
         note=args.note,
         date=args.date,
     )
-    cmd_trim(args_trim)
-
+    return plan_trim(args_trim, positions, row_id)
 
-def cmd_stop(args: argparse.Namespace) -> None:
-    rows = load_rows()
-    positions, _ = build_portfolio(rows)
 
+def plan_stop(args: argparse.Namespace, positions: Dict[str, Dict[int, Lot]], row_id: int) -> Plan:
     ticker = args.ticker.upper()
     lot = positions.get(ticker, {}).get(args.id)
     
     if not lot:
-        print(f"⚠️ Stop skipped: lot id={args.id} for {ticker} not found.")
-        return
+        return [], f"⚠️ Stop skipped: lot id={args.id} for {ticker} not found."
 
-    row_id = next_row_id(rows)
-    date = args.date or datetime.date.today().isoformat()
+    date = args.date or _today()
     note = f"stop id={args.id}" + (f" {args.note}" if args.note else "")
     row = {
         "id": str(row_id),
@@ -273,22 +1910,18 @@ def cmd_stop(args: argparse.Namespace) -> None:
         "qty": "0",
         "price": "0",
         "stop": str(Decimal(args.new_stop)),
+        "target_id": str(args.id),
         "note": note,
     }
-    append_row(row)
-    print(f"Moved stop for lot {args.id} of {ticker}: {lot.stop} ➝ {args.new_stop}")
+    return [row], f"Moved stop for lot {args.id} of {ticker}: {lot.stop} ➝ {args.new_stop}"
 
 
-def cmd_split(args: argparse.Namespace) -> None:
-    rows = load_rows()
-    positions, _ = build_portfolio(rows)
-
+def plan_split(args: argparse.Namespace, positions: Dict[str, Dict[int, Lot]], row_id: int) -> Plan:
     ticker = args.ticker.upper()
     lot = positions.get(ticker, {}).get(args.id)
 
     if not lot or lot.qty == 0:
-        print(f"⚠️ Split skipped: lot id={args.id} for {ticker} not found or closed.")
-        return
+        return [], f"⚠️ Split skipped: lot id={args.id} for {ticker} not found or closed."
 
     tokens = args.parts.split()
     parts: List[Tuple[Decimal, Decimal]] = []
@@ -297,21 +1930,17 @@ def cmd_split(args: argparse.Namespace) -> None:
             qty_s, stop_s = tok.split(":", 1)
             parts.append((Decimal(qty_s), Decimal(stop_s)))
         except Exception:
-            print(f"⚠️ Split skipped: invalid part '{tok}'.")
-            return
+            return [], f"⚠️ Split skipped: invalid part '{tok}'."
 
     total_qty = sum(q for q, _ in parts)
     if total_qty != lot.qty:
-        print(f"⚠️ Split skipped: parts sum {total_qty} ≠ lot qty {lot.qty}.")
-        return
+        return [], f"⚠️ Split skipped: parts sum {total_qty} ≠ lot qty {lot.qty}."
 
     stops = [s for _, s in parts]
     if len(stops) != len(set(stops)):
-        print("⚠️ Split skipped: duplicate stop values.")
-        return
+        return [], "⚠️ Split skipped: duplicate stop values."
 
-    date = args.date or datetime.date.today().isoformat()
-    row_id = next_row_id(rows)
+    date = args.date or _today()
     total_rows = len(parts) + 1
     idx = 1
 
@@ -319,7 +1948,7 @@ def cmd_split(args: argparse.Namespace) -> None:
     trim_qty = lot.qty - parts[0][0]
     note = f"split from id={args.id} part {idx}/{total_rows}"
     rows_to_append = [
-        make_row(row_id, date, ticker, -trim_qty, lot.price, Decimal("0"), note)
+        make_row(row_id, date, ticker, -trim_qty, lot.price, Decimal("0"), note, args.id)
     ]
     row_id += 1
     idx += 1
@@ -327,7 +1956,7 @@ def cmd_split(args: argparse.Namespace) -> None:
     # B. stop move for original lot
     note = f"split from id={args.id} part {idx}/{total_rows}"
     rows_to_append.append(
-        make_row(row_id, date, ticker, Decimal("0"), Decimal("0"), parts[0][1], note)
+        make_row(row_id, date, ticker, Decimal("0"), Decimal("0"), parts[0][1], note, args.id)
     )
     row_id += 1
     idx += 1
@@ -336,36 +1965,1609 @@ def cmd_split(args: argparse.Namespace) -> None:
     for qty, stop in parts[1:]:
         note = f"split from id={args.id} part {idx}/{total_rows}"
         rows_to_append.append(
-            make_row(row_id, date, ticker, qty, lot.price, stop, note)
+            make_row(row_id, date, ticker, qty, lot.price, stop, note, args.id)
         )
         row_id += 1
         idx += 1
 
-    for r in rows_to_append:
-        append_row(r)
-    print(f"Split lot {args.id} of {ticker} into {len(parts)} parts")
-    
+    return rows_to_append, f"Split lot {args.id} of {ticker} into {len(parts)} parts"
+
+
+"""
+쓰기 동시성: 여러 스크립트가 동시에 add/trim 을 실행해도 id 가 겹치거나 검증이 낡지 않도록
+id 할당 ~ append 는 data/trades.lock 의 배타 flock 안에서만 한다.
+
+1. 잠금 밖에서 낙관적으로 계획해 본다 (리플레이/체크포인트를 데우고, 실패할 명령은 여기서 끝)
+2. 잠금 안에서 대상 lot 을 다시 읽어 재검증하고, 그때의 next_row_id() 로 행을 만든다
+3. group commit: 잠금이 이미 잡혀 있으면 명령을 data/trades.spool/<key>.req.json 으로 남기고 잠금을 기다린다.
+   잠금을 잡은 쪽(리더)은 자기 명령과 스풀의 명령을 도착 순서대로 메모리 포트폴리오에 검증·적용하고
+   한 번의 write + fsync 로 기록한 뒤 각자의 결과를 <key>.done.json 으로 남긴다.
+   잠금을 넘겨받은 대기자는 자기 결과가 있으면 출력만 하고, 없으면 자기가 리더가 된다.
+   대기자가 중단되면 자기 요청을 지우고, 리더는 writer 프로세스가 이미 없는 요청·결과를 버린다.
+리더가 기록 도중 죽어도 같은 요청이 두 번 기록되지 않도록, 기록 전에 journal.json 에
+결과와 마지막 id 를 남긴다. 다음 리더는 그 id 까지 기록됐으면 결과만 전달한다.
+batch/migrate/convert/compact 도 같은 잠금을 잡는다.
+"""
+class _LedgerLock:
+    """data/trades.lock 에 거는 배타 flock (프로세스가 죽으면 OS 가 풀어 준다). fcntl 이 없으면(Windows) 잠그지 않는다."""
+
+    def __init__(self) -> None:
+        self._file: Optional[Any] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        DATA_PATH.parent.mkdir(exist_ok=True)
+        f = _sidecar_path("lock").open("a")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self) -> None:
+        if self._file is not None:
+            self._file.close()  # 닫으면 flock 도 풀린다
+            self._file = None
+
+    def __enter__(self) -> "_LedgerLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.release()
+
+
+def _spool_dir() -> Path:
+    return _sidecar_path("spool")
+
+
+def _spool_request(args: argparse.Namespace) -> str:
+    """명령을 스풀에 남기고 key 를 돌려준다. key 는 도착 순서대로 정렬된다."""
+    import time
+
+    spool = _spool_dir()
+    spool.mkdir(exist_ok=True)
+    key = f"{time.time_ns():020d}-{os.getpid()}"
+    data = {k: v for k, v in vars(args).items() if k != "func"}
+    _write_json_atomic(spool / f"{key}.req.json", {**data, "_pid": os.getpid()})
+    return key
+
+
+def _pid_alive(pid: int) -> bool:
+    """요청을 남긴 writer 프로세스가 아직 살아 있는지 (확인할 수 없으면 살아 있다고 본다)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _sweep_done(spool: Path) -> None:
+    """결과를 가져갈 writer 가 죽어 남은 <key>.done.json 을 지운다"""
+    for done in spool.glob("*.done.json"):
+        pid = done.name[: -len(".done.json")].rpartition("-")[2]
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            done.unlink(missing_ok=True)
+
+
+def _drop_request(key: str) -> None:
+    """대기하던 writer 가 중단됨: 아직 기록되지 않은 요청과, 이미 기록됐다면 그 결과를 지운다"""
+    spool = _spool_dir()
+    (spool / f"{key}.req.json").unlink(missing_ok=True)
+    (spool / f"{key}.done.json").unlink(missing_ok=True)
+
+
+def _take_result(key: str) -> Optional[str]:
+    """다른 리더가 이 요청을 이미 기록했으면 그 결과 메시지 (없으면 None)"""
+    done = _spool_dir() / f"{key}.done.json"
+    try:
+        with done.open() as f:
+            message = json.load(f)["message"]
+    except FileNotFoundError:
+        return None
+    done.unlink()
+    return message
+
+
+def _finish_request(key: str, message: Optional[str]) -> None:
+    spool = _spool_dir()
+    if message is not None:
+        _write_json_atomic(spool / f"{key}.done.json", {"message": message})
+    (spool / f"{key}.req.json").unlink(missing_ok=True)
+
+
+def _recover_journal() -> None:
+    """이전 리더가 기록 도중 죽었으면: 행이 기록됐을 때만 결과를 전달한다 (아니면 요청을 다시 처리)."""
+    journal = _spool_dir() / "journal.json"
+    try:
+        with journal.open() as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    if next_row_id() > data["last_id"]:
+        for key, message in data["results"].items():
+            _finish_request(key, message)
+    journal.unlink()
+
+
+def _commit_group(own: Optional[Tuple[Any, argparse.Namespace]] = None, mine: Optional[str] = None) -> str:
+    """
+    잠금을 잡은 리더: 자기 명령(own 또는 스풀의 mine)과 스풀의 다른 명령을 한 번에 검증·기록하고
+    자기 명령의 메시지를 돌려준다.
+    """
+    import argparse
+
+    spool = _spool_dir()
+    requests: List[Tuple[Optional[str], Any, argparse.Namespace]] = []
+    if spool.is_dir():
+        _recover_journal()
+        _sweep_done(spool)
+        if mine is not None:
+            # 죽은 리더의 저널이 방금 이 요청까지 기록했음을 확인했으면 결과만 받아 간다
+            message = _take_result(mine)
+            if message is not None:
+                return message
+        for req in sorted(spool.glob("*.req.json")):
+            key = req.name[: -len(".req.json")]
+            try:
+                with req.open() as f:
+                    data = json.load(f)
+            except FileNotFoundError:  # 대기자가 그사이 중단하고 지웠다
+                continue
+            pid = data.pop("_pid", None)
+            if key != mine and pid is not None and not _pid_alive(pid):
+                req.unlink(missing_ok=True)  # 결과를 받을 writer 가 없으니 기록하지 않는다
+                continue
+            requests.append((key, _BATCH_PLANNERS[data["command"]], argparse.Namespace(**data)))
+    if own:
+        requests.append((None, *own))  # 먼저 기다리던 요청들 다음 순서
+
+    # 대상 lot 은 잠금 안에서 저장소에서 다시 읽는다 (재검증). 같은 묶음 안의 변경은 메모리에서 이어진다
+    positions: Dict[str, Dict[int, Lot]] = {}
+    realized: Dict[str, Decimal] = {}
+    for _, planner, args in requests:
+        if planner is not plan_add:
+            ticker = args.ticker.upper()
+            lots = load_lot(ticker, args.id)
+            lot = lots.get(ticker, {}).get(args.id)
+            if lot and args.id not in positions.get(ticker, {}):
+                positions.setdefault(ticker, {})[args.id] = Lot(lot.id, lot.ticker, lot.qty, lot.price, lot.stop)
+                realized.setdefault(ticker, Decimal("0"))
+
+    row_id = next_row_id()
+    pending: List[Dict[str, str]] = []
+    results: Dict[Optional[str], str] = {}
+    for key, planner, args in requests:
+        try:
+            rows, message = planner(args, positions, row_id)
+        except Exception as e:  # 스풀의 잘못된 요청 하나가 묶음 전체를 막지 않게
+            rows, message = [], f"⚠️ {args.command.capitalize()} skipped: {type(e).__name__}: {e}"
+        if rows:
+            build_portfolio([_to_trade_row(r) for r in rows], positions, realized)
+            pending.extend(rows)
+            row_id += len(rows)
+        results[key] = message
+
+    spooled = {key: message for key, message in results.items() if key is not None}
+    journal = spool / "journal.json"
+    if spooled:
+        _write_json_atomic(journal, {"last_id": row_id - 1 if pending else 0, "results": spooled})
+    if pending:
+        append_rows(pending)
+    for key, message in spooled.items():
+        _finish_request(key, None if key == mine else message)
+    journal.unlink(missing_ok=True)
+    if mine not in results:
+        # 이번 묶음이 가져가지 못한 자기 요청 (스풀에서 사라짐): 기록 여부를 알 수 없다
+        return "⚠️ Request was not found in the spool; check the ledger before retrying."
+    return results[mine]
+
+
+def _exclusive(func: Any) -> Any:
+    """원장 파일을 통째로 다시 쓰는 명령은 실행 내내 잠금을 잡는다 (그사이 append 가 옛 파일에 붙어 사라지지 않게)"""
+    def locked(args: argparse.Namespace) -> None:
+        with _LedgerLock():
+            func(args)
+
+    locked.__name__, locked.__doc__ = func.__name__, func.__doc__
+    return locked
+
+
+def _run_plan(planner: Any, args: argparse.Namespace) -> None:
+    """단일 쓰기 명령: 현재 포트폴리오로 계획하고, 행이 있으면 기록한 뒤 메시지를 출력한다."""
+    if planner is plan_add:
+        ensure_csv()
+        positions: Dict[str, Dict[int, Lot]] = {}  # add 는 검증할 lot 이 없어 리플레이하지 않는다
+    else:
+        # 샤드 레이아웃이면 해당 티커 샤드만, SQLite 면 대상 lot 의 행만 리플레이한다
+        positions = load_lot(args.ticker.upper(), args.id)
+    # 낙관적 검증 (잠금 밖): 건너뛸 명령이면 잠금을 잡지 않는다
+    rows, message = planner(args, positions, next_row_id())
+    if not rows:
+        print(message)
+        return
+
+    lock = _LedgerLock()
+    if lock.acquire(blocking=False):
+        try:
+            message = _commit_group(own=(planner, args))
+        finally:
+            lock.release()
+    else:
+        # 다른 writer 가 기록 중: 요청을 스풀에 남기고 기다린다 (그 writer 가 같이 기록해 줄 수 있다)
+        key = _spool_request(args)
+        try:
+            with lock:
+                message = _take_result(key)
+                if message is None:
+                    message = _commit_group(mine=key)
+        except BaseException:
+            # Ctrl-C 등으로 대기 중 중단: 요청이 스풀에 남아 다음 리더가 대신 기록하지 않게 한다
+            _drop_request(key)
+            raise
+    print(message)
+
+
+def cmd_add(args: argparse.Namespace) -> None:
+    _run_plan(plan_add, args)
+
+
+def cmd_trim(args: argparse.Namespace) -> None:
+    _run_plan(plan_trim, args)
+
+
+def cmd_close(args: argparse.Namespace) -> None:
+    _run_plan(plan_close, args)
+
+
+def cmd_stop(args: argparse.Namespace) -> None:
+    _run_plan(plan_stop, args)
+
+
+def cmd_split(args: argparse.Namespace) -> None:
+    _run_plan(plan_split, args)
+
+
+# batch 파일에서 허용하는 명령 → 계획 함수
+_BATCH_PLANNERS = {
+    "add": plan_add,
+    "trim": plan_trim,
+    "close": plan_close,
+    "stop": plan_stop,
+    "split": plan_split,
+}
+
+
+def _copy_portfolio(
+    positions: Dict[str, Dict[int, Lot]], realized: Dict[str, Decimal]
+) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """load_portfolio() 가 캐시한 상태(_STATE)를 건드리지 않도록 lot 까지 복사한다."""
+    copied = {
+        ticker: {lot_id: Lot(lot.id, lot.ticker, lot.qty, lot.price, lot.stop) for lot_id, lot in lots.items()}
+        for ticker, lots in positions.items()
+    }
+    return copied, dict(realized)
+
+
+def _to_trade_row(row: Dict[str, str]) -> TradeRow:
+    """계획된 행(dict) → 리플레이용 TradeRow"""
+    target = row["target_id"]
+    return TradeRow(int(row["id"]), row["date"], row["ticker"], Decimal(row["qty"]),
+                    Decimal(row["price"]), Decimal(row["stop"]),
+                    int(target) if target else None, row["note"])
+
+
+def cmd_batch(args: argparse.Namespace) -> None:
+    """
+    명령 파일(또는 '-' = stdin)의 각 줄을 기존 서브 명령 문법으로 읽어
+    리플레이 한 번으로 얻은 메모리 포트폴리오에 차례로 검증·적용하고,
+    생긴 행 전체를 append_rows() 한 번으로 기록한다.
+    빈 줄과 '#' 주석은 무시하고, 줄 앞의 'tradingbook'/'tb' 는 떼어 낸다.
+    """
+    if args.file == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.file, encoding="utf-8") as f:
+            lines = f.readlines()
+
+    # 입력을 다 읽은 뒤에 잠금을 잡는다 (stdin 을 기다리는 동안 다른 writer 를 막지 않게)
+    with _LedgerLock():
+        _apply_batch(lines)
+
+
+def _apply_batch(lines: List[str]) -> None:
+    import contextlib
+    import shlex
+
+    parser = build_parser()
+    positions, realized = _copy_portfolio(*load_portfolio())
+    row_id = next_row_id()
+
+    pending: List[Dict[str, str]] = []
+    skipped: List[Tuple[int, str]] = []
+    applied = 0
+    for lineno, line in enumerate(lines, 1):
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as e:
+            skipped.append((lineno, str(e)))
+            continue
+        if argv and argv[0] in ("tradingbook", "tb"):
+            argv = argv[1:]
+        if not argv:
+            continue
+        # --help 는 사용법을 찍고 exit(0) 한다 → 파싱 오류로 섞이지 않게 먼저 거른다
+        if "-h" in argv or "--help" in argv:
+            skipped.append((lineno, "--help is not available in a batch (run 'tradingbook <command> --help')"))
+            continue
+        command = _command_name(argv)
+        planner = _BATCH_PLANNERS.get(command or "")
+        if planner is None:
+            skipped.append((lineno, f"'{command}' is not allowed in a batch "
+                                    f"(use {', '.join(_BATCH_PLANNERS)})"))
+            continue
+
+        # argparse 오류는 stderr 로 출력되고 SystemExit 이 난다 → 마지막 줄을 사유로 쓴다
+        # (argparse 가 stdout 에 쓰는 것은 stderr 로 돌려 배치 결과 출력에 섞이지 않게 한다)
+        err = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(sys.stderr), contextlib.redirect_stderr(err):
+                line_args = parser.parse_args(argv)
+            rows, message = planner(line_args, positions, row_id)
+        except SystemExit:
+            lines_err = err.getvalue().strip().splitlines()
+            skipped.append((lineno, lines_err[-1] if lines_err else "invalid arguments"))
+            continue
+        except Exception as e:  # 잘못된 숫자 등
+            skipped.append((lineno, f"{type(e).__name__}: {e}"))
+            continue
+
+        if not rows:
+            skipped.append((lineno, message.replace("⚠️ ", "", 1)))
+            continue
+        # 다음 줄이 이 줄의 결과(새 lot, 줄어든 수량, 옮긴 스탑)를 보고 검증하도록 바로 반영
+        build_portfolio([_to_trade_row(r) for r in rows], positions, realized)
+        pending.extend(rows)
+        row_id += len(rows)
+        applied += 1
+        print(f"{lineno}: {message}")
+
+    if pending:
+        append_rows(pending)
+    print(f"Batch: {applied} command(s) applied, {len(pending)} row(s) appended, "
+          f"{len(skipped)} line(s) skipped.")
+    for lineno, reason in skipped:
+        print(f"⚠️ line {lineno} skipped: {reason}")
+
+
+"""
+브로커 체결 내역 가져오기: 증권사 CSV(컬럼 이름은 증권사마다 다름)를 컬럼 매핑으로 읽어
+체결 하나씩 메모리 포트폴리오에 검증·적용한다. 매수는 새 lot, 매도는 그 티커의 열린 lot 을
+오래된 것부터(FIFO) 줄이는 trim 행이 된다. id 는 잠금 안에서 연속으로 할당하고,
+행은 IMPORT_CHUNK 개씩 모아 append_rows() 로 기록하므로 체결이 수백만 건이어도
+메모리는 열린 lot 수 + 한 묶음 크기로 일정하다.
+"""
+IMPORT_CHUNK = 50_000
+# 매핑을 주지 않은 필드는 헤더에서 이 이름들을 (대소문자 무시) 찾는다. side 가 없으면 qty 부호로 판단
+_IMPORT_COLUMNS = {
+    "date": ("date", "trade date", "transaction date", "datetime", "time", "executed at", "fill time"),
+    "ticker": ("symbol", "ticker", "instrument", "security"),
+    "side": ("side", "action", "buy/sell", "b/s", "transaction type", "type"),
+    "qty": ("qty", "quantity", "shares", "filled qty", "filled quantity"),
+    "price": ("price", "fill price", "avg price", "average price", "execution price", "trade price"),
+}
+_BUY_SIDES = {"buy", "b", "bot", "bought", "buy to open"}
+_SELL_SIDES = {"sell", "s", "sld", "sold", "sell to close"}
+
+
+def _import_columns(fieldnames: List[str], overrides: Dict[str, str]) -> Dict[str, str]:
+    """필드 → 브로커 CSV 컬럼 이름. 필수 컬럼을 못 찾으면 ValueError"""
+    by_lower = {name.strip().lower(): name for name in fieldnames}
+    columns = {}
+    for field, candidates in _IMPORT_COLUMNS.items():
+        if field in overrides:
+            if overrides[field] not in fieldnames:
+                raise ValueError(f"column '{overrides[field]}' for {field} not in the file header")
+            columns[field] = overrides[field]
+            continue
+        found = next((by_lower[c] for c in candidates if c in by_lower), None)
+        if found is not None:
+            columns[field] = found
+        elif field != "side":
+            raise ValueError(f"no {field} column found; pass --map {field}=COLUMN")
+    return columns
+
+
+def _import_number(text: str) -> Decimal:
+    cleaned = text.strip().replace(",", "").replace("$", "")
+    try:
+        value = Decimal(cleaned)
+    except InvalidOperation:
+        raise ValueError(f"invalid number '{text}'") from None
+    if not value.is_finite():  # NaN/Infinity 는 비교 자체가 InvalidOperation 을 낸다
+        raise ValueError(f"invalid number '{text}'")
+    return value
+
+
+def _import_date(text: str, date_format: Optional[str]) -> str:
+    from datetime import date, datetime
+
+    text = text.strip()
+    try:
+        if date_format:
+            return datetime.strptime(text, date_format).date().isoformat()
+        try:
+            return date.fromisoformat(text[:10]).isoformat()
+        except ValueError:
+            return datetime.strptime(text.split()[0], "%m/%d/%Y").date().isoformat()
+    except (ValueError, IndexError):
+        raise ValueError(f"invalid date '{text}'") from None
+
+
+def plan_fill(fill: Dict[str, str], columns: Dict[str, str], positions: Dict[str, Dict[int, Lot]],
+              row_id: int, args: argparse.Namespace) -> List[Dict[str, str]]:
+    """체결 한 줄 → 덧붙일 행들. 검증에 실패하면 사유를 담은 ValueError"""
+    ticker = (fill[columns["ticker"]] or "").strip().upper()
+    if not ticker:
+        raise ValueError("empty ticker")
+    qty = _import_number(fill[columns["qty"]] or "")
+    if "side" in columns:
+        side = (fill[columns["side"]] or "").strip().lower()
+        if side not in _BUY_SIDES and side not in _SELL_SIDES:
+            raise ValueError(f"unknown side '{fill[columns['side']]}'")
+        buy = side in _BUY_SIDES
+    else:
+        buy = qty > 0
+    qty = abs(qty)
+    if qty == 0:
+        raise ValueError("zero quantity")
+    price = _import_number(fill[columns["price"]] or "")
+    if price <= 0:
+        raise ValueError(f"non-positive price {price}")
+    date = _import_date(fill[columns["date"]] or "", args.date_format)
+
+    if buy:
+        stop = Decimal("0")
+        if args.stop_pct:
+            # 가격의 소수 자릿수(최소 2자리)에 맞춰 자른다
+            stop = (price * (1 - args.stop_pct / 100)).quantize(
+                Decimal(1).scaleb(min(price.as_tuple().exponent, -2)))
+        return [make_row(row_id, date, ticker, qty, price, stop, args.note)]
+
+    lots = positions.get(ticker, {})
+    open_qty = sum((lot.qty for lot in lots.values()), Decimal("0"))
+    if qty > open_qty:
+        raise ValueError(f"selling {qty} {ticker} but only {open_qty} open")
+    rows = []
+    remaining = qty
+    for lot in lots.values():  # 삽입 순서 = lot 이 생긴 순서 → FIFO
+        take = min(remaining, lot.qty)
+        note = f"trim id={lot.id}" + (f" {args.note}" if args.note else "")
+        rows.append(make_row(row_id, date, ticker, -take, price, Decimal("0"), note, lot.id))
+        row_id += 1
+        remaining -= take
+        if not remaining:
+            break
+    return rows
+
+
+def cmd_import(args: argparse.Namespace) -> None:
+    """브로커 체결 CSV(또는 '-' = stdin)를 스트리밍으로 검증하고 원장에 기록한다."""
+    overrides = {}
+    for item in args.map:
+        field, sep, column = item.partition("=")
+        if not sep or field not in _IMPORT_COLUMNS:
+            print(f"⚠️ Import skipped: invalid --map '{item}' (use FIELD=COLUMN, FIELD in {', '.join(_IMPORT_COLUMNS)})")
+            return
+        overrides[field] = column
+    if args.stop_pct is not None:
+        # 체결마다가 아니라 스캔 전에 한 번만 검증한다
+        try:
+            args.stop_pct = _import_number(str(args.stop_pct))
+        except ValueError:
+            args.stop_pct = None
+        if args.stop_pct is None or not 0 <= args.stop_pct < 100:
+            print("⚠️ Import skipped: --stop-pct must be a number from 0 to below 100")
+            return
+
+    # 증권사 CSV 는 BOM 이 붙어 있는 경우가 많다
+    src = sys.stdin if args.file == "-" else open(args.file, newline="", encoding="utf-8-sig")
+    with src, _LedgerLock():
+        reader = csv.DictReader(src)
+        try:
+            columns = _import_columns(reader.fieldnames or [], overrides)
+        except ValueError as e:
+            print(f"⚠️ Import skipped: {e}")
+            return
+        _import_fills(reader, columns, args)
+
 
-def cmd_status(_: argparse.Namespace) -> None:
-    rows = load_rows()
-    positions, _ = build_portfolio(rows)
-    print_status(positions)
+def _import_fills(reader: Iterator[Dict[str, str]], columns: Dict[str, str], args: argparse.Namespace) -> None:
+    positions, realized = _copy_portfolio(*load_portfolio())
+    row_id = next_row_id()
+    pending: List[Dict[str, str]] = []
+    imported = appended = skipped = 0
+    reasons: List[Tuple[int, str]] = []  # 앞쪽 몇 개만 보관 (메모리 일정)
+    # FIFO 는 티커 안에서만 날짜 순서가 필요하다 (티커 → 날짜로 정렬된 내보내기도 받는다)
+    last_dates: Dict[str, str] = {}
 
+    for lineno, fill in enumerate(reader, 2):
+        try:
+            rows = plan_fill(fill, columns, positions, row_id, args)
+            if rows[0]["date"] < last_dates.get(rows[0]["ticker"], ""):
+                raise ValueError(f"fill is older than the previous {rows[0]['ticker']} fill "
+                                 "(FIFO needs each ticker's oldest fills first)")
+        except ValueError as e:
+            skipped += 1
+            if len(reasons) < 20:
+                reasons.append((lineno, str(e)))
+            continue
+        last_dates[rows[0]["ticker"]] = rows[0]["date"]
+        # 다음 체결이 이 체결의 결과(새 lot, 줄어든 수량)를 보고 검증하도록 바로 반영
+        build_portfolio([_to_trade_row(r) for r in rows], positions, realized)
+        pending.extend(rows)
+        row_id += len(rows)
+        imported += 1
+        if len(pending) >= IMPORT_CHUNK:
+            append_rows(pending)
+            appended += len(pending)
+            pending = []
+
+    if pending:
+        append_rows(pending)
+        appended += len(pending)
+    print(f"Import: {imported} fill(s) imported, {appended} row(s) appended, {skipped} fill(s) skipped.")
+    for lineno, reason in reasons:
+        print(f"⚠️ line {lineno} skipped: {reason}")
+    if skipped > len(reasons):
+        print(f"⚠️ ... and {skipped - len(reasons)} more skipped fill(s).")
+
+
+"""
+시세 캐시 (선택): data/prices.json 에 티커별 마지막 시세를 둔다. 시세를 받아 오는 로컬 스크립트가
+CSV/JSON 시세 파일을 만들고 `tb prices FILE` 로 넣으면, status/report 가 그 시세로 평가한다.
+
+  {"version": 1, "quotes": {"QQQ": {"price": "431.20", "as_of": "2024-03-29T16:00:00", "ts": 1711742400.0}}}
+
+- 시세 파일 CSV: ticker|symbol, price|last|close, (선택) as_of|date|time|timestamp 컬럼
+- 시세 파일 JSON: {"QQQ": 431.2}, {"QQQ": {"price": 431.2, "as_of": "..."}}, [{"ticker": "QQQ", "price": ...}]
+- 시각이 없는 시세는 시세 파일의 수정 시각을 쓴다. 같은 티커는 더 최근 시세만 덮어쓴다
+- PRICE_STALE_SECONDS 보다 오래된 시세는 표에서 * 로 표시한다
+프로세스 안에서는 _PRICES 에 올려 두고 prices.json 의 stat 이 바뀔 때만 다시 읽는다 (serve/shell).
+"""
+PRICES_VERSION = 1
+PRICE_STALE_SECONDS = 24 * 60 * 60
+_PRICE_COLUMNS = {
+    "ticker": ("ticker", "symbol"),
+    "price": ("price", "last", "close"),
+    "as_of": ("as_of", "date", "time", "timestamp"),
+}
+_PRICES: Dict[str, Any] = {}
+
+
+def _prices_path() -> Path:
+    return DATA_PATH.with_name("prices.json")
+
+
+def _now() -> float:
+    import time
+
+    return time.time()
+
+
+def load_prices() -> Dict[str, Quote]:
+    """티커 → Quote. 시세 캐시가 없거나 읽을 수 없으면 빈 dict (평가 컬럼 없이 출력)"""
+    path = _prices_path()
+    try:
+        key = _stat_key(os.stat(path))
+    except OSError:
+        return {}
+    if _PRICES.get("stat") == key:
+        return _PRICES["quotes"]
+    try:
+        with path.open() as f:
+            data = json.load(f)
+        if data.get("version") != PRICES_VERSION:
+            return {}
+        quotes = {ticker: Quote(Decimal(q["price"]), q["ts"], q["as_of"]) for ticker, q in data["quotes"].items()}
+    except (OSError, ValueError, KeyError, InvalidOperation, AttributeError):
+        return {}
+    _PRICES.update(stat=key, quotes=quotes)
+    return quotes
+
+
+def _quote_time(value: Any, fallback: float) -> Tuple[float, str]:
+    """시세 시각 → (epoch 초, ISO 문자열). 값이 없으면 fallback(시세 파일 수정 시각)"""
+    from datetime import datetime
+
+    if value in (None, ""):
+        ts = fallback
+    elif isinstance(value, (int, float)) or str(value).replace(".", "", 1).isdigit():
+        ts = float(value)
+    else:
+        try:
+            ts = datetime.fromisoformat(str(value).strip()).timestamp()  # 시간대가 없으면 로컬 시각
+        except ValueError:
+            raise ValueError(f"invalid time '{value}'") from None
+    return ts, datetime.fromtimestamp(ts).isoformat(timespec="seconds")
+
+
+def _read_quotes(text: str, mtime: float) -> Tuple[Dict[str, Quote], List[str]]:
+    """시세 파일 내용 → (티커 → Quote, 건너뛴 사유들). 같은 파일 안의 중복 티커는 더 최근 것"""
+    entries: List[Tuple[Any, Any, Any]] = []
+    stripped = text.lstrip("\ufeff \t\r\n")
+    if stripped.startswith(("{", "[")):
+        data = json.loads(stripped)
+        if isinstance(data, dict):
+            for ticker, value in data.items():
+                if isinstance(value, dict):
+                    entries.append((ticker, value.get("price"), value.get("as_of")))
+                else:
+                    entries.append((ticker, value, None))
+        else:
+            for item in data:
+                if not isinstance(item, dict):
+                    raise ValueError("quotes JSON list items must be objects")
+                entries.append((item.get("ticker") or item.get("symbol"), item.get("price"), item.get("as_of")))
+    else:
+        reader = csv.DictReader(io.StringIO(stripped))
+        by_lower = {name.strip().lower(): name for name in reader.fieldnames or []}
+        columns = {field: next((by_lower[c] for c in candidates if c in by_lower), None)
+                   for field, candidates in _PRICE_COLUMNS.items()}
+        if columns["ticker"] is None or columns["price"] is None:
+            raise ValueError("quotes CSV needs ticker (or symbol) and price (or last/close) columns")
+        entries.extend((r[columns["ticker"]], r[columns["price"]], r[columns["as_of"]] if columns["as_of"] else None)
+                       for r in reader)
+
+    quotes: Dict[str, Quote] = {}
+    skipped: List[str] = []
+    for ticker, price, as_of in entries:
+        try:
+            ticker = str(ticker or "").strip().upper()
+            if not ticker:
+                raise ValueError("empty ticker")
+            value = _import_number(str(price if price is not None else ""))
+            # NaN/Infinity, 그리고 정밀도를 넘는 크기(1e400 등)는 평가 금액을 의미 없게 만든다
+            if not value.is_finite() or value.adjusted() >= getcontext().prec:
+                raise ValueError(f"price out of range '{price}'")
+            if value <= 0:
+                raise ValueError(f"price must be positive, got {value}")
+            ts, iso = _quote_time(as_of, mtime)
+        except (ValueError, InvalidOperation) as e:
+            skipped.append(f"{ticker or '?'}: {e}")
+            continue
+        if ticker not in quotes or ts >= quotes[ticker].ts:
+            quotes[ticker] = Quote(value, ts, iso)
+    return quotes, skipped
+
+
+def cmd_prices(args: argparse.Namespace) -> None:
+    """FILE 이 있으면 시세 캐시에 합치고, 없으면 캐시의 시세와 경과 시간을 보여준다."""
+    quotes = dict(load_prices())
+    if args.file is None:
+        if not quotes:
+            print("No cached quotes; load a quotes file with `prices FILE`.")
+            return
+        now = _now()
+        print("Ticker | Last | As of | Age")
+        print("-" * 50)
+        for ticker in sorted(quotes):
+            q = quotes[ticker]
+            age = now - q.ts
+            flag = " (stale)" if age > PRICE_STALE_SECONDS else ""
+            print(f"{ticker:<6} | {q.price:.2f} | {q.as_of} | {age / 3600:.1f}h{flag}")
+        return
+
+    try:
+        if args.file == "-":
+            text, mtime = sys.stdin.read(), _now()
+        else:
+            with open(args.file, encoding="utf-8-sig") as f:
+                text, mtime = f.read(), os.fstat(f.fileno()).st_mtime
+        fresh, skipped = _read_quotes(text, mtime)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Prices skipped: {e}")
+        return
+
+    updated = 0
+    for ticker, q in fresh.items():
+        if ticker not in quotes or q.ts >= quotes[ticker].ts:
+            quotes[ticker] = q
+            updated += 1
+    _write_json_atomic(_prices_path(), {
+        "version": PRICES_VERSION,
+        "quotes": {t: {"price": str(q.price), "as_of": q.as_of, "ts": q.ts} for t, q in sorted(quotes.items())},
+    })
+    print(f"💹 Prices: {updated} quote(s) updated, {len(fresh) - updated} older than the cache, "
+          f"{len(skipped)} skipped.")
+    for reason in skipped[:20]:
+        print(f"⚠️ {reason}")
+
+
+def _quotes_for(args: argparse.Namespace) -> Dict[str, Quote]:
+    """읽기 명령 공통: 현재 시세는 과거 시점(--as-of) 포트폴리오에는 붙이지 않는다"""
+    return {} if getattr(args, "as_of", None) else load_prices()
+
+
+def _portfolio_for(args: argparse.Namespace) -> Tuple[Dict[str, Dict[int, Lot]], Dict[str, Decimal]]:
+    """읽기 명령 공통: --as-of 가 있으면 그날 장 마감 기준 포트폴리오, 없으면 현재"""
+    as_of = getattr(args, "as_of", None)
+    if as_of:
+        print(f"🕰️ As of {as_of}\n")
+        return load_portfolio_as_of(as_of)
+    return load_portfolio()
+
+
+def cmd_status(args: argparse.Namespace) -> None:
+    positions, _ = _portfolio_for(args)
+    print_status(positions, _quotes_for(args))
+
+
+def cmd_report(args: argparse.Namespace) -> None:
+    positions, realized = _portfolio_for(args)
+    print_report(positions, realized, _quotes_for(args))
+
+
+def cmd_summary(args: argparse.Namespace) -> None:
+    positions, realized = _portfolio_for(args)
+    quotes = _quotes_for(args)
+    print_status(positions, quotes)
+    print_report(positions, realized, quotes)
+
+
+def cmd_history(args: argparse.Namespace) -> None:
+    """
+    lot 하나의 이벤트 체인: 생성 → 매도(건별 실현 손익) / 스탑 이동 / 분할(새 lot) → 현재 상태.
+    build_portfolio 와 같은 규칙으로 그 lot 만 따라간다 (청산 뒤의 행, 다른 티커의 행은 무시된 것으로 표시).
+    """
+    rows = lot_history(args.id)
+    head = next((r for r in rows if r.id == args.id), None)
+    if head is None or head.qty <= 0:
+        print(f"⚠️ history skipped: lot id={args.id} not found")
+        return
+
+    lot = Lot(head.id, head.ticker, head.qty, head.price, head.stop)
+    total = Decimal("0")
+    origin = f" (split from lot id={head.target})" if head.target is not None else ""
+    print(f"📜 Lot ID={lot.id} [{lot.ticker}]{origin}\n")
+    print(f"{head.date} #{head.id:<6} BUY   | Qty={head.qty} | In={head.price:.2f} | Stop={head.stop:.2f}")
+    for r in rows:
+        if r.id == head.id:
+            continue
+        line = f"{r.date} #{r.id:<6}"
+        if r.qty > 0:
+            # 분할로 생긴 새 lot (원래 lot 상태와 무관하게 생긴다)
+            print(f"{line} CHILD | Lot ID={r.id} | Qty={r.qty} | In={r.price:.2f} | Stop={r.stop:.2f}")
+        elif r.ticker != lot.ticker:
+            print(f"{line} {'TRIM ' if r.qty < 0 else 'STOP '} | ignored: ticker {r.ticker} does not match")
+        elif lot.qty == 0:
+            print(f"{line} {'TRIM ' if r.qty < 0 else 'STOP '} | ignored: lot already closed")
+        elif r.qty < 0:
+            sell_qty = min(-r.qty, lot.qty)
+            pl = sell_qty * (r.price - lot.price)
+            total += pl
+            lot.qty -= sell_qty
+            kind = "SPLIT" if r.note.startswith("split from") else "TRIM "
+            print(f"{line} {kind} | Qty=-{sell_qty} @ {r.price:.2f} | P/L={pl:.2f} | Left={lot.qty}")
+        else:
+            print(f"{line} STOP  | Stop={lot.stop:.2f} → {r.stop:.2f}")
+            lot.stop = r.stop
 
-def cmd_report(_: argparse.Namespace) -> None:
-    rows = load_rows()
-    positions, realized = build_portfolio(rows)
-    print_report(positions, realized)
+    state = f"Open | Qty={lot.qty} | Stop={lot.stop:.2f} | Risk=${lot.risk():.2f}" if lot.qty else "Closed"
+    print(f"\n{state} | Realized P/L={total:.2f}")
 
+def _legacy_target_id(r: Dict[str, str]) -> str:
+    """구 스키마 행의 target_id 값: 매도/스탑 행은 note 의 id=N, split 으로 생긴 lot 은 원래 lot id"""
+    target = _legacy_target(r["qty"], r.get("note") or "")
+    return "" if target is None else str(target)
+
+
+@_exclusive
+def cmd_migrate(_: argparse.Namespace) -> None:
+    """
+    구 스키마 원장을 target_id 컬럼이 있는 스키마로 한 번의 스트리밍 패스로 다시 쓴다.
+    매도/스탑 행은 note 의 id=N, split 으로 생긴 lot 은 원래 lot id 를 target_id 로 채운다.
+    """
+    if _backend().name != "csv":
+        print("Sharded and SQLite ledgers always use the target_id schema; nothing to migrate.")
+        return
+    ensure_csv()
+    header = read_header()
+    if "target_id" in header:
+        print("Ledger already has a target_id column; nothing to migrate.")
+        return
+
+    tmp = DATA_PATH.with_name(DATA_PATH.name + ".tmp")
+    count = 0
+    with DATA_PATH.open(newline="") as src, tmp.open("w", newline="") as dst:
+        reader = csv.DictReader(src)
+        writer = csv.DictWriter(dst, fieldnames=HEADER, extrasaction="ignore")
+        writer.writeheader()
+        for r in reader:
+            r["target_id"] = _legacy_target_id(r)
+            writer.writerow(r)
+            count += 1
+        dst.flush()
+        os.fsync(dst.fileno())
+    # 원자적으로 교체. 체크포인트/메타는 digest·stat 불일치로 자동 무효화된다
+    os.replace(tmp, DATA_PATH)
+    print(f"Migrated {count} rows to the target_id schema.")
+
+
+@_exclusive
+def cmd_convert(args: argparse.Namespace) -> None:
+    """
+    단일 CSV ↔ 티커별 샤드, 단일 CSV ↔ SQLite 변환. 한 번의 스트리밍 패스로 새 레이아웃을
+    임시 경로에 쓰고 바꿔 넣은 뒤, 원래 원장은 지우지 않고 .bak 으로 옮겨 둔다 (감사 기록 보존).
+    """
+    current = _backend().name
+    if args.to == current:
+        print({"sharded": "Ledger is already sharded.", "sqlite": "Ledger is already a SQLite database.",
+               "csv": "Ledger is already a single CSV."}[current])
+        return
+    if "csv" not in (current, args.to):
+        print(f"⚠️ Convert skipped: convert the {current} ledger to csv first.")
+        return
+    # 컴팩션된 원장은 베이스라인/아카이브가 파일별이라 행만 옮겨서는 같은 결과가 안 나온다
+    if any(_sidecar_path("baseline.json", path).exists() for path in _ledger_files()):
+        print("⚠️ Convert skipped: the ledger has been compacted; convert before compacting.")
+        return
+    if args.to == "sharded":
+        count = _convert_to_shards()
+    elif args.to == "sqlite":
+        count = _convert_to_sqlite()
+    elif current == "sqlite":
+        count = _sqlite_to_csv()
+    else:
+        count = _convert_to_csv()
+    if count is not None:
+        print(f"Converted {count} rows to the {args.to} layout.")
+
+
+def _convert_to_shards() -> Optional[int]:
+    import shutil
+
+    shard_dir = _shard_dir()
+    tmp_dir = shard_dir.with_name(shard_dir.name + ".tmp")
+    backup = DATA_PATH.with_name(DATA_PATH.name + ".bak")
+    for path in (shard_dir, backup):
+        if path.exists():
+            print(f"⚠️ Convert skipped: {path} already exists; move it away first.")
+            return None
+    shutil.rmtree(tmp_dir, ignore_errors=True)  # 이전에 중단된 변환의 잔여물
+    tmp_dir.mkdir()
+
+    tickers: Dict[str, str] = {}
+    handles: Dict[str, Any] = {}
+    writers: Dict[str, Any] = {}
+    last_id = 0
+    count = 0
+
+    def close_all() -> None:
+        for f in handles.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        handles.clear()
+        writers.clear()
+
+    try:
+        with DATA_PATH.open(newline="") as src:
+            reader = csv.DictReader(src)
+            legacy = "target_id" not in (reader.fieldnames or [])
+            for r in reader:
+                if legacy:
+                    r["target_id"] = _legacy_target_id(r)
+                ticker = r["ticker"]
+                writer = writers.get(ticker)
+                if writer is None:
+                    if len(handles) >= 256:  # 티커가 아주 많아도 열린 파일 수는 제한
+                        close_all()
+                    new = ticker not in tickers
+                    if new:
+                        tickers[ticker] = _shard_file_name(ticker, tickers.values())
+                    f = handles[ticker] = (tmp_dir / tickers[ticker]).open("a", newline="")
+                    writer = writers[ticker] = csv.DictWriter(f, fieldnames=HEADER, extrasaction="ignore")
+                    if new:
+                        writer.writeheader()
+                writer.writerow(r)
+                last_id = max(last_id, int(r["id"]))
+                count += 1
+    finally:
+        close_all()
+    _write_json_atomic(tmp_dir / "manifest.json", {"version": SHARD_VERSION, "last_id": last_id, "tickers": tickers})
+
+    os.replace(tmp_dir, shard_dir)
+    os.replace(DATA_PATH, backup)
+    print(f"Original ledger kept as {backup}")
+    return count
+
+
+def _convert_to_csv() -> Optional[int]:
+    shard_dir = _shard_dir()
+    backup = shard_dir.with_name(shard_dir.name + ".bak")
+    for path in (DATA_PATH, backup):
+        if path.exists():
+            print(f"⚠️ Convert skipped: {path} already exists; move it away first.")
+            return None
+
+    tmp = DATA_PATH.with_name(DATA_PATH.name + ".tmp")
+    count = 0
+    with tmp.open("w", newline="") as dst:
+        writer = csv.DictWriter(dst, fieldnames=HEADER, extrasaction="ignore")
+        writer.writeheader()
+        for r in _merged_shard_rows():
+            writer.writerow(r)
+            count += 1
+        dst.flush()
+        os.fsync(dst.fileno())
+
+    os.replace(tmp, DATA_PATH)
+    os.replace(shard_dir, backup)
+    print(f"Original shards kept in {backup}")
+    return count
+
+def _convert_to_sqlite() -> Optional[int]:
+    import sqlite3
+
+    db_path = _db_path()
+    tmp = db_path.with_name(db_path.name + ".tmp")
+    backup = DATA_PATH.with_name(DATA_PATH.name + ".bak")
+    for path in (db_path, backup):
+        if path.exists():
+            print(f"⚠️ Convert skipped: {path} already exists; move it away first.")
+            return None
+    tmp.unlink(missing_ok=True)  # 이전에 중단된 변환의 잔여물
+
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.executescript(_SQLITE_SCHEMA)
+        with DATA_PATH.open(newline="") as src, conn:
+            reader = csv.DictReader(src)
+            rows: Iterable[Dict[str, str]] = reader
+            if "target_id" not in (reader.fieldnames or []):
+                rows = ({**r, "target_id": _legacy_target_id(r)} for r in reader)
+            conn.executemany(_SQLITE_INSERT, map(_sqlite_params, rows))
+        conn.executescript(_SQLITE_INDEXES)
+        conn.execute("PRAGMA journal_mode=WAL")  # DB 파일에 기록되어 이후 연결에도 유지된다
+        count = conn.execute("SELECT count(*) FROM trades").fetchone()[0]
+    except sqlite3.IntegrityError as e:
+        conn.close()
+        tmp.unlink()
+        print(f"⚠️ Convert skipped: {e} (the ledger has duplicate row ids).")
+        return None
+    conn.close()
+
+    os.replace(tmp, db_path)
+    os.replace(DATA_PATH, backup)
+    print(f"Original ledger kept as {backup}")
+    return count
+
+
+def _sqlite_to_csv() -> Optional[int]:
+    db_path = _db_path()
+    backup = db_path.with_name(db_path.name + ".bak")
+    for path in (DATA_PATH, backup):
+        if path.exists():
+            print(f"⚠️ Convert skipped: {path} already exists; move it away first.")
+            return None
+
+    tmp = DATA_PATH.with_name(DATA_PATH.name + ".tmp")
+    count = 0
+    with tmp.open("w", newline="") as dst:
+        writer = csv.DictWriter(dst, fieldnames=HEADER, extrasaction="ignore")
+        writer.writeheader()
+        for r in _sqlite_rows():
+            writer.writerow(r)
+            count += 1
+        dst.flush()
+        os.fsync(dst.fileno())
+
+    # 연결을 닫으면 WAL 이 DB 파일로 합쳐지고 -wal/-shm 파일이 사라진다
+    _close_db()
+    os.replace(tmp, DATA_PATH)
+    os.replace(db_path, backup)
+    print(f"Original database kept as {backup}")
+    return count
+
+
+def _ledger_files() -> List[Path]:
+    """지금 레이아웃의 원장 파일들: 단일 CSV 또는 manifest 순서의 샤드들 (SQLite 는 없음)"""
+    return _backend().files()
+
+
+@_exclusive
+def cmd_compact(args: argparse.Namespace) -> None:
+    """
+    완전히 청산된 lot 의 행(매수, 그 lot 을 대상으로 한 매도/스탑)을 아카이브 세그먼트로 옮기고,
+    원장에는 열린 lot 의 행만 남긴다. --verify 는 아카이브 + 원장이 베이스라인과 맞는지 검사한다.
+    샤드 레이아웃이면 샤드마다 따로 컴팩션한다.
+    """
+    if _backend().name == "sqlite":
+        print("⚠️ Compact skipped: compaction works on CSV ledgers; the SQLite layout replays by index instead.")
+        return
+    paths = _ledger_files()
+    if args.verify:
+        checked = 0
+        for path in paths:
+            problems = _verify_compaction(path)
+            if problems is None:
+                continue
+            checked += 1
+            for problem in problems:
+                print(f"⚠️ {path.name}: {problem}")
+            if not problems:
+                print(f"✅ {path.name}: archive and ledger agree with the compaction baseline.")
+        if not checked:
+            print("Ledger has not been compacted; nothing to verify.")
+        return
+
+    archived = kept = 0
+    for path in paths:
+        moved, remaining = _compact_file(path)
+        archived += moved
+        kept += remaining
+    if not archived:
+        print("Nothing to compact: no fully closed lots in the ledger.")
+        return
+    print(f"Compacted: {archived} row(s) of closed lots archived, {kept} row(s) remain in the ledger.")
+
+
+def _compact_file(path: Path) -> Tuple[int, int]:
+    """원장 파일 하나를 컴팩션하고 (아카이브로 옮긴 행 수, 원장에 남은 행 수) 를 돌려준다."""
+    old = load_baseline(path)
+    # 현재 상태는 체크포인트(다른 엔진이 만들었을 수 있음) 대신 Decimal 전체 리플레이로 정확히 구한다
+    with path.open("rb") as f:
+        positions, realized = build_portfolio(parse_rows(line.decode("utf-8") for line in f),
+                                              *_baseline_state(old)[:2])
+    open_lots = {(ticker, lot_id) for ticker, lots in positions.items() for lot_id in lots}
+
+    archive = _archive_path(path)
+    archive_bytes = old["archive"]["bytes"] if old else 0
+    archive_rows = old["archive"]["rows"] if old else 0
+    # 지난번에 중단된 컴팩션이 아카이브 끝에 남긴 행은 버린다 (베이스라인에 반영되지 않은 행)
+    if archive.exists() and archive.stat().st_size > archive_bytes:
+        with archive.open("r+b") as f:
+            f.truncate(archive_bytes)
+
+    base_positions, base_realized, last_id = _baseline_state(old)
+    # 베이스라인에 없던 새 티커도 전체 리플레이와 같은 순서(처음 나온 순서)로 자리를 잡는다
+    for ticker in positions:
+        base_positions.setdefault(ticker, {})
+        base_realized.setdefault(ticker, Decimal("0"))
+
+    tmp = path.with_name(path.name + ".tmp")
+    moved = kept = 0
+    with path.open(newline="") as src, tmp.open("w", newline="") as dst, archive.open("a", newline="") as arc:
+        reader = csv.DictReader(src)
+        fieldnames = reader.fieldnames or HEADER
+        legacy = "target_id" not in fieldnames
+        live = csv.DictWriter(dst, fieldnames=fieldnames, extrasaction="ignore")
+        live.writeheader()
+        # 아카이브는 원장 스키마와 관계없이 항상 target_id 스키마로 쌓는다
+        archived = csv.DictWriter(arc, fieldnames=HEADER, extrasaction="ignore")
+        if not archive_bytes:
+            archived.writeheader()
+
+        def closed_rows() -> Iterator[TradeRow]:
+            nonlocal moved, kept, last_id
+            for r in reader:
+                if legacy:
+                    r["target_id"] = _legacy_target_id(r)
+                last_id = max(last_id, int(r["id"]))
+                qty = Decimal(r["qty"])
+                lot_id = int(r["id"]) if qty > 0 else int(r["target_id"]) if r["target_id"] else None
+                if (r["ticker"], lot_id) in open_lots:
+                    live.writerow(r)
+                    kept += 1
+                else:
+                    # 열린 lot 과 무관한 행: 청산된 lot 의 행, 그리고 대상이 없어 리플레이가 무시하는 행
+                    archived.writerow(r)
+                    moved += 1
+                    yield _to_trade_row(r)
+
+        base_positions, base_realized = build_portfolio(closed_rows(), base_positions, base_realized)
+        for f in (dst, arc):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def abort(reason: str) -> Tuple[int, int]:
+        tmp.unlink()
+        if archive_bytes:
+            with archive.open("r+b") as f:
+                f.truncate(archive_bytes)
+        else:
+            archive.unlink()
+        if reason:
+            print(f"⚠️ Compact skipped for {path.name}: {reason}")
+        return 0, moved + kept
+
+    if not moved:
+        return abort("")
+    # 옮긴 행만 리플레이하면 모든 lot 이 닫혀 있어야 하고, 베이스라인 + 남긴 행 = 지금 상태여야 한다
+    if any(base_positions.values()):
+        return abort("archived rows leave open lots (duplicate lot ids?)")
+    with tmp.open("rb") as f:
+        check = build_portfolio(parse_rows(line.decode("utf-8") for line in f),
+                                *_copy_portfolio(base_positions, base_realized))
+    if _encode_state(*check) != _encode_state(positions, realized):
+        return abort("baseline + remaining rows would not reproduce the current portfolio")
+
+    baseline = {
+        "version": BASELINE_VERSION,
+        "generation": (old["generation"] if old else 0) + 1,
+        "last_id": last_id,
+        "tickers": list(base_positions),
+        "realized": {ticker: str(pl) for ticker, pl in base_realized.items()},
+        "open_lots": sorted(lot_id for _, lot_id in open_lots),
+        "archive": {"rows": archive_rows + moved, "bytes": archive.stat().st_size, "sha1": _file_sha1(archive)},
+        "active_sha1": _file_sha1(tmp),
+    }
+    # 베이스라인(.next) → 원장 교체 → 베이스라인 확정. 중간에 죽으면 _finish_compaction 이 정리한다
+    pending = _sidecar_path("baseline.json.next", path)
+    _write_json_atomic(pending, baseline)
+    _sidecar_path("ckpt.json", path).unlink(missing_ok=True)
+    _STATE.pop(path, None)
+    os.replace(tmp, path)
+    os.replace(pending, _sidecar_path("baseline.json", path))
+    if path == DATA_PATH:
+        _save_meta(last_id, path.stat())
+    return moved, kept
+
+
+def _verify_compaction(path: Path) -> Optional[List[str]]:
+    """
+    아카이브가 베이스라인이 기록한 그대로인지, 아카이브 + 원장 = 베이스라인 + 원장 인지 검사해
+    문제 목록을 돌려준다. 컴팩션된 적 없는 파일이면 None
+    """
+    import heapq
+
+    baseline = load_baseline(path)
+    if not baseline:
+        return None
+    archive = _archive_path(path)
+    expected = baseline["archive"]
+    if not archive.exists() or archive.stat().st_size < expected["bytes"]:
+        return [f"archive {archive.name} is missing or truncated"]
+    problems = []
+    if archive.stat().st_size > expected["bytes"]:
+        problems.append(f"archive has {archive.stat().st_size - expected['bytes']} trailing byte(s) from an "
+                        f"interrupted compaction (dropped by the next compact)")
+    if _file_sha1(archive, expected["bytes"]) != expected["sha1"]:
+        return problems + [f"archive {archive.name} was modified after compaction (sha1 mismatch)"]
+
+    with archive.open("rb") as f:
+        archive_rows = list(parse_rows(line.decode("utf-8") for line in f.read(expected["bytes"]).splitlines(True)))
+    if len(archive_rows) != expected["rows"]:
+        problems.append(f"archive has {len(archive_rows)} rows, baseline recorded {expected['rows']}")
+
+    # 아카이브만 리플레이: 모든 lot 이 닫히고 실현 손익이 베이스라인과 같아야 한다
+    archived_positions, archived_realized = build_portfolio(archive_rows)
+    still_open = sorted(lot_id for lots in archived_positions.values() for lot_id in lots)
+    if still_open:
+        problems.append(f"archived lots still open: {still_open[:10]}")
+    for ticker in set(archived_realized) | set(baseline["realized"]):
+        if archived_realized.get(ticker, Decimal("0")) != Decimal(baseline["realized"].get(ticker, "0")):
+            problems.append(f"{ticker} realized P/L differs between archive and baseline")
+    archived_ids = {r.id for r in archive_rows}
+    reopened = [lot_id for lot_id in baseline["open_lots"] if lot_id in archived_ids]
+    if reopened:
+        problems.append(f"lots open at compaction time found in the archive: {reopened[:10]}")
+
+    # 감사 기록 전체(아카이브 + 원장, id 순)를 처음부터 리플레이한 결과 = 평소 리플레이 결과
+    with path.open("rb") as f:
+        live_rows = list(parse_rows(line.decode("utf-8") for line in f))
+    history = build_portfolio(heapq.merge(archive_rows, live_rows, key=lambda r: r.id))
+    compacted = build_portfolio(live_rows, *_baseline_state(baseline)[:2])
+    if _encode_state(*history) != _encode_state(*compacted):
+        problems.append("replaying archive + ledger does not match baseline + ledger")
+    return problems
+
+
+"""
+상주 데몬: `tradingbook serve` 가 리플레이된 포트폴리오를 메모리에 들고 있고,
+일반 CLI 호출은 argv 를 유닉스 소켓(data/trades.sock)으로 넘겨 결과 출력만 받아 온다.
+새로 붙은 행은 load_portfolio() 의 프로세스 내 상태(_STATE)로 증분 반영된다.
+데몬이 없으면(소켓 없음/연결 실패) 지금처럼 프로세스 안에서 바로 실행한다.
+
+프로토콜: 요청/응답 모두 JSON 한 줄
+  → {"argv": [...], "cwd": "..."}
+  ← {"stdout": "...", "stderr": "...", "code": 0}
+"""
+# 데몬으로 넘기지 않고 항상 직접 실행하는 명령
+_LOCAL_COMMANDS = {"serve", "shell"}
+# 값을 하나 받는 전역 옵션 (명령 이름을 찾을 때 건너뛰기 위함)
+_GLOBAL_VALUE_OPTIONS = {"--engine", "--qty-digits", "--price-digits", "--jobs", "--profile", "--timings-format"}
+# 이 프로세스 자체를 재야 하는 옵션: 데몬으로 넘기지 않는다
+_LOCAL_OPTIONS = {"--timings", "--profile"}
+
+
+def _socket_path() -> Path:
+    return _sidecar_path("sock")
+
+
+def _command_name(argv: List[str]) -> Optional[str]:
+    """argv 에서 전역 옵션을 건너뛰고 서브 명령 이름을 찾는다."""
+    skip = False
+    for token in argv:
+        if skip:
+            skip = False
+        elif token in _GLOBAL_VALUE_OPTIONS:
+            skip = True
+        elif not token.startswith("-"):
+            return token
+    return None
+
+
+def forward_to_daemon(argv: List[str]) -> Optional[int]:
+    """
+    데몬이 떠 있으면 argv 를 넘겨 실행하고 종료 코드를 반환한다.
+    데몬이 없으면 None → 호출한 쪽이 프로세스 안에서 실행한다.
+    """
+    if os.environ.get("TRADINGBOOK_NO_DAEMON"):
+        return None
+    command = _command_name(argv)
+    if command is None or command in _LOCAL_COMMANDS or _LOCAL_OPTIONS.intersection(argv):
+        return None
+    rest = argv[argv.index(command) + 1:]
+    if (command == "batch" and rest in ([], ["-"])) or (command in ("import", "prices") and "-" in rest):
+        return None  # stdin 은 데몬으로 넘길 수 없다
+    path = _socket_path()
+    if not path.exists():
+        return None  # 데몬이 없는 보통의 경우: socket 모듈도 올리지 않는다
+    import socket
+
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+
+    request = json.dumps({"argv": argv, "cwd": os.getcwd()}).encode("utf-8") + b"\n"
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(str(path))
+    except OSError:
+        return None  # 죽은 데몬이 남긴 소켓 파일 → 로컬 실행
+    with sock, sock.makefile("rwb") as stream:
+        stream.write(request)
+        stream.flush()
+        line = stream.readline()
+    if not line:
+        # 요청은 이미 넘어갔으므로 로컬에서 다시 실행하면 행이 두 번 기록될 수 있다
+        print("⚠️ Daemon closed the connection before replying; check the ledger before retrying.",
+              file=sys.stderr)
+        return 1
+    response = json.loads(line)
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["code"]
+
+
+def _run_captured(argv: List[str]) -> Dict[str, Any]:
+    """데몬 안에서 명령 하나를 실행하고 stdout/stderr/종료 코드를 모아 돌려준다."""
+    import contextlib
+    import traceback
+
+    out, err = io.StringIO(), io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            main(argv)
+        except SystemExit as e:  # argparse 오류, --help 등
+            if isinstance(e.code, str):
+                print(e.code, file=err)
+            code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:  # 명령 하나가 실패해도 데몬은 계속 떠 있어야 한다
+            traceback.print_exc(file=err)
+            code = 1
+    return {"stdout": out.getvalue(), "stderr": err.getvalue(), "code": code}
+
+
+def _handle_client(conn: socket.socket) -> None:
+    with conn, conn.makefile("rwb") as stream:
+        try:
+            request = json.loads(stream.readline())
+            argv = [str(a) for a in request["argv"]]
+        except (ValueError, KeyError, TypeError):
+            return
+        if _command_name(argv) in _LOCAL_COMMANDS:
+            response = {"stdout": "", "stderr": "⚠️ This command cannot run through the daemon.\n", "code": 2}
+        else:
+            cwd = os.getcwd()
+            try:
+                os.chdir(request.get("cwd") or cwd)  # 상대 경로 인자는 클라이언트 기준
+                response = _run_captured(argv)
+            finally:
+                os.chdir(cwd)
+        stream.write(json.dumps(response).encode("utf-8") + b"\n")
+        stream.flush()
+
+
+def cmd_serve(args: argparse.Namespace) -> None:
+    import signal
+    import socket
+
+    if not hasattr(socket, "AF_UNIX"):
+        print("⚠️ serve needs Unix domain sockets, which this platform does not provide.")
+        return
+    path = _socket_path()
+    if path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(path))
+        except OSError:
+            path.unlink()  # 이전 데몬이 남긴 소켓 파일
+        else:
+            probe.close()
+            print(f"⚠️ A daemon is already serving {DATA_PATH} on {path}.")
+            return
+
+    # 먼저 한 번 리플레이해 두어 첫 요청부터 메모리 상태를 쓰게 한다
+    load_portfolio()
+
+    def stop(*_: Any) -> None:
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(str(path))
+        server.listen(16)
+        print(f"Serving {DATA_PATH} on {path} (Ctrl-C to stop)", flush=True)
+        while True:
+            conn, _ = server.accept()
+            _handle_client(conn)  # 한 번에 한 명령씩: 쓰기 명령끼리 섞이지 않는다
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        path.unlink(missing_ok=True)
+
+def cmd_shell(_: argparse.Namespace) -> None:
+    """
+    대화형 셸: 파서는 한 번만 만들고, 포트폴리오는 _STATE 로 명령 간에 메모리에 유지한다.
+    명령이 덧붙인 행은 다음 명령에서 꼬리만 증분 반영된다.
+    """
+    import shlex
+
+    parser = build_parser()
+    try:
+        import importlib
+
+        importlib.import_module("readline")  # 불러오기만 해도 input() 에 방향키/히스토리가 붙는다
+    except ImportError:
+        pass
+
+    load_portfolio()
+    print("TradingBook shell — enter a subcommand (e.g. 'status'), 'help' or 'exit'.")
+    while True:
+        try:
+            line = input("tradingbook> ")
+        except EOFError:
+            print()
+            break
+        except KeyboardInterrupt:
+            print()
+            continue
+
+        try:
+            argv = shlex.split(line)
+        except ValueError as e:
+            print(f"⚠️ {e}")
+            continue
+        if not argv:
+            continue
+        if argv[0] in ("exit", "quit"):
+            break
+        if argv[0] == "help":
+            parser.print_help()
+            continue
+        if _command_name(argv) in _LOCAL_COMMANDS:
+            print(f"⚠️ '{_command_name(argv)}' cannot be run inside the shell.")
+            continue
+
+        try:
+            dispatch(parser, argv)
+        except SystemExit:
+            pass  # argparse 가 이미 오류/도움말을 출력했다
+        except Exception as e:  # 잘못된 숫자 등으로 셸이 죽지 않게
+            print(f"⚠️ {type(e).__name__}: {e}")
+
+"""
+계측: 전역 옵션 --timings / --profile 이 있을 때만 아래 함수들을 시간을 재는 래퍼로
+모듈 전역에서 바꿔 끼우고, 명령이 끝나면 원래 함수로 되돌린다.
+모듈 안의 호출도 전역 이름으로 함수를 찾으므로 래퍼를 거친다.
+옵션이 없으면 dispatch() 의 if 하나 외에는 아무것도 바뀌지 않는다.
+
+각 단계 시간은 자기 자신만의 시간(exclusive)이다: build_portfolio 안에서 소비되는
+parse_rows 제너레이터의 시간(CSV 파싱 + 숫자 변환)은 parse_rows 로만 잡힌다.
+"""
+_TIMED_FUNCTIONS = (
+    "ensure_csv",
+    "load_rows",
+    "parse_rows",
+    "load_checkpoint",
+    "save_checkpoint",
+    "load_portfolio",
+    "load_lot",
+    "indexed_rows",
+    "load_portfolio_as_of",
+    "lot_history",
+    "build_portfolio",
+    "build_portfolio_fixed",
+    "next_row_id",
+    "append_rows",
+    "print_status",
+    "print_report",
+)
+
+
+class _PhaseTimer:
+    """함수별 호출 수와 exclusive 시간을 모은다 (중첩 호출은 부모 시간에서 뺀다)."""
+
+    def __init__(self) -> None:
+        import time
+
+        self.clock = time.perf_counter
+        self.seconds: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.children = [0.0]  # 호출 스택마다 자식들이 쓴 시간
+
+    def run(self, name: str, fn: Any, *args: Any, **kwargs: Any) -> Any:
+        self.children.append(0.0)
+        start = self.clock()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = self.clock() - start
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - self.children.pop()
+            self.children[-1] += elapsed
+
+    def wrap(self, name: str, fn: Any) -> Any:
+        import inspect
+
+        if inspect.isgeneratorfunction(fn):
+            # 제너레이터는 만들 때가 아니라 next() 마다 시간을 잰다
+            def timed_generator(*args: Any, **kwargs: Any) -> Iterator[Any]:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                it = fn(*args, **kwargs)
+                while True:
+                    try:
+                        item = self.run(name, next, it)
+                    except StopIteration:
+                        return
+                    yield item
+            return timed_generator
+
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return self.run(name, fn, *args, **kwargs)
+        return timed
+
+
+def _run_instrumented(args: argparse.Namespace) -> None:
+    """--timings / --profile 이 붙은 명령 실행. 결과는 명령 출력과 섞이지 않게 stderr 로 낸다."""
+    import time
+
+    timer = _PhaseTimer() if args.timings else None
+    originals = {name: globals()[name] for name in _TIMED_FUNCTIONS} if timer else {}
+    for name, fn in originals.items():
+        globals()[name] = timer.wrap(name, fn)
+
+    report: Dict[str, Any] = {"command": args.command}
+    start = time.perf_counter()
+    try:
+        if args.profile == "cprofile":
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.runcall(args.func, args)
+        elif args.profile == "tracemalloc":
+            import tracemalloc
+
+            tracemalloc.start()
+            try:
+                args.func(args)
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        else:
+            args.func(args)
+    finally:
+        report["total_s"] = time.perf_counter() - start
+        globals().update(originals)  # 셸/데몬의 다음 명령은 원래 함수로
+
+    if timer:
+        report["phases"] = {
+            name: {"seconds": timer.seconds[name], "calls": timer.calls.get(name, 0)}
+            for name in sorted(timer.seconds, key=timer.seconds.__getitem__, reverse=True)
+        }
+        report["other_s"] = report["total_s"] - sum(timer.seconds.values())
+    if args.profile == "cprofile":
+        import pstats
+
+        stats = pstats.Stats(profiler)
+        top = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:25]  # type: ignore[attr-defined]
+        report["profile"] = [
+            {"function": f"{path}:{line}({func})", "calls": nc, "tottime": tt, "cumtime": ct}
+            for (path, line, func), (_, nc, tt, ct, _) in top
+        ]
+    elif args.profile == "tracemalloc":
+        report["memory"] = {
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                {"where": str(stat.traceback[0]), "size": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:15]
+            ],
+        }
+
+    if args.timings_format == "json":
+        print(json.dumps(report, indent=2), file=sys.stderr)
+        return
+
+    err = sys.stderr
+    print(f"\n⏱️ {args.command}: {report['total_s'] * 1e3:.2f} ms total", file=err)
+    if timer:
+        print(f"{'phase':<22} {'calls':>6} {'ms':>10} {'%':>6}", file=err)
+        total = report["total_s"] or 1.0
+        for name, phase in report["phases"].items():
+            print(f"{name:<22} {phase['calls']:>6} {phase['seconds'] * 1e3:>10.2f} "
+                  f"{phase['seconds'] / total * 100:>5.1f}%", file=err)
+        print(f"{'(other)':<22} {'':>6} {report['other_s'] * 1e3:>10.2f} "
+              f"{report['other_s'] / total * 100:>5.1f}%", file=err)
+    if args.profile == "cprofile":
+        print(f"\n{'ncalls':>9} {'tottime':>9} {'cumtime':>9}  function (top 25 by cumtime)", file=err)
+        for entry in report["profile"]:
+            print(f"{entry['calls']:>9} {entry['tottime']:>9.4f} {entry['cumtime']:>9.4f}  {entry['function']}",
+                  file=err)
+    elif args.profile == "tracemalloc":
+        memory = report["memory"]
+        print(f"\n🧠 peak {memory['peak_bytes'] / 1024:.1f} KiB, still allocated "
+              f"{memory['current_bytes'] / 1024:.1f} KiB; top allocation sites:", file=err)
+        for entry in memory["top"]:
+            print(f"{entry['size'] / 1024:>10.1f} KiB {entry['count']:>8}  {entry['where']}", file=err)
+
+
+# 서브 명령 → 한 줄 도움말. 순서가 곧 usage 의 명령 목록 순서다
+_COMMAND_HELP = {
+    "add": "Add a new lot (buy)",
+    "trim": "Sell part of a lot (partial exit)",
+    "close": "Close an entire lot (full exit)",
+    "stop": "Move stop loss for a specific lot",
+    "split": "Split a lot into multiple lots",
+    "report": "Display portfolio summary and P/L report",
+    "status": "Display all currently open lots",
+    "summary": "Show both status and report",
+    "history": "Show the event chain of one lot (trims, stop moves, splits)",
+    "prices": "Load a quotes file into the local price cache, or list cached quotes",
+    "batch": "Run add/trim/close/stop/split lines from a file with a single replay and append",
+    "import": "Import broker fills: buys become lots, sells trim open lots FIFO",
+    "migrate": "Rewrite a legacy ledger with the target_id column",
+    "convert": "Switch storage between one CSV, per-ticker shards and SQLite",
+    "compact": "Archive closed lots and replay from a baseline",
+    "shell": "Interactive prompt that keeps the portfolio in memory",
+    "serve": "Keep the portfolio in memory and serve CLI calls over a Unix socket",
+}
+_COMMAND_METAVAR = "{" + ",".join(_COMMAND_HELP) + "}"
 
-def cmd_summary(_: argparse.Namespace) -> None:
-    rows = load_rows()
-    positions, realized = build_portfolio(rows)
-    print_status(positions)
-    print_report(positions, realized)
 
 # 이 함수는 argparse.ArgumentParser 객체를 생성해서 리턴함. 즉 CLI 파서 생성기
-def build_parser() -> argparse.ArgumentParser:
+def build_parser(command: Optional[str] = None) -> argparse.ArgumentParser:
+    """
+    command 를 주면 그 서브 명령의 파서만 만든다 (main() 은 argv 에서 찾은 명령만 넘긴다).
+    None 이면 도움말/셸/데몬용으로 전체를 만든다.
+    """
+    import argparse
+
+    if command not in _COMMAND_HELP:
+        command = None
 
     p = argparse.ArgumentParser(
     prog="tradingbook",
@@ -380,91 +3582,206 @@ def build_parser() -> argparse.ArgumentParser:
     tradingbook status                                        # Show all open lots (ID-level view)
     tradingbook report                                        # Show ticker-level portfolio summary
     tradingbook summary                                       # status + report in one shot
+    tradingbook report --as-of 2024-03-31                     # Portfolio as of a past date (monthly snapshots)
+    tradingbook history --id 3                                # Trims (with P/L), stop moves and splits of lot id=3
+    tradingbook prices quotes.csv                             # Refresh the price cache → status/report show unrealized P/L
+    tradingbook batch stops.txt                               # Run write commands from a file in one append
+    tradingbook import fills.csv --map ticker=Symbol --stop-pct 8   # Broker fills → lots / FIFO trims
+    tradingbook migrate                                       # Add target_id column to a legacy ledger
+    tradingbook convert --to sharded                          # One append-only file per ticker
+    tradingbook --jobs 4 report                               # Replay ticker shards in parallel
+    tradingbook convert --to sqlite                           # Indexed trades.db (WAL); lot lookups by index
+    tradingbook compact                                       # Move closed lots' rows to the archive
+    tradingbook compact --verify                              # Audit archive + ledger against the baseline
+    tradingbook serve                                         # Resident daemon; later calls are forwarded
+    tradingbook shell                                         # Interactive prompt (tradingbook> status)
+    tradingbook --timings summary                             # Per-phase timing breakdown on stderr
+    tradingbook --profile cprofile --timings-format json report  # cProfile top entries as JSON
     """,
     formatter_class=argparse.RawDescriptionHelpFormatter,
     )
 
-    
+    # 전역 옵션: 리플레이 수치 엔진 선택
+    p.add_argument(
+        "--engine",
+        choices=["decimal", "fixed"],
+        default="decimal",
+        help="Replay arithmetic: Decimal (default) or scaled integers (an exact cross-check of Decimal, not faster)",
+    )
+    p.add_argument("--qty-digits", type=int, default=8,
+                   help="Decimal places kept for qty by the fixed engine (default: 8)")
+    p.add_argument("--price-digits", type=int, default=6,
+                   help="Decimal places kept for price by the fixed engine (default: 6)")
+
+    p.add_argument("--jobs", type=int, default=1,
+                   help="Processes used to replay ticker shards in parallel for status/report (sharded layout only)")
+
+    # 전역 옵션: 계측 (없으면 아무 비용 없음)
+    p.add_argument("--timings", action="store_true",
+                   help="Print per-phase timings (parse, replay, checkpoint, append, printing) to stderr")
+    p.add_argument("--profile", choices=["cprofile", "tracemalloc"],
+                   help="Run the command under cProfile or tracemalloc and print the top entries to stderr")
+    p.add_argument("--timings-format", choices=["text", "json"], default="text",
+                   help="Format of the --timings/--profile report (default: text)")
 
     # add, trim, close, stop, report 같은 서브 명령어를 지원하도록 설정
     # dest="command" → 사용자가 입력한 명령어는 args.command에 저장됨
     # required=True → 반드시 하나의 서브 명령어는 입력해야 함
-    sub = p.add_subparsers(dest="command", required=True)
+    # 서브 파서를 하나만 만들 때는 미리 계산된 전체 명령 목록을 metavar 로 써서 usage 문구를 같게 유지
+    metavar = None if command is None else _COMMAND_METAVAR
+    sub = p.add_subparsers(dest="command", required=True, metavar=metavar)
+
+    def want(name: str) -> bool:
+        return command is None or command == name
 
     ### add 명령어 정의
-    add_p = sub.add_parser("add", help="Add a new lot (buy)")
-    # positional argument (필수인자, 반드시 순서를 지켜야 함)
-    add_p.add_argument("ticker", help="Stock ticker symbol (e.g., TSLA)")
-    add_p.add_argument("qty", help="Number of shares to buy (e.g., 100)")
-    add_p.add_argument("price", help="Entry price per share (e.g., 200.0)")
-    add_p.add_argument("stop", help="Initial stop loss price (e.g., 180.0)")
+    if want("add"):
+        add_p = sub.add_parser("add", help=_COMMAND_HELP["add"])
+        # positional argument (필수인자, 반드시 순서를 지켜야 함)
+        add_p.add_argument("ticker", help="Stock ticker symbol (e.g., TSLA)")
+        add_p.add_argument("qty", help="Number of shares to buy (e.g., 100)")
+        add_p.add_argument("price", help="Entry price per share (e.g., 200.0)")
+        add_p.add_argument("stop", help="Initial stop loss price (e.g., 180.0)")
 
-    add_p.add_argument("--note", help="Optional memo or trade note")
-    # 선택인자 (--arg 사용 시에만 사용, 순서 상관 없고 생략 가능함)
-    add_p.add_argument("--date", help="Transaction date (YYYY-MM-DD). Defaults to today.")    
-    # 실행함수 등록
-    add_p.set_defaults(func=cmd_add)
+        add_p.add_argument("--note", help="Optional memo or trade note")
+        # 선택인자 (--arg 사용 시에만 사용, 순서 상관 없고 생략 가능함)
+        add_p.add_argument("--date", help="Transaction date (YYYY-MM-DD). Defaults to today.")    
+        # 실행함수 등록
+        add_p.set_defaults(func=cmd_add)
 
 
     ### trim 명령어 등록
-    trim_p = sub.add_parser("trim", help="Sell part of a lot (partial exit)")
+    if want("trim"):
+        trim_p = sub.add_parser("trim", help=_COMMAND_HELP["trim"])
 
-    trim_p.add_argument("ticker", help="Stock ticker (e.g., TSLA)")
-    trim_p.add_argument("qty", help="Quantity to sell (e.g., 30)")
-    trim_p.add_argument("--id", required=True, type=int, help="Target lot ID to trim from")
-    trim_p.add_argument("--price", required=True, help="Sell price (e.g., 220.5)")
-    trim_p.add_argument("--note", help="Optional memo or trade note")
-    trim_p.add_argument("--date", help="Execution date (YYYY-MM-DD)")
-    trim_p.set_defaults(func=cmd_trim)
+        trim_p.add_argument("ticker", help="Stock ticker (e.g., TSLA)")
+        trim_p.add_argument("qty", help="Quantity to sell (e.g., 30)")
+        trim_p.add_argument("--id", required=True, type=int, help="Target lot ID to trim from")
+        trim_p.add_argument("--price", required=True, help="Sell price (e.g., 220.5)")
+        trim_p.add_argument("--note", help="Optional memo or trade note")
+        trim_p.add_argument("--date", help="Execution date (YYYY-MM-DD)")
+        trim_p.set_defaults(func=cmd_trim)
 
 
     # close 명령어 등록
-    close_p = sub.add_parser("close", help="Close an entire lot (full exit)")
+    if want("close"):
+        close_p = sub.add_parser("close", help=_COMMAND_HELP["close"])
 
-    close_p.add_argument("ticker", help="Stock ticker (e.g., TSLA)")
-    close_p.add_argument("--id", required=True, type=int, help="Lot ID to close")
-    close_p.add_argument("--price", required=True, help="Sell price for closing (e.g., 240.0)")
-    close_p.add_argument("--note", help="Optional memo or trade note")
-    close_p.add_argument("--date", help="Execution date (YYYY-MM-DD)")
-    close_p.set_defaults(func=cmd_close)
+        close_p.add_argument("ticker", help="Stock ticker (e.g., TSLA)")
+        close_p.add_argument("--id", required=True, type=int, help="Lot ID to close")
+        close_p.add_argument("--price", required=True, help="Sell price for closing (e.g., 240.0)")
+        close_p.add_argument("--note", help="Optional memo or trade note")
+        close_p.add_argument("--date", help="Execution date (YYYY-MM-DD)")
+        close_p.set_defaults(func=cmd_close)
 
 
     # stop 명령어 등록
-    stop_p = sub.add_parser("stop", help="Move stop loss for a specific lot")
+    if want("stop"):
+        stop_p = sub.add_parser("stop", help=_COMMAND_HELP["stop"])
 
-    stop_p.add_argument("ticker", help="Stock ticker (e.g., TSLA)")
-    stop_p.add_argument("new_stop", help="New stop loss price (e.g., 190.0)")
-    stop_p.add_argument("--id", required=True, type=int, help="Lot ID to update stop for")
-    stop_p.add_argument("--note", help="Optional memo or trade note")
-    stop_p.add_argument("--date", help="Execution date (YYYY-MM-DD)")
-    stop_p.set_defaults(func=cmd_stop)
+        stop_p.add_argument("ticker", help="Stock ticker (e.g., TSLA)")
+        stop_p.add_argument("new_stop", help="New stop loss price (e.g., 190.0)")
+        stop_p.add_argument("--id", required=True, type=int, help="Lot ID to update stop for")
+        stop_p.add_argument("--note", help="Optional memo or trade note")
+        stop_p.add_argument("--date", help="Execution date (YYYY-MM-DD)")
+        stop_p.set_defaults(func=cmd_stop)
 
     # split 명령어 등록
-    split_p = sub.add_parser("split", help="Split a lot into multiple lots")
-    split_p.add_argument("ticker", help="Stock ticker (e.g., TSLA)")
-    split_p.add_argument("--id", required=True, type=int, help="Lot ID to split")
-    split_p.add_argument(
-        "--parts",
-        required=True,
-        help="Parts as 'QTY:STOP' tokens separated by space",
-    )
-    split_p.add_argument("--note", help="Optional memo or trade note")
-    split_p.add_argument("--date", help="Execution date (YYYY-MM-DD)")
-    split_p.set_defaults(func=cmd_split)
+    if want("split"):
+        split_p = sub.add_parser("split", help=_COMMAND_HELP["split"])
+        split_p.add_argument("ticker", help="Stock ticker (e.g., TSLA)")
+        split_p.add_argument("--id", required=True, type=int, help="Lot ID to split")
+        split_p.add_argument(
+            "--parts",
+            required=True,
+            help="Parts as 'QTY:STOP' tokens separated by space",
+        )
+        split_p.add_argument("--note", help="Optional memo or trade note")
+        split_p.add_argument("--date", help="Execution date (YYYY-MM-DD)")
+        split_p.set_defaults(func=cmd_split)
 
 
     # report 명령어 등록
-    rep_p = sub.add_parser("report", help="Display portfolio summary and P/L report")
-    rep_p.set_defaults(func=cmd_report)
+    if want("report"):
+        rep_p = sub.add_parser("report", help=_COMMAND_HELP["report"])
+        rep_p.add_argument("--as-of", type=_as_of_date, metavar="YYYY-MM-DD",
+                           help="Show the portfolio at the end of this date (rows dated on or before it)")
+        rep_p.set_defaults(func=cmd_report)
 
 
     # status 명령어 등록
-    stat_p = sub.add_parser("status", help="Display all currently open lots")
-    stat_p.set_defaults(func=cmd_status)
+    if want("status"):
+        stat_p = sub.add_parser("status", help=_COMMAND_HELP["status"])
+        stat_p.add_argument("--as-of", type=_as_of_date, metavar="YYYY-MM-DD",
+                           help="Show the portfolio at the end of this date (rows dated on or before it)")
+        stat_p.set_defaults(func=cmd_status)
 
     # summary 명령어 등록
-    sum_p = sub.add_parser("summary", help="Show both status and report")
-    sum_p.set_defaults(func=cmd_summary)
+    if want("summary"):
+        sum_p = sub.add_parser("summary", help=_COMMAND_HELP["summary"])
+        sum_p.add_argument("--as-of", type=_as_of_date, metavar="YYYY-MM-DD",
+                           help="Show the portfolio at the end of this date (rows dated on or before it)")
+        sum_p.set_defaults(func=cmd_summary)
+
+    # history 명령어 등록
+    if want("history"):
+        hist_p = sub.add_parser("history", help=_COMMAND_HELP["history"])
+        hist_p.add_argument("--id", required=True, type=int, help="Lot ID to trace")
+        hist_p.set_defaults(func=cmd_history)
+
+    # prices 명령어 등록
+    if want("prices"):
+        price_p = sub.add_parser("prices", help=_COMMAND_HELP["prices"])
+        price_p.add_argument("file", nargs="?",
+                             help="Quotes CSV/JSON written by your price script ('-' reads stdin; omit to list)")
+        price_p.set_defaults(func=cmd_prices)
+
+    # batch 명령어 등록
+    if want("batch"):
+        batch_p = sub.add_parser("batch", help=_COMMAND_HELP["batch"])
+        batch_p.add_argument("file", nargs="?", default="-",
+                             help="Command file, one subcommand per line ('-' or omitted: read stdin)")
+        batch_p.set_defaults(func=cmd_batch)
+
+    # import 명령어 등록
+    if want("import"):
+        imp_p = sub.add_parser("import", help=_COMMAND_HELP["import"])
+        imp_p.add_argument("file", help="Broker fills CSV, oldest fill first ('-' reads stdin)")
+        imp_p.add_argument("--map", action="append", default=[], metavar="FIELD=COLUMN",
+                           help="Column for date/ticker/side/qty/price (repeatable; common headers are detected)")
+        imp_p.add_argument("--date-format", help="strptime format of the date column (default: ISO or MM/DD/YYYY)")
+        imp_p.add_argument("--stop-pct", help="Initial stop of bought lots, percent below the fill price (default: 0)")
+        imp_p.add_argument("--note", default="import", help="Note for imported rows (default: import)")
+        imp_p.set_defaults(func=cmd_import)
+
+    # migrate 명령어 등록
+    if want("migrate"):
+        mig_p = sub.add_parser("migrate", help=_COMMAND_HELP["migrate"])
+        mig_p.set_defaults(func=cmd_migrate)
+
+    # convert 명령어 등록
+    if want("convert"):
+        conv_p = sub.add_parser("convert", help=_COMMAND_HELP["convert"])
+        conv_p.add_argument("--to", required=True, choices=["sharded", "sqlite", "csv"],
+                            help="Target layout: one file per ticker, an indexed trades.db, or a single trades.csv")
+        conv_p.set_defaults(func=cmd_convert)
+
+    # compact 명령어 등록
+    if want("compact"):
+        comp_p = sub.add_parser("compact", help=_COMMAND_HELP["compact"])
+        comp_p.add_argument("--verify", action="store_true",
+                            help="Check the archive and ledger against the baseline instead of compacting")
+        comp_p.set_defaults(func=cmd_compact)
+
+    # shell 명령어 등록
+    if want("shell"):
+        shell_p = sub.add_parser("shell", help=_COMMAND_HELP["shell"])
+        shell_p.set_defaults(func=cmd_shell)
+
+    # serve 명령어 등록
+    if want("serve"):
+        serve_p = sub.add_parser("serve", help=_COMMAND_HELP["serve"])
+        serve_p.set_defaults(func=cmd_serve)
 
     return p
 
@@ -473,8 +3790,22 @@ def build_parser() -> argparse.ArgumentParser:
 # 기본값은 None. 이 경우 sys.argv를 자동 사용함
 def main(argv: List[str] | None = None) -> None:
 
-    # CLI 파서 생성
-    parser = build_parser() 
+    # 커맨드라인에서 실행된 경우, 데몬이 떠 있으면 명령을 넘기고 결과만 출력한다
+    if argv is None:
+        argv = sys.argv[1:]
+        code = forward_to_daemon(argv)
+        if code is not None:
+            if code:
+                sys.exit(code)
+            return
+
+    # CLI 파서 생성: 실행할 서브 명령의 파서만 만든다 (명령이 없거나 모르는 이름이면 전체)
+    parser = build_parser(_command_name(argv))
+    dispatch(parser, argv)
+
+
+def dispatch(parser: argparse.ArgumentParser, argv: List[str]) -> None:
+    """파싱 + 전역 옵션 반영 + 실행. main() 과 shell 이 같이 쓴다."""
 
     # 인자 실제로 파싱해서 네임스페이스 객체로 반환
     # ex) tradingbook add TSLA 100 200 180
@@ -490,8 +3821,19 @@ def main(argv: List[str] | None = None) -> None:
     #    )
     args = parser.parse_args(argv) 
 
+    # 전역 옵션은 모듈 설정값으로 반영 (Decimal 정밀도 설정과 같은 방식)
+    global ENGINE, QTY_DIGITS, PRICE_DIGITS, JOBS
+    ENGINE, QTY_DIGITS, PRICE_DIGITS, JOBS = args.engine, args.qty_digits, args.price_digits, args.jobs
+
     # 여기서 CLI 명령이 실제로 실행됨
-    args.func(args)
+    try:
+        if args.timings or args.profile:
+            _run_instrumented(args)
+        else:
+            args.func(args)
+    except ScaleError as e:
+        # 원장 값이 fixed 엔진의 자릿수보다 세밀함 → 트레이스백 대신 사용법 오류로
+        parser.error(f"{e} for --engine {args.engine}; raise --qty-digits/--price-digits or use --engine decimal")
 
 
 if __name__ == "__main__":
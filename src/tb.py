@@ -0,0 +1,11 @@
+"""
+얇은 진입점: python src/tb.py status
+
+python src/main.py 처럼 스크립트로 직접 실행한 파일은 바이트코드가 캐시되지 않아
+실행할 때마다 main.py 전체를 다시 컴파일한다. 여기서는 main 을 모듈로 import 하므로
+__pycache__ 의 .pyc 를 재사용해 그만큼 시작이 빠르다. (동작은 main.py 와 같다)
+"""
+import main
+
+if __name__ == "__main__":
+    main.main()